@@ -1,17 +1,43 @@
 import json
-from flask import Flask, jsonify, render_template, request, send_from_directory
+from flask import Flask, Response, jsonify, render_template, request, send_from_directory
 import os
 import threading
-import packet_handler
+import time
+from types import SimpleNamespace
 import rules_manager
 import log_manager
+import metrics
+import rate_limiter
 import uuid
-import shutil
 import math
 import argparse
 
 app = Flask(__name__, static_folder='static')
 sniffer_thread = None
+# The capture engine (packet_handler, which imports Scapy) is only imported when
+# sniffing is first started, so browsing logs and editing rules never waits for
+# Scapy. Until then the status endpoints report idle_engine's zero counters.
+CAPTURE_ENGINES = ('scapy', 'raw')  # packet_handler.CAPTURE_ENGINES, without importing it
+packet_handler = None
+engine_options = None  # parsed command line, applied when the engine is loaded
+idle_engine = SimpleNamespace(capture_engine='scapy', capture_stats={'packets': 0, 'drops': 0},
+                              pipeline_stats={'capture_drops': 0}, work_queue=None, send_queue=())
+RULES_PAGE_LIMIT = 50
+# Rule versions restart at 1 with the process, so ETags also carry a per-process tag
+RULES_ETAG_PREFIX = f"rules-{uuid.uuid4().hex[:8]}"
+
+@app.before_request
+def load_rules_once():
+    """
+    Loads the rules before the first request this process serves, whether it
+    runs under app.run(), flask run or a WSGI server, and starts watching
+    rules.json. Until rules.json loads, requests get a 503 and nothing is saved.
+    """
+    try:
+        rules_manager.ensure_rules_loaded()
+    except (OSError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Cannot load {rules_manager.RULES_FILE}: {e}"}), 503
+    rules_manager.start_rules_watcher()
 
 # --- Web UI ---
 @app.route('/')
@@ -19,35 +45,91 @@ def index():
     return render_template('index.html')
 
 # --- API Endpoints for Rule Management ---
+def rules_response(ruleset, build):
+    """
+    Tags a rules response with the snapshot version as its ETag and answers
+    304 Not Modified without building the body if the client already has it.
+    """
+    etag = f"{RULES_ETAG_PREFIX}-{ruleset.version}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def rule_matches_search(rule, search):
+    qname = rule.get('trigger_condition', {}).get('dns', {}).get('qname') or ''
+    return search in (rule.get('name') or '').lower() or search in qname.lower()
+
 @app.route('/api/rules', methods=['GET'])
 def get_rules():
-    return jsonify(rules_manager.rules)
+    """
+    ?page=1&limit=50 pages the list (limit=0 returns every rule), ?q= keeps rules whose
+    name or qname contains the text, ?fields=rule_id,name returns only those keys.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = max(request.args.get('limit', RULES_PAGE_LIMIT, type=int), 0)
+    search = request.args.get('q', '', type=str).strip().lower()
+    fields = [field for field in request.args.get('fields', '', type=str).split(',') if field]
+    ruleset = rules_manager.snapshot
+
+    def build():
+        rules = ruleset.rules
+        if search:
+            rules = [rule for rule in rules if rule_matches_search(rule, search)]
+        total_rules = len(rules)
+        if limit:
+            total_pages = math.ceil(total_rules / limit)
+            rules = rules[(page - 1) * limit:page * limit]
+        else:
+            total_pages = 1
+        if fields:
+            rules = [{field: rule[field] for field in fields if field in rule} for rule in rules]
+        return {
+            'rules': list(rules),
+            'page': page,
+            'pages': total_pages,
+            'limit': limit,
+            'total': total_rules,
+            'version': ruleset.version,
+        }
+
+    return rules_response(ruleset, build)
+
+@app.route('/api/rules/<string:rule_id>', methods=['GET'])
+def get_rule(rule_id):
+    ruleset = rules_manager.snapshot
+    for rule in ruleset.rules:
+        if rule.get('rule_id') == rule_id:
+            return rules_response(ruleset, lambda: rule)
+    return jsonify({"status": "error", "message": "Rule not found"}), 404
 
 @app.route('/api/rules', methods=['POST'])
 def add_rule():
     new_rule = request.json
     new_rule['rule_id'] = str(uuid.uuid4()) # Assign a unique ID
-    rules_manager.rules.append(new_rule)
-    rules_manager.save_rules()
+    try:
+        rules_manager.add_rule(new_rule)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     return jsonify(new_rule), 201
 
 @app.route('/api/rules/<string:rule_id>', methods=['PUT'])
 def update_rule(rule_id):
     updated_rule_data = request.json
-    for i, rule in enumerate(rules_manager.rules):
-        if rule.get('rule_id') == rule_id:
-            rules_manager.rules[i] = updated_rule_data
-            rules_manager.save_rules()
+    try:
+        if rules_manager.update_rule(rule_id, updated_rule_data):
             return jsonify(updated_rule_data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     return jsonify({"status": "error", "message": "Rule not found"}), 404
 
 @app.route('/api/rules/<string:rule_id>', methods=['DELETE'])
 def delete_rule(rule_id):
-    for i, rule in enumerate(rules_manager.rules):
-        if rule.get('rule_id') == rule_id:
-            del rules_manager.rules[i]
-            rules_manager.save_rules()
-            return jsonify({"status": "success", "message": "Rule deleted"})
+    if rules_manager.delete_rule(rule_id):
+        return jsonify({"status": "success", "message": "Rule deleted"})
     return jsonify({"status": "error", "message": "Rule not found"}), 404
 
 @app.route('/api/rules/import', methods=['POST'])
@@ -62,9 +144,10 @@ def import_rules():
             new_rules = json.load(file)
             # Optional: add to existing or replace
             # This implementation replaces all current rules
-            rules_manager.rules = new_rules
-            rules_manager.save_rules()
+            rules_manager.replace_rules(new_rules)
             return jsonify({"status": "success", "message": f"Imported {len(new_rules)} rules."})
+        except ValueError as e: # Includes JSON decode errors
+            return jsonify({"status": "error", "message": str(e)}), 400
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -80,7 +163,12 @@ def list_log_sessions():
 
     # Sorting
     reverse = (order == 'desc')
-    sessions.sort(reverse=reverse) # Simple sort as it's just a list of strings
+    sort_keys = {
+        'id': lambda session: session['task_id'],
+        'packets': lambda session: (session['packets'], session['task_id']),
+        'size': lambda session: (session['log_bytes'] + session['pcap_bytes'], session['task_id']),
+    }
+    sessions.sort(key=sort_keys.get(sort_by, sort_keys['id']), reverse=reverse)
 
     # Pagination
     total_sessions = len(sessions)
@@ -104,13 +192,28 @@ def get_log_session_details(task_id):
         return jsonify({"status": "error", "message": "Log session not found"}), 404
     return jsonify(details)
 
+@app.route('/api/logs/<string:task_id>/log', methods=['GET'])
+def read_task_log(task_id):
+    """
+    Ranged access to task.log: ?offset=N&length=M reads forward from N (poll with the
+    returned next_offset to follow a live session); without offset, returns the last
+    M bytes, or the M bytes before ?end=N to page backwards.
+    """
+    log = log_manager.read_task_log(
+        task_id,
+        offset=request.args.get('offset', type=int),
+        length=request.args.get('length', log_manager.LOG_TAIL_BYTES, type=int),
+        end=request.args.get('end', type=int),
+    )
+    if log is None:
+        return jsonify({"status": "error", "message": "Log session not found"}), 404
+    return jsonify(log)
+
 @app.route('/api/logs/<string:task_id>', methods=['DELETE'])
 def delete_log_session(task_id):
-    log_dir = os.path.join(log_manager.LOGS_DIR, task_id)
-    if not os.path.isdir(log_dir):
-        return jsonify({"status": "error", "message": "Log session not found"}), 404
     try:
-        shutil.rmtree(log_dir)
+        if not log_manager.delete_log_session(task_id):
+            return jsonify({"status": "error", "message": "Log session not found"}), 404
         return jsonify({"status": "success", "message": f"Log session {task_id} deleted."})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -120,15 +223,55 @@ def download_pcap(task_id, filename):
     log_dir = os.path.join(log_manager.LOGS_DIR, task_id)
     return send_from_directory(log_dir, filename, as_attachment=True)
 
+@app.route('/api/logs/<string:task_id>/pcap')
+def download_filtered_pcap(task_id):
+    """
+    Streams the session's capture reduced to the exchanges matching every given
+    filter: ?rule_id=, ?qname= (exact or '*.suffix'), ?start= and ?end= (epoch seconds).
+    """
+    stream = log_manager.iter_filtered_pcap(
+        task_id,
+        rule_id=request.args.get('rule_id') or None,
+        qname=request.args.get('qname') or None,
+        start=request.args.get('start', type=float),
+        end=request.args.get('end', type=float),
+    )
+    if stream is None:
+        return jsonify({"status": "error", "message": "No indexed capture for this log session"}), 404
+    return Response(stream, mimetype='application/vnd.tcpdump.pcap', headers={
+        'Content-Disposition': f'attachment; filename={task_id}-filtered.pcap',
+    })
+
 # --- API Endpoints for Sniffer Control ---
+def load_capture_engine():
+    """
+    Imports the capture engine, and with it Scapy, on first use and applies the
+    command-line options to it.
+    """
+    global packet_handler
+    if packet_handler is None:
+        started = time.perf_counter()
+        import packet_handler as engine
+        import fanout
+        if engine_options is not None:
+            engine.capture_engine = engine_options.engine
+            engine.SEND_BATCH_SIZE = engine_options.send_batch
+            engine.PIPELINE_WORKERS = engine_options.workers
+            engine.PIPELINE_QUEUE_SIZE = engine_options.queue_size
+            fanout.PROCESSES = engine_options.processes
+        packet_handler = engine
+        log_manager.console.info("Capture engine loaded in %.2fs", time.perf_counter() - started)
+    return packet_handler
+
 @app.route('/api/control/start', methods=['POST'])
 def start_sniffing_api():
     global sniffer_thread
     if sniffer_thread and sniffer_thread.is_alive():
         return jsonify({"status": "error", "message": "Sniffer is already running."}), 400
     
+    engine = load_capture_engine()
     log_manager.start_new_log_session() # Start a new log session
-    sniffer_thread = threading.Thread(target=packet_handler.start_sniffing, daemon=True)
+    sniffer_thread = threading.Thread(target=engine.start_sniffing, daemon=True)
     sniffer_thread.start()
     return jsonify({"status": "success", "message": "Packet sniffer started."})
 
@@ -139,14 +282,110 @@ def stop_sniffing_api():
         return jsonify({"status": "error", "message": "Sniffer is not running."}), 400
         
     packet_handler.stop_sniffing_handler()
-    sniffer_thread.join(timeout=5) # Wait for the thread to finish
+    sniffer_thread.join(timeout=packet_handler.STOP_TIMEOUT) # Wait for the thread to finish
     sniffer_thread = None
+    log_manager.stop_log_session() # Flush and close the session's log and pcap files
     return jsonify({"status": "success", "message": "Packet sniffer stopped."})
 
+@app.route('/api/control/status', methods=['GET'])
+def sniffer_status_api():
+    engine = packet_handler or idle_engine
+    return jsonify({
+        "running": bool(sniffer_thread and sniffer_thread.is_alive()),
+        "engine": engine.capture_engine,
+        "kernel_packets": engine.capture_stats['packets'],
+        "kernel_drops": engine.capture_stats['drops'],
+        "capture_queue_drops": engine.pipeline_stats['capture_drops'],
+        "log_queue_drops": log_manager.writer_stats['dropped'],
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_api():
+    """
+    Responder counters, per-rule matches and the response latency histogram in
+    the Prometheus text format.
+    """
+    engine = packet_handler or idle_engine
+    work_queue, log_queue = engine.work_queue, log_manager.log_queue
+    totals = {
+        "kernel_packets_total": ("Packets seen by the capture sockets (kernel counter)",
+                                 engine.capture_stats['packets']),
+        "kernel_drops_total": ("Packets dropped by the kernel before capture", engine.capture_stats['drops']),
+        "capture_queue_drops_total": ("Packets dropped on a full worker queue",
+                                      engine.pipeline_stats['capture_drops']),
+        "log_records_written_total": ("Log and pcap records written", log_manager.writer_stats['written']),
+        "log_queue_drops_total": ("Log and pcap records dropped on a full writer queue",
+                                  log_manager.writer_stats['dropped']),
+    }
+    gauges = {
+        "running": ("Whether the sniffer is running", int(bool(sniffer_thread and sniffer_thread.is_alive()))),
+        "capture_queue_depth": ("Packets waiting for a responder worker", work_queue.qsize() if work_queue else 0),
+        "send_queue_depth": ("Responses waiting for a batched send", len(engine.send_queue)),
+        "log_queue_depth": ("Records waiting for the log writer", log_queue.qsize() if log_queue else 0),
+        "rules_active": ("Enabled rules in the active snapshot", len(rules_manager.snapshot.active)),
+        "rules_version": ("Version of the active rule snapshot", rules_manager.snapshot.version),
+    }
+    return Response(metrics.render_prometheus(totals, gauges), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run DNS Authority Responder Flask App")
     parser.add_argument('--port', type=int, default=5000, help='Port to run the web server on')
+    parser.add_argument('--engine', choices=CAPTURE_ENGINES, default='scapy',
+                        help="Capture engine: 'scapy' (reference) or 'raw' (AF_PACKET fast path)")
+    parser.add_argument('--send-batch', type=int, default=1,
+                        help='Queue up to N responses per send flush (1 sends immediately)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Responder worker threads decoupled from capture (0 processes inline)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Responder processes sharing the capture via PACKET_FANOUT (raw engine, Linux; 0 = none)')
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help='Capacity of the packet queue used by the worker pipeline')
+    parser.add_argument('--rules-journal', action='store_true',
+                        help='Append rule edits to rules.json.journal instead of rewriting rules.json each time')
+    parser.add_argument('--pcap-rotate-mb', type=float, default=0,
+                        help='Start a new capture segment once the current one reaches this size (0 = never)')
+    parser.add_argument('--pcap-rotate-seconds', type=float, default=0,
+                        help='Start a new capture segment after this many seconds (0 = never)')
+    parser.add_argument('--pcap-compress', action='store_true', help='Gzip closed capture segments in the background')
+    parser.add_argument('--pcap-keep', type=int, default=0,
+                        help='Keep only the newest N capture segments of a session (0 = keep all)')
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help='Responses per second allowed per source address (0 = unlimited)')
+    parser.add_argument('--client-burst', type=int, default=0, help='Token bucket size per source address')
+    parser.add_argument('--rule-rate', type=float, default=0,
+                        help='Responses per second allowed per rule (0 = unlimited)')
+    parser.add_argument('--rule-burst', type=int, default=0, help='Token bucket size per rule')
+    parser.add_argument('--rate-table-size', type=int, default=65536,
+                        help='Source addresses tracked by the rate limiter before the least recent is evicted')
+    parser.add_argument('--slip', type=int, default=0,
+                        help='Answer every Nth rate-limited query with a truncated reply (0 = drop all)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Console log level; DEBUG enables the per-packet messages')
     args = parser.parse_args()
+    log_manager.configure_console_logging(args.log_level)
+    if args.processes > 1 and (args.engine != 'raw' or args.workers):
+        parser.error("--processes requires --engine raw and cannot be combined with --workers")
+    engine_options = args
+    idle_engine.capture_engine = args.engine
+    log_manager.PCAP_ROTATE_BYTES = int(args.pcap_rotate_mb * 1024 * 1024)
+    log_manager.PCAP_ROTATE_SECONDS = args.pcap_rotate_seconds
+    log_manager.PCAP_COMPRESS = args.pcap_compress
+    log_manager.PCAP_KEEP_SEGMENTS = args.pcap_keep
+    rate_limiter.CLIENT_RATE, rate_limiter.CLIENT_BURST = args.client_rate, args.client_burst
+    rate_limiter.RULE_RATE, rate_limiter.RULE_BURST = args.rule_rate, args.rule_burst
+    rate_limiter.TABLE_SIZE = args.rate_table_size
+    rate_limiter.SLIP = args.slip
+    rate_limiter.configure()
+    rules_manager.journal_enabled = args.rules_journal
+    # debug=True runs the app in a child process of the Werkzeug reloader; only
+    # that child serves requests, so only it loads the rules up front (to fail
+    # fast on a bad rules.json). Other servers load them on the first request.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        try:
+            rules_manager.ensure_rules_loaded()
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"[!] Cannot load {rules_manager.RULES_FILE}: {e}")
+        rules_manager.start_rules_watcher()
 
     # Use '0.0.0.0' to be accessible from the network
     app.run(host='0.0.0.0', port=args.port, debug=True)
@@ -0,0 +1,506 @@
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from scapy.all import Ether, IP, IPv6, UDP, DNS, DNSQR, DNSRROPT, rdpcap
+from scapy.layers.l2 import Dot1Q, Dot1AD
+import dns_parser
+import packet_handler
+import rules_manager
+
+# Rule shapes covering the response features the templates must reproduce.
+RESPONSE_SHAPES = {
+    "nxdomain": {
+        "dns_header": {"flags": {"aa": {"value": 0}, "rcode": {"value": 3},
+                                 "rd": {"mode": "inherit"}, "ad": {"mode": "inherit"}, "cd": {"mode": "inherit"}}},
+        "l2": {"src_mac": {"mode": "auto"}, "dst_mac": {"mode": "inherit"}},
+        "l3": {"src_ip": {"mode": "inherit"}, "dst_ip": {"mode": "inherit"}},
+        "l4": {"src_port": {"mode": "inherit"}, "dst_port": {"mode": "inherit"}},
+        "dns_answers": [], "dns_authority": [], "dns_additional": [],
+    },
+    "answers": {
+        "dns_header": {"flags": {"aa": {"value": 1}, "rd": {"mode": "custom", "value": 0}}},
+        "l2": {"src_mac": {"mode": "custom", "value": "02:00:00:00:00:01"}, "dst_mac": {"mode": "inherit"}},
+        "l3": {"src_ip": {"mode": "auto"}, "dst_ip": {"mode": "inherit"}},
+        "l4": {"src_port": {"mode": "custom", "value": 5353}, "dst_port": {"mode": "inherit"}},
+        "dns_answers": [
+            {"name": {"mode": "custom", "value": "atk.com"}, "type": 1, "ttl": 1, "rdata": "1.1.1.2"},
+            {"name": {"mode": "inherit"}, "type": 1, "ttl": 2, "rdata": "33.3.3.3"},
+            {"name": {"mode": "inherit"}, "type": 5, "ttl": 60, "rdata": "alias.example.net"},
+        ],
+        "dns_authority": [{"name": {"mode": "inherit"}, "type": 2, "ttl": 300, "rdata": "ns1.example.net"}],
+        "dns_additional": [{"type": 41, "udp_payload_size": 4096}],
+    },
+    # A delegation with glue: many names sharing suffixes, so it exercises name
+    # compression, and too big for 512 bytes, so it exercises truncation.
+    "referral": {
+        "dns_header": {"flags": {"aa": {"value": 0}}},
+        "dns_answers": [{"name": {"mode": "inherit"}, "type": 5, "ttl": 60, "rdata": "edge.example.net"}],
+        "dns_authority": [{"name": {"mode": "custom", "value": "example.net"}, "type": 2, "ttl": 3600,
+                           "rdata": f"{c}.ns.example.net"} for c in "abcdefghijklm"],
+        "dns_additional": [{"name": {"mode": "custom", "value": f"{c}.ns.example.net"}, "type": 1, "ttl": 3600,
+                            "rdata": f"198.51.100.{i + 1}"} for i, c in enumerate("abcdefghijklm")] +
+                          [{"name": {"mode": "custom", "value": f"{c}.ns.example.net"}, "type": 28, "ttl": 3600,
+                            "rdata": f"2001:db8::{i + 1:x}"} for i, c in enumerate("abcdefghijklm")] +
+                          [{"type": 41, "udp_payload_size": 1232}],
+    },
+}
+
+def make_rule(shape):
+    return {"rule_id": shape, "name": shape, "is_enabled": True, "priority": 1,
+            "trigger_condition": {"dns": {"qname": "example.com", "qtype": 1}},
+            "response_action": copy.deepcopy(RESPONSE_SHAPES[shape])}
+
+def make_queries(count, iface):
+    """
+    Synthesizes dissected DNS queries the way sniff() would hand them over.
+    Every fourth query is IPv6, every fifth has one VLAN tag and the one after
+    it two (QinQ), and every third advertises an EDNS buffer size.
+    """
+    queries = []
+    for i in range(count):
+        l2 = Ether(src="02:00:00:00:00:02", dst="02:00:00:00:00:03")
+        if i % 5 == 1:
+            l2 = l2 / Dot1Q(vlan=100 + i % 7)
+        elif i % 5 == 2:
+            l2 = l2 / Dot1AD(vlan=10) / Dot1Q(vlan=100 + i % 7, prio=i % 8)
+        if i % 4 == 3:
+            l3 = IPv6(src=f"fd00::{i:x}", dst="fd00::53")
+        else:
+            l3 = IP(src=f"10.0.{i // 250 % 250}.{i % 250 + 1}", dst="10.0.0.53")
+        frame = (l2 / l3 /
+                 UDP(sport=1024 + i % 60000, dport=53) /
+                 DNS(id=i & 0xFFFF, rd=i & 1, cd=(i >> 1) & 1,
+                     qd=DNSQR(qname=f"host{i}.Example.com", qtype=1),
+                     ar=DNSRROPT(rclass=(512, 1232, 4096)[i // 3 % 3]) if i % 3 == 0 else None))
+        packet = Ether(bytes(frame))
+        packet.sniffed_on = iface
+        queries.append(packet)
+    return queries
+
+def install_rules(count):
+    """
+    Replaces the active rules with 'count' rules for the synthetic query names.
+    Every third rule needs a full match on the source port, and every third of
+    those never matches, so both the index and the residual checks are exercised.
+    """
+    shapes = list(RESPONSE_SHAPES)
+    rules = []
+    for i in range(count):
+        rule = make_rule(shapes[i % len(shapes)])
+        rule['rule_id'] = f"bench-{i}"
+        rule['trigger_condition']['dns']['qname'] = f"host{i}.example.com"
+        if i % 3 == 1:
+            rule['trigger_condition']['l4'] = {'src_port': 1024 + i % 60000}
+        elif i % 3 == 2:
+            rule['trigger_condition']['l4'] = {'src_port': 1}
+        rules.append(rule)
+    rules_manager.activate_rules(rules)
+
+def time_per_packet(func, queries, rule):
+    start = time.perf_counter()
+    for packet in queries:
+        func(packet, rule)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+def bench_templates(queries):
+    """
+    Checks template output byte-for-byte against the Scapy path, times both paths
+    and reports the average response frame size.
+    """
+    ok = True
+    for shape in RESPONSE_SHAPES:
+        rule = make_rule(shape)
+        if packet_handler.get_response_template(rule) is None:
+            print(f"{shape:>10}: template unsupported, skipped")
+            continue
+
+        mismatches = sum(
+            packet_handler.generate_response(packet, rule) !=
+            bytes(packet_handler.build_response_packet(packet, rule))
+            for packet in queries
+        )
+        ok &= mismatches == 0
+
+        scapy_us = time_per_packet(lambda p, r: bytes(packet_handler.build_response_packet(p, r)), queries, rule)
+        template_us = time_per_packet(packet_handler.generate_response, queries, rule)
+        size = sum(len(packet_handler.generate_response(packet, rule)) for packet in queries) / len(queries)
+        print(f"{shape:>10}: scapy {scapy_us:8.1f} us/pkt  template {template_us:8.1f} us/pkt  "
+              f"speedup {scapy_us / template_us:5.1f}x  {size:6.0f} bytes  mismatches {mismatches}")
+    return ok
+
+def bench_wildcards(count, lookups=100000):
+    """
+    Builds a suffix trie from 'count' wildcard patterns and times lookups of
+    names that hit a pattern at varying depths, plus names that miss.
+    """
+    rules = []
+    for i in range(count):
+        rule = make_rule("nxdomain")
+        rule['rule_id'] = f"wild-{i}"
+        rule['trigger_condition']['dns']['qname'] = f"*.zone{i}.example.com"
+        rules.append(rule)
+    start = time.perf_counter()
+    rules_manager.activate_rules(rules)
+    build_ms = (time.perf_counter() - start) * 1e3
+
+    names = []
+    for i in range(lookups):
+        zone = i * 7919 % count
+        if i % 4 == 3:
+            names.append(f"host{i}.nozone{zone}.example.com")
+        else:
+            names.append(".".join(f"l{d}" for d in range(i % 3 + 1)) + f".zone{zone}.example.com")
+
+    trie = rules_manager.snapshot.wildcards
+    start = time.perf_counter()
+    hits = sum(bool(trie.lookup(name, 1)) for name in names)
+    lookup_us = (time.perf_counter() - start) / len(names) * 1e6
+
+    expected = len(names) - len(names) // 4
+    print(f"wildcards: {count} patterns built in {build_ms:.0f} ms, "
+          f"{lookup_us:.2f} us/lookup, {hits}/{len(names)} hits (expected {expected})")
+    return hits == expected
+
+def bench_subnets(count, lookups=20000):
+    """
+    Installs 'count' rules for one qname, each restricted to its own /24 source
+    subnet (every tenth also to a port range), and checks find_matching_rule
+    against a linear scan of match_query while timing both.
+    """
+    rules = []
+    for i in range(count):
+        rule = make_rule("nxdomain")
+        rule['rule_id'] = f"subnet-{i}"
+        rule['trigger_condition']['l3'] = {'src_ip': f"10.{i // 256 % 256}.{i % 256}.0/24"}
+        if i % 10 == 0:
+            rule['trigger_condition']['l4'] = {'src_port': "1024-2047"}
+        rules.append(rule)
+    rules_manager.activate_rules(rules)
+
+    # One dissected frame, with the source address and port patched per query (checksums are not verified)
+    base = bytearray(bytes(Ether() / IP(src="10.0.0.1", dst="10.0.0.53") / UDP(sport=1024, dport=53) /
+                           DNS(qd=DNSQR(qname="example.com", qtype=1))))
+    queries = []
+    for i in range(lookups):
+        base[26:30] = bytes((10, i * 31 % 64, i * 7 % 256, i % 250 + 1))
+        base[34:36] = (1024 + i % 2048).to_bytes(2, 'big')
+        queries.append(dns_parser.parse_frame(bytes(base)))
+
+    compiled = [(rule, rules_manager.compile_ranges(rule)) for rule in rules_manager.snapshot.active]
+
+    def linear(query):
+        for rule, ranges in compiled:
+            if rules_manager.match_query(query, rule, ranges):
+                return rule
+        return None
+
+    sample = queries[:max(100, 1000000 // count)]
+    mismatches = sum(rules_manager.find_matching_rule(q) is not linear(q) for q in sample)
+    start = time.perf_counter()
+    for query in queries:
+        rules_manager.find_matching_rule(query)
+    indexed_us = (time.perf_counter() - start) / len(queries) * 1e6
+    start = time.perf_counter()
+    for query in sample:
+        linear(query)
+    linear_us = (time.perf_counter() - start) / len(sample) * 1e6
+    print(f"subnets: {count} rules  indexed {indexed_us:8.2f} us/lookup  linear {linear_us:10.2f} us/lookup  "
+          f"mismatches {mismatches}")
+    return mismatches == 0
+
+# Rule shapes of the sweep: one distinct qname per rule, one wildcard zone per
+# rule, or a single qname with one /24 source subnet per rule.
+SWEEP_SHAPES = ('exact', 'wildcard', 'subnet')
+SWEEP_RULE_COUNTS = (10, 100, 1000, 10000, 100000)
+SWEEP_LOCAL_IP = "10.255.0.53"
+
+def _sweep_subnet(i):
+    return f"{10 + i // 65536}.{i // 256 % 256}.{i % 256}"
+
+def make_sweep_rules(shape, count):
+    """
+    'count' rules of one trigger shape; responses cycle through the RESPONSE_SHAPES.
+    """
+    shapes = list(RESPONSE_SHAPES)
+    rules = []
+    for i in range(count):
+        rule = make_rule(shapes[i % len(shapes)])
+        rule['rule_id'] = f"{shape}-{i}"
+        trigger = rule['trigger_condition']
+        if shape == 'exact':
+            trigger['dns']['qname'] = f"host{i}.example.com"
+        elif shape == 'wildcard':
+            trigger['dns']['qname'] = f"*.zone{i}.example.com"
+        else:
+            trigger['l3'] = {'src_ip': f"{_sweep_subnet(i)}.0/24"}
+        rules.append(rule)
+    return rules
+
+def make_sweep_frames(shape, count, queries):
+    """
+    Raw query frames for make_sweep_rules(shape, count); about half of them hit a rule.
+    """
+    frames = []
+    for i in range(queries):
+        key = i * 7919 % (2 * count)
+        qname, src = "example.com", "10.0.0.1"
+        if shape == 'exact':
+            qname = f"host{key}.example.com"
+        elif shape == 'wildcard':
+            qname = f"www.zone{key}.example.com"
+        else:
+            src = f"{_sweep_subnet(key)}.1" if key < count else "192.0.2.1"
+        frames.append(bytes(Ether(src="02:00:00:00:00:02", dst="02:00:00:00:00:03") /
+                            IP(src=src, dst=SWEEP_LOCAL_IP) / UDP(sport=1024 + i % 60000, dport=53) /
+                            DNS(id=i & 0xFFFF, rd=1, qd=DNSQR(qname=qname, qtype=1))))
+    return frames
+
+def percentiles(samples_ns, points=(50, 90, 99)):
+    """
+    Returns the given percentiles of a list of nanosecond samples, in microseconds.
+    """
+    if not samples_ns:
+        return [0.0 for _ in points]
+    ordered = sorted(samples_ns)
+    return [ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] / 1e3 for p in points]
+
+def time_stages(frames, iface, engine):
+    """
+    Times the parse, match and generate stages of every frame separately.
+    :return: {stage: [nanoseconds per frame]}; generate only covers matched queries.
+    """
+    stages = {'parse': [], 'match': [], 'generate': []}
+    clock = time.perf_counter_ns
+    for frame in frames:
+        t0 = clock()
+        if engine == 'raw':
+            query = dns_parser.parse_frame(frame)
+        else:
+            query = Ether(frame)
+        if query is None:
+            continue
+        query.sniffed_on = iface
+        t1 = clock()
+        rule = rules_manager.find_matching_rule(query)
+        t2 = clock()
+        stages['parse'].append(t1 - t0)
+        stages['match'].append(t2 - t1)
+        if rule:
+            packet_handler.generate_response(query, rule)
+            stages['generate'].append(clock() - t2)
+    return stages
+
+def replay(frames, iface, engine):
+    """
+    Feeds every frame through the engine's full callback (process_frame or
+    process_packet) the way the capture loop would.
+    """
+    if engine == 'raw':
+        now = time.time()
+        for frame in frames:
+            packet_handler.process_frame(frame, iface, now)
+    else:
+        for frame in frames:
+            packet = Ether(frame)
+            packet.sniffed_on = iface
+            packet_handler.process_packet(packet)
+
+def bench_sweep(rule_counts, shapes, queries, iface, engine, pcap_frames=None):
+    """
+    Replays synthetic (or captured) queries against growing rule sets of each
+    shape with sending and logging stubbed out, and reports throughput, per-stage
+    latency percentiles and memory allocated by the packet path.
+    """
+    sent = []
+    stubs = {'send_response': lambda iface, frame, captured_at=None: sent.append(len(frame)),
+             'log_exchange': lambda *args: None}
+    originals = {name: getattr(packet_handler, name) for name in stubs}
+    packet_handler.set_local_ips([SWEEP_LOCAL_IP])
+    print(f"sweep: engine {engine}, {queries if pcap_frames is None else len(pcap_frames)} queries per run; "
+          f"latencies are p50/p90/p99 in us")
+    try:
+        for name, stub in stubs.items():
+            setattr(packet_handler, name, stub)
+        for shape in shapes:
+            for count in rule_counts:
+                rules = make_sweep_rules(shape, count)
+                start = time.perf_counter()
+                rules_manager.activate_rules(rules)
+                build_ms = (time.perf_counter() - start) * 1e3
+                packet_handler.response_templates.clear()
+                if pcap_frames is None:
+                    frames = make_sweep_frames(shape, count, queries)
+                else:
+                    frames = pcap_frames
+                    packet_handler.set_local_ips(local_addresses(frames))
+
+                replay(frames, iface, engine)  # Warm up: compiles the response templates of the hit rules
+                stages = time_stages(frames, iface, engine)
+
+                sent.clear()
+                start = time.perf_counter()
+                replay(frames, iface, engine)
+                elapsed = time.perf_counter() - start
+
+                tracemalloc.start()  # Restarted per run, so the peak is this replay's
+                baseline, _ = tracemalloc.get_traced_memory()
+                replay(frames, iface, engine)
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                stage_text = "  ".join(
+                    f"{name} " + "/".join(f"{value:.1f}" for value in percentiles(samples))
+                    for name, samples in stages.items())
+                print(f"{shape:>8} {count:>6} rules (built in {build_ms:7.1f} ms): "
+                      f"{len(frames) / elapsed:9.0f} pkt/s  {len(sent) // 2}/{len(frames)} answered  {stage_text}  "
+                      f"mem peak {(peak - baseline) / 1024:.0f} KiB, retained {(current - baseline) / 1024:.0f} KiB")
+    finally:
+        for name, original in originals.items():
+            setattr(packet_handler, name, original)
+    return True
+
+def local_addresses(frames):
+    """
+    Treats every destination address in the frames as one of ours.
+    """
+    addresses = set()
+    for packet in map(Ether, frames):
+        for layer in (IP, IPv6):
+            if layer in packet:
+                addresses.add(packet[layer].dst)
+    return addresses
+
+def compare_engines(frames, iface):
+    """
+    Replays raw frames through the Scapy engine and the raw engine, checks that
+    both pick the same rule and emit identical responses, and times both.
+    """
+    packet_handler.set_local_ips(local_addresses(frames))
+
+    def scapy_engine(frame):
+        packet = Ether(frame)
+        packet.sniffed_on = iface
+        return packet_handler.respond_to_packet(packet)
+
+    def raw_engine(frame):
+        result = packet_handler.respond_to_frame(frame, iface)
+        return result[1:] if result else None
+
+    mismatches = sum(scapy_engine(frame) != raw_engine(frame) for frame in frames)
+    answered = sum(raw_engine(frame) is not None for frame in frames)
+    timings = {}
+    for name, engine in (('scapy', scapy_engine), ('raw', raw_engine)):
+        start = time.perf_counter()
+        for frame in frames:
+            engine(frame)
+        timings[name] = (time.perf_counter() - start) / len(frames) * 1e6
+
+    print(f"engines: {len(frames)} frames, {answered} answered, mismatches {mismatches}")
+    print(f"engines: scapy {timings['scapy']:8.1f} us/pkt  raw {timings['raw']:8.1f} us/pkt  "
+          f"speedup {timings['scapy'] / timings['raw']:5.1f}x")
+    return mismatches == 0
+
+# Runs in a fresh interpreter per rule count, in a directory holding that rules.json.
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+import rules_manager
+timings = {'import_app': time.perf_counter() - started, 'scapy_imported': 'scapy' in sys.modules}
+started = time.perf_counter()
+rules_manager.load_rules()
+timings[sys.argv[1]] = time.perf_counter() - started
+if rules_manager.cache_writer is not None:
+    rules_manager.cache_writer.join()
+started = time.perf_counter()
+import packet_handler
+timings['import_engine'] = time.perf_counter() - started
+print(json.dumps(timings))
+"""
+
+def bench_startup(rule_counts):
+    """
+    Times the control plane's startup for growing rule sets, each in a fresh
+    interpreter: importing app (which must not import Scapy), loading rules.json
+    without and then with the compiled cache, and loading the capture engine.
+    """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (source_dir, os.environ.get('PYTHONPATH')))))
+    lazy = True
+    for count in rule_counts:
+        with tempfile.TemporaryDirectory() as work_dir:
+            with open(os.path.join(work_dir, rules_manager.RULES_FILE), 'w') as f:
+                json.dump(make_sweep_rules('exact', count), f)
+            timings = {}
+            for step in ('load_json', 'load_cached'):
+                result = subprocess.run([sys.executable, '-c', STARTUP_PROBE, step], cwd=work_dir, env=env,
+                                        capture_output=True, text=True, check=True)
+                timings.update(json.loads(result.stdout.splitlines()[-1]))
+                lazy = lazy and not timings['scapy_imported']
+        print(f"startup: {count:>7} rules  import app {timings['import_app'] * 1000:7.1f} ms  "
+              f"load json {timings['load_json'] * 1000:8.1f} ms  cached {timings['load_cached'] * 1000:8.1f} ms  "
+              f"engine {timings['import_engine'] * 1000:7.1f} ms")
+    return lazy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline JanusDNS benchmarks")
+    parser.add_argument('--queries', type=int, default=2000, help='Number of synthetic queries')
+    parser.add_argument('--iface', default='lo', help="Interface used to resolve 'auto' fields")
+    parser.add_argument('--pcap', help='Replay this capture through both engines using the rules in rules.json')
+    parser.add_argument('--wildcards', type=int, metavar='N', help='Benchmark wildcard qname lookups with N patterns')
+    parser.add_argument('--subnets', type=int, metavar='N', help='Benchmark CIDR source conditions with N subnet rules')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Replay queries (synthetic, or --pcap) against growing rule sets of each shape')
+    parser.add_argument('--rule-counts', default=",".join(map(str, SWEEP_RULE_COUNTS)),
+                        help='Comma-separated rule counts for --sweep')
+    parser.add_argument('--shapes', default=",".join(SWEEP_SHAPES), help='Comma-separated rule shapes for --sweep')
+    parser.add_argument('--engine', choices=packet_handler.CAPTURE_ENGINES, default='raw',
+                        help='Engine whose packet path --sweep replays through')
+    parser.add_argument('--startup', action='store_true',
+                        help='Time app import and rules.json loading (with and without the compiled cache)')
+    args = parser.parse_args()
+
+    if args.startup:
+        if not bench_startup([int(count) for count in args.rule_counts.split(",")]):
+            raise SystemExit("[!] Importing app imported Scapy.")
+        raise SystemExit(0)
+
+    if args.sweep:
+        shapes = args.shapes.split(",")
+        if not set(shapes) <= set(SWEEP_SHAPES):
+            parser.error(f"--shapes must be a subset of {','.join(SWEEP_SHAPES)}")
+        pcap_frames = [bytes(packet) for packet in rdpcap(args.pcap)] if args.pcap else None
+        bench_sweep([int(count) for count in args.rule_counts.split(",")], shapes,
+                    args.queries, args.iface, args.engine, pcap_frames)
+        raise SystemExit(0)
+
+    if args.subnets:
+        if not bench_subnets(args.subnets):
+            raise SystemExit("[!] Indexed subnet lookups disagree with a linear scan.")
+        raise SystemExit(0)
+
+    if args.wildcards:
+        if not bench_wildcards(args.wildcards):
+            raise SystemExit("[!] Wildcard lookups returned unexpected matches.")
+        raise SystemExit(0)
+
+    if args.pcap:
+        rules_manager.load_rules()
+        frames = [bytes(packet) for packet in rdpcap(args.pcap)]
+        if not compare_engines(frames, args.iface):
+            raise SystemExit("[!] The raw engine disagrees with the Scapy engine.")
+        raise SystemExit(0)
+
+    queries = make_queries(args.queries, args.iface)
+    if not bench_templates(queries):
+        raise SystemExit("[!] Template output differs from the Scapy reference path.")
+
+    install_rules(args.queries // 2)
+    if not compare_engines([bytes(packet) for packet in queries], args.iface):
+        raise SystemExit("[!] The raw engine disagrees with the Scapy engine.")
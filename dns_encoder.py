@@ -0,0 +1,186 @@
+import bisect
+import struct
+from scapy.all import DNSRR
+
+DNS_HEADER_LEN = 12
+TYPE_OPT = 41
+DEFAULT_UDP_PAYLOAD_SIZE = 1232
+# Responses to queries without EDNS must fit in 512 bytes; smaller EDNS buffer
+# sizes are treated as 512 too (RFC 6891, section 6.2.5).
+CLASSIC_UDP_SIZE = 512
+# Types whose rdata is a single domain name that may be compressed (RFC 3597,
+# section 4): NS, MD, MF, CNAME, PTR. DNAME rdata must stay uncompressed.
+COMPRESSIBLE_RDATA_TYPES = (2, 3, 4, 5, 12)
+MAX_LABEL_LEN = 63
+MAX_NAME_LEN = 255
+MAX_POINTER = 0x3FFF
+# The first question's name starts right after the header, so inherited RR
+# names are always this pointer.
+QNAME_POINTER = b'\xc0\x0c'
+SECTIONS = ('dns_answers', 'dns_authority', 'dns_additional')
+ADDITIONAL = 2
+
+_rr_fixed = struct.Struct('!HHIH')
+_pointer = struct.Struct('!H')
+
+class EncodedRecords:
+    """
+    A rule's answer, authority and additional records encoded once, with their
+    names compressed against the query name and against each other.
+    All records but the OPT are one block, in section order, with 'ends' holding
+    the end offset of each record. The block follows the question, whose length
+    varies per query, so pointers into the block are stored as (position, target)
+    'fixups' relative to its start and rebased per query. The OPT record is kept
+    apart and always goes last, so leaving it out moves nothing.
+    """
+    __slots__ = ('block', 'ends', 'sections', 'prefix_counts', 'fixups', 'max_target',
+                 'opt', 'uses_qname')
+
+def _labels(name):
+    """
+    Splits a presentation-format name ('example.com' or 'example.com.') into labels.
+    """
+    if isinstance(name, str):
+        name = name.encode()
+    name = name or b''
+    if name.endswith(b'.'):
+        name = name[:-1]
+    if not name:
+        return ()
+    labels = tuple(name.split(b'.'))
+    if any(not 0 < len(label) <= MAX_LABEL_LEN for label in labels):
+        raise ValueError(f"invalid name {name!r}")
+    if sum(len(label) + 1 for label in labels) + 1 > MAX_NAME_LEN:
+        raise ValueError(f"name too long: {name!r}")
+    return labels
+
+def _encode_name(labels, offset, targets, fixups):
+    """
+    Encodes a name that starts at 'offset' in the block, ending it with a pointer
+    to the longest suffix already written, and remembers its new suffixes.
+    """
+    parts = []
+    for i in range(len(labels)):
+        suffix = labels[i:]
+        target = targets.get(suffix)
+        if target is not None:
+            fixups.append((offset, target))
+            parts.append(b'\x00\x00')  # Filled in per query
+            return b''.join(parts)
+        if offset <= MAX_POINTER:
+            targets[suffix] = offset
+        parts.append(bytes((len(labels[i]),)) + labels[i])
+        offset += 1 + len(labels[i])
+    parts.append(b'\x00')
+    return b''.join(parts)
+
+def compile_records(action):
+    """
+    Encodes the RR sections of a response_action into EncodedRecords.
+    Only the first OPT record is used, and it is moved to the additional section.
+    Raises ValueError if a record cannot be encoded.
+    """
+    block = bytearray()
+    targets = {}  # name suffix (tuple of labels) -> offset in the block
+    fixups = []
+    ends, sections = [], []
+    counts = [0, 0, 0]
+    prefix_counts = [(0, 0, 0)]
+    opt = b''
+    uses_qname = False
+    for section, key in enumerate(SECTIONS):
+        for rr_conf in action.get(key) or []:
+            rr_type = rr_conf.get("type")
+            if rr_type == TYPE_OPT:
+                if not opt:
+                    try:
+                        opt = b'\x00' + _rr_fixed.pack(
+                            TYPE_OPT, rr_conf.get("udp_payload_size", DEFAULT_UDP_PAYLOAD_SIZE), 0, 0)
+                    except struct.error as e:
+                        raise ValueError(f"invalid OPT record: {e}")
+                continue
+
+            name_conf = rr_conf.get("name", {})
+            if name_conf.get("mode", "inherit") == "custom":
+                name = _encode_name(_labels(name_conf.get("value")), len(block), targets, fixups)
+            else:
+                name = QNAME_POINTER
+                uses_qname = True
+
+            try:
+                if rr_type in COMPRESSIBLE_RDATA_TYPES:
+                    # Scapy resolves type, class and TTL; the rdata name is ours to compress
+                    fixed = bytes(DNSRR(rrname=b'.', type=rr_type, ttl=rr_conf.get("ttl"), rdata=b'.'))[1:9]
+                    rdata = _encode_name(_labels(rr_conf.get("rdata")), len(block) + len(name) + 10,
+                                         targets, fixups)
+                    tail = fixed + _pointer.pack(len(rdata)) + rdata
+                else:
+                    tail = bytes(DNSRR(rrname=b'.', type=rr_type, ttl=rr_conf.get("ttl"),
+                                       rdata=rr_conf.get("rdata")))[1:]
+            except (OSError, TypeError, KeyError, struct.error) as e:
+                # Scapy reports an unresolvable address rdata as socket.gaierror and a
+                # wrongly typed value as TypeError; ValueError (UnicodeError included)
+                # already describes the problem and propagates as it is
+                raise ValueError(f"cannot serialize RR: {e}")
+
+            block += name + tail
+            ends.append(len(block))
+            sections.append(section)
+            counts[section] += 1
+            prefix_counts.append(tuple(counts))
+
+    records = EncodedRecords()
+    records.block = bytes(block)
+    records.ends = ends
+    records.sections = sections
+    records.prefix_counts = prefix_counts
+    records.fixups = fixups
+    records.max_target = max((target for _, target in fixups), default=0)
+    records.opt = opt
+    records.uses_qname = uses_qname
+    return records
+
+def encode_records(records, question_end, edns_size):
+    """
+    Lays out the records behind a question that ends at 'question_end' (counted
+    from the start of the DNS message), within the query's UDP size limit:
+    EDNS queries (edns_size > 0) get their advertised buffer size and the OPT
+    record, other queries 512 bytes and no OPT (RFC 6891, section 7).
+    Records are kept in order while they fit. An answer or authority record that
+    does not fit truncates the response (TC); additional records that do not fit
+    are simply left out (RFC 2181, section 9).
+    :return: ((ancount, nscount, arcount), encoded records, truncated), or None if
+             the records cannot follow this question (no question to inherit the
+             name from, or a pointer beyond the 14-bit range).
+    """
+    if records.uses_qname and question_end <= DNS_HEADER_LEN:
+        return None
+    if edns_size:
+        limit = max(edns_size, CLASSIC_UDP_SIZE)
+        opt = records.opt
+    else:
+        limit = CLASSIC_UDP_SIZE
+        opt = b''
+
+    ends = records.ends
+    kept = len(ends)
+    room = limit - question_end - len(opt)
+    if kept and ends[-1] > room:
+        kept = bisect.bisect_right(ends, room)
+    truncated = kept < len(ends) and records.sections[kept] != ADDITIONAL
+    block = records.block if kept == len(ends) else records.block[:ends[kept - 1] if kept else 0]
+
+    if records.fixups:
+        if question_end + records.max_target > MAX_POINTER:
+            return None
+        buffer = bytearray(block)
+        for position, target in records.fixups:
+            if position >= len(buffer):
+                break
+            _pointer.pack_into(buffer, position, 0xC000 | (question_end + target))
+        block = bytes(buffer)
+
+    ancount, nscount, arcount = records.prefix_counts[kept]
+    if opt:
+        arcount += 1
+    return (ancount, nscount, arcount), block + opt, truncated
@@ -0,0 +1,211 @@
+import socket
+import struct
+
+ETH_HEADER_LEN = 14
+ETH_TYPE_IPV4 = 0x0800
+ETH_TYPE_IPV6 = 0x86DD
+# 802.1Q and 802.1ad (QinQ outer) TPIDs, the ones Scapy dissects; up to two tags are accepted.
+VLAN_TPIDS = (0x8100, 0x88A8)
+MAX_VLAN_TAGS = 2
+VLAN_TAG_LEN = 4
+IPV6_HEADER_LEN = 40
+IP_PROTO_UDP = 17
+DNS_PORT = 53
+DNS_HEADER_LEN = 12
+TYPE_OPT = 41
+
+_eth_type = struct.Struct('!H')
+_ipv4_header = struct.Struct('!BBHHHBBH4s4s')
+_ipv6_header = struct.Struct('!IHBB16s16s')
+_udp_header = struct.Struct('!HHHH')
+_dns_header = struct.Struct('!HHHHHH')
+_question_tail = struct.Struct('!HH')
+_rr_fixed = struct.Struct('!HHIH')
+
+class ParsedQuery:
+    """
+    The fields of a DNS query that rule matching and response templates need,
+    decoded straight from the raw frame without Scapy dissection.
+    Addresses are kept packed (4 bytes for IPv4, 16 for IPv6); the string
+    properties are only built on demand. 'vlan' holds the frame's VLAN tags
+    (TPID and TCI of each, outermost first), b'' if it is untagged, and for
+    IPv6 'ttl' and 'proto' are the hop limit and next header. 'edns_size' is
+    the UDP payload size of the query's OPT record, 0 without EDNS.
+    """
+    __slots__ = ('frame', 'sniffed_on', 'time', 'vlan',
+                 'eth_src', 'eth_dst', 'ip_src', 'ip_dst', 'ttl', 'proto', 'sport', 'dport',
+                 'dns_id', 'dns_flags', 'qdcount', 'ancount', 'nscount', 'arcount',
+                 'qname', 'qtype', 'qclass', 'question', 'edns_size')
+
+    @property
+    def src_mac(self):
+        return ':'.join(f'{b:02x}' for b in self.eth_src)
+
+    @property
+    def dst_mac(self):
+        return ':'.join(f'{b:02x}' for b in self.eth_dst)
+
+    @property
+    def src_ip(self):
+        return ip_to_text(self.ip_src)
+
+    @property
+    def dst_ip(self):
+        return ip_to_text(self.ip_dst)
+
+    @property
+    def ip_version(self):
+        return 4 if len(self.ip_src) == 4 else 6
+
+    def flag(self, shift, width=1):
+        return (self.dns_flags >> shift) & ((1 << width) - 1)
+
+    @property
+    def qr(self):
+        return self.dns_flags >> 15
+
+def ip_to_text(packed):
+    """
+    Formats a packed IPv4 or IPv6 address the way Scapy reports it.
+    """
+    if len(packed) == 4:
+        return socket.inet_ntoa(packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def _parse_name(data, offset, end):
+    """
+    Decodes an uncompressed DNS name. Returns (labels, offset after the name),
+    or None if the name is malformed or uses compression.
+    """
+    labels = []
+    while offset < end:
+        length = data[offset]
+        offset += 1
+        if length == 0:
+            return labels, offset
+        if length & 0xC0 or offset + length > end:
+            return None
+        labels.append(data[offset:offset + length])
+        offset += length
+    return None
+
+def _edns_size(data, offset, end, skip, count):
+    """
+    Looks for an OPT record among the 'count' additional records that follow
+    'skip' answer and authority records at 'offset'. Returns its UDP payload
+    size, or 0 if there is none or the records are malformed.
+    """
+    for index in range(skip + count):
+        while True:  # Owner name, possibly ending in a compression pointer
+            if offset >= end:
+                return 0
+            length = data[offset]
+            if length & 0xC0 == 0xC0:
+                offset += 2
+                break
+            if length & 0xC0:
+                return 0
+            offset += 1 + length
+            if length == 0:
+                break
+        if offset + 10 > end:
+            return 0
+        rr_type, rr_class, _, rdlength = _rr_fixed.unpack_from(data, offset)
+        if rr_type == TYPE_OPT and index >= skip:
+            return rr_class
+        offset += 10 + rdlength
+    return 0
+
+def parse_frame(frame):
+    """
+    Parses an Ethernet/IPv4 or IPv6/UDP frame addressed to port 53, untagged or
+    with up to two VLAN tags, into a ParsedQuery. Returns None for anything else
+    (other protocols, IPv4 fragments, IPv6 extension headers, truncated or
+    malformed packets, messages without a question).
+    """
+    if len(frame) < ETH_HEADER_LEN + 20 + 8 + DNS_HEADER_LEN:
+        return None
+    eth_type = _eth_type.unpack_from(frame, 12)[0]
+    offset = ETH_HEADER_LEN
+    vlan = b''
+    if eth_type != ETH_TYPE_IPV4:  # Untagged IPv4 skips all of this
+        while eth_type in VLAN_TPIDS and offset < ETH_HEADER_LEN + MAX_VLAN_TAGS * VLAN_TAG_LEN:
+            if offset + VLAN_TAG_LEN > len(frame):
+                return None
+            eth_type = _eth_type.unpack_from(frame, offset + 2)[0]
+            offset += VLAN_TAG_LEN
+        vlan = frame[12:offset - 2]
+        if offset + 20 + 8 + DNS_HEADER_LEN > len(frame):
+            return None
+
+    if eth_type == ETH_TYPE_IPV4:
+        (version_ihl, _, total_length, _, frag, ttl, proto, _,
+         ip_src, ip_dst) = _ipv4_header.unpack_from(frame, offset)
+        header_length = (version_ihl & 0x0F) * 4
+        if version_ihl >> 4 != 4 or header_length < 20 or proto != IP_PROTO_UDP:
+            return None
+        if frag & 0x3FFF:  # More-fragments flag or a non-zero fragment offset
+            return None
+        ip_end = min(offset + total_length, len(frame))
+    elif eth_type == ETH_TYPE_IPV6:
+        if offset + IPV6_HEADER_LEN > len(frame):
+            return None
+        (version_flow, payload_length, proto, ttl,
+         ip_src, ip_dst) = _ipv6_header.unpack_from(frame, offset)
+        if version_flow >> 28 != 6 or proto != IP_PROTO_UDP:
+            return None
+        header_length = IPV6_HEADER_LEN
+        ip_end = min(offset + IPV6_HEADER_LEN + payload_length, len(frame))
+    else:
+        return None
+
+    offset += header_length
+    if offset + 8 + DNS_HEADER_LEN > ip_end:
+        return None
+    sport, dport, _, _ = _udp_header.unpack_from(frame, offset)
+    if dport != DNS_PORT:
+        return None
+
+    offset += 8
+    dns_id, dns_flags, qdcount, ancount, nscount, arcount = _dns_header.unpack_from(frame, offset)
+    if qdcount == 0:
+        return None
+
+    question_start = offset + DNS_HEADER_LEN
+    offset = question_start
+    first = None
+    for _ in range(qdcount):
+        parsed = _parse_name(frame, offset, ip_end)
+        if parsed is None or parsed[1] + 4 > ip_end:
+            return None
+        labels, offset = parsed
+        qtype, qclass = _question_tail.unpack_from(frame, offset)
+        offset += 4
+        if first is None:
+            first = (labels, qtype, qclass)
+
+    query = ParsedQuery()
+    query.frame = frame
+    query.sniffed_on = None
+    query.time = None
+    query.vlan = vlan
+    query.eth_dst = frame[0:6]
+    query.eth_src = frame[6:12]
+    query.ip_src = ip_src
+    query.ip_dst = ip_dst
+    query.ttl = ttl
+    query.proto = proto
+    query.sport = sport
+    query.dport = dport
+    query.dns_id = dns_id
+    query.dns_flags = dns_flags
+    query.qdcount = qdcount
+    query.ancount = ancount
+    query.nscount = nscount
+    query.arcount = arcount
+    labels, query.qtype, query.qclass = first
+    # Same form Scapy reports for DNSQR.qname, e.g. b'example.com.'
+    query.qname = b'.'.join(labels) + b'.'
+    query.question = frame[question_start:offset]
+    query.edns_size = _edns_size(frame, offset, ip_end, ancount + nscount, arcount) if arcount else 0
+    return query
@@ -0,0 +1,268 @@
+import multiprocessing
+import pickle
+import queue
+import signal
+import threading
+import time
+import log_manager
+import metrics
+import packet_handler
+import rate_limiter
+import rules_manager
+
+# --- Globals ---
+# Multi-process responder (raw engine only). With PROCESSES > 1 the sniffer
+# thread starts that many responder processes; each opens its own AF_PACKET
+# sockets in a PACKET_FANOUT group per interface, so the kernel spreads query
+# flows across processes (and cores) by hash. The first process creates the
+# groups, with ids the kernel keeps unique, and the others join them once it has
+# reported them, so another JanusDNS instance never shares our groups.
+# The Flask process is threaded, so workers are not forked from it: they come
+# from a forkserver that has already imported the capture engine
+# (FORKSERVER_PRELOAD), and get the settings in WORKER_SETTINGS and the compiled
+# rules from the control plane before they start answering. It stays their
+# control plane:
+# - rule edits: API edits (add/update/delete) are sent down each worker's pipe
+#   as the edits themselves, and a receiver thread in the worker applies them
+#   with rules_manager.edit_ruleset(). Anything else (a reload, an import, more
+#   than rules_manager.EDIT_LOG_SIZE edits between two syncs) sends the whole
+#   compiled snapshot. Pickling it stalls the control plane and unpickling it
+#   holds each worker's GIL, so its capture loop stops for as long (about 0.85 s
+#   and 1.6 s at 100k rules); the socket buffers absorb what arrives meanwhile.
+#   A shared counter lets workers skip messages superseded by a newer snapshot
+#   without unpickling them.
+# - logs: workers queue their log/pcap records to the control plane's writer
+# - stats: workers report metrics and kernel counters every STATS_POLL_INTERVAL
+PROCESSES = 0
+FORKSERVER_PRELOAD = ['fanout']  # Imports the capture engine, and Scapy, once
+# Module globals a worker copies from the control plane
+WORKER_SETTINGS = (
+    (packet_handler, ('capture_engine', 'active_interfaces', 'SEND_BATCH_SIZE', 'SEND_BATCH_TIMEOUT')),
+    (log_manager, ('current_task_id', 'log_file_path')),
+    (rate_limiter, ('CLIENT_RATE', 'CLIENT_BURST', 'RULE_RATE', 'RULE_BURST', 'TABLE_SIZE', 'SLIP')),
+)
+SYNC_INTERVAL = 0.2  # seconds between rule change checks in the control plane
+# Shutdown budget, kept below packet_handler.STOP_TIMEOUT so that the log
+# session is only closed once the workers' last records have been forwarded.
+JOIN_TIMEOUT = 2.5   # seconds a worker gets to exit before it is terminated
+KILL_TIMEOUT = 0.5   # seconds a terminated worker gets before it is killed
+FORWARD_TIMEOUT = 1  # seconds to forward the records still queued by the workers
+SETUP_TIMEOUT = 5    # seconds the first worker gets to create the fanout groups
+SNAPSHOT, STOP = 0, 1  # slots of the shared control array: generation of the last full snapshot sent, stop flag
+
+workers = []
+worker_stats = {}  # worker id -> last (capture_stats, log drops) it reported
+
+def _worker_settings():
+    return tuple(tuple(getattr(module, name) for name in names) for module, names in WORKER_SETTINGS)
+
+def _send_rules(pipe, generation, kind, payload):
+    """
+    Sends one rules message: a small (generation, kind) header, then the pickled
+    payload, a RuleSet ('snapshot') or a list of edit_ruleset() changes ('edits').
+    :return: False if the worker is gone.
+    """
+    try:
+        pipe.send_bytes(pickle.dumps((generation, kind)))
+        pipe.send_bytes(payload)
+    except OSError:
+        return False
+    return True
+
+def _receive_rules(rules_reader, control):
+    """
+    Applies the next rules message from the control plane.
+    Raises EOFError or OSError once the control plane has closed the pipe.
+    """
+    generation, kind = pickle.loads(rules_reader.recv_bytes())
+    payload = rules_reader.recv_bytes()
+    if generation < control[SNAPSHOT]:
+        return  # A newer full snapshot is already on its way and replaces this
+    if kind == 'snapshot':
+        rules_manager.activate_snapshot(pickle.loads(payload))
+        return
+    for change in pickle.loads(payload):
+        ruleset = rules_manager.edit_ruleset(rules_manager.snapshot, change)
+        if ruleset is not None:
+            rules_manager.activate_snapshot(ruleset)
+
+def _worker_main(worker_id, settings, console_level, fanout_groups, control, rules_reader, stats, records,
+                 joined):
+    """
+    Body of a responder process: the raw capture loop on its fanout sockets.
+    fanout_groups maps each interface to its group id, or None for the first
+    process, which creates the groups and reports their ids on 'joined'.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The control plane decides when to stop
+    log_manager.configure_console_logging(console_level)
+    for (module, names), values in zip(WORKER_SETTINGS, settings):
+        for name, value in zip(names, values):
+            setattr(module, name, value)
+    rate_limiter.configure()
+    log_manager.log_queue = records
+
+    sockets = packet_handler.open_raw_sockets(list(fanout_groups), fanout_groups)
+    if joined is not None:
+        joined.put({iface: fanout_groups[iface] for iface in sockets.values()})
+    try:
+        _receive_rules(rules_reader, control)  # The snapshot to start from
+    except (EOFError, OSError):
+        return
+    if not sockets:
+        log_manager.console.warning("Responder %s: no raw sockets could be opened.", worker_id)
+        return
+    packet_handler.refresh_interface_addresses()
+    threading.Thread(target=packet_handler.refresh_interface_addresses_periodically, daemon=True).start()
+    if packet_handler.SEND_BATCH_SIZE > 1:
+        threading.Thread(target=packet_handler.flush_send_queue_periodically, daemon=True).start()
+
+    def receive_rules():
+        while True:
+            try:
+                _receive_rules(rules_reader, control)
+            except (EOFError, OSError):
+                return
+
+    threading.Thread(target=receive_rules, daemon=True).start()
+
+    def running():
+        return not control[STOP]
+
+    def report():
+        stats.put((worker_id, metrics.snapshot(), dict(packet_handler.capture_stats),
+                   log_manager.writer_stats['dropped']))
+
+    try:
+        packet_handler.raw_capture_loop(sockets, running, report)
+    finally:
+        packet_handler.close_send_sockets()
+        report()
+
+def _apply_report(report):
+    """
+    Merges a worker's report into the control plane's metrics and counters.
+    Reports are cumulative, so only the difference to the previous one is added.
+    """
+    worker_id, worker_metrics, capture_stats, log_drops = report
+    metrics.set_remote(worker_id, worker_metrics)
+    previous_capture, previous_drops = worker_stats.get(worker_id, ({'packets': 0, 'drops': 0}, 0))
+    for key in ('packets', 'drops'):
+        packet_handler.capture_stats[key] += capture_stats[key] - previous_capture[key]
+    log_manager.writer_stats['dropped'] += log_drops - previous_drops
+    worker_stats[worker_id] = (capture_stats, log_drops)
+
+def _drain_reports(stats, timeout):
+    try:
+        _apply_report(stats.get(timeout=timeout))
+        while True:
+            _apply_report(stats.get_nowait())
+    except queue.Empty:
+        pass
+
+def _join_all(processes, timeout):
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        process.join(max(deadline - time.monotonic(), 0))
+
+def _forward_records(records):
+    """
+    Hands the workers' log and pcap records to this process's log writer.
+    """
+    while True:
+        record = records.get()
+        if record is None:
+            break
+        log_manager._enqueue(*record)
+
+def run_fanout_engine():
+    """
+    Starts PROCESSES responder processes and serves as their control plane until
+    sniffing is stopped: pushes rule changes and collects logs and statistics.
+    """
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    control = context.RawArray('Q', 2)
+    stats = context.Queue()
+    records = context.Queue(maxsize=log_manager.LOG_QUEUE_SIZE)
+    settings = _worker_settings()
+    console_level = log_manager.console.level
+    synced = rules_manager.snapshot
+    generation = 0
+    initial = pickle.dumps(synced, pickle.HIGHEST_PROTOCOL)  # Pickled once for all workers
+    pipes = []
+    worker_stats.clear()
+
+    def start_worker(worker_id, fanout_groups, joined=None):
+        rules_reader, rules_writer = context.Pipe(duplex=False)
+        process = context.Process(target=_worker_main, name=f"responder-{worker_id}", daemon=True,
+                                  args=(worker_id, settings, console_level, fanout_groups, control,
+                                        rules_reader, stats, records, joined))
+        process.start()
+        rules_reader.close()
+        workers.append(process)
+        pipes.append(rules_writer)
+        _send_rules(rules_writer, generation, 'snapshot', initial)
+
+    joined = context.Queue()
+    start_worker(0, dict.fromkeys(packet_handler.active_interfaces), joined)
+    try:
+        fanout_groups = joined.get(timeout=SETUP_TIMEOUT)
+    except queue.Empty:
+        fanout_groups = {}
+    if fanout_groups:
+        for worker_id in range(1, PROCESSES):
+            start_worker(worker_id, dict(fanout_groups))
+        log_manager.console.info("Started %s responder processes (PACKET_FANOUT groups %s).",
+                                 PROCESSES, sorted(fanout_groups.values()))
+    else:
+        log_manager.console.warning("The first responder process could not create any PACKET_FANOUT group. Aborting.")
+    forwarder = threading.Thread(target=_forward_records, args=(records,), daemon=True)
+    forwarder.start()
+
+    exited = set()
+    try:
+        while fanout_groups and not packet_handler.stop_sniffing.is_set():
+            if rules_manager.snapshot is not synced:
+                synced, edits = rules_manager.edits_since(synced.version)
+                generation += 1
+                if edits is None:
+                    control[SNAPSHOT] = generation
+                    kind, payload = 'snapshot', pickle.dumps(synced, pickle.HIGHEST_PROTOCOL)
+                else:
+                    kind, payload = 'edits', pickle.dumps(edits, pickle.HIGHEST_PROTOCOL)
+                for pipe in pipes:
+                    _send_rules(pipe, generation, kind, payload)  # A worker gone is reported below
+            _drain_reports(stats, SYNC_INTERVAL)
+            for process in workers:
+                if process.exitcode is not None and process.name not in exited:
+                    exited.add(process.name)
+                    log_manager.console.warning("Responder process %s exited with code %s.",
+                                                process.name, process.exitcode)
+    finally:
+        control[STOP] = 1
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        while any(process.is_alive() for process in workers) and time.monotonic() < deadline:
+            _drain_reports(stats, 0.1)  # Keep reading so no worker blocks flushing its queues
+        stuck = [process for process in workers if process.is_alive()]
+        for process in stuck:
+            log_manager.console.warning("Responder process %s did not stop in time, terminating it.", process.name)
+            process.terminate()
+        _join_all(stuck, KILL_TIMEOUT)
+        for process in stuck:
+            if process.is_alive():
+                process.kill()
+        _join_all(stuck, KILL_TIMEOUT)
+        _drain_reports(stats, 0)
+        metrics.retire_remote()
+        deadline = time.monotonic() + FORWARD_TIMEOUT
+        try:
+            records.put(None, timeout=FORWARD_TIMEOUT)
+        except queue.Full:
+            pass
+        forwarder.join(max(deadline - time.monotonic(), 0))
+        if forwarder.is_alive():
+            log_manager.console.warning("Not all log records of the responder processes could be written.")
+        for pipe in pipes:
+            pipe.close()
+        workers.clear()
+        log_manager.console.info("Responder processes stopped.")
@@ -1,32 +1,397 @@
 import os
 import datetime
-from scapy.all import wrpcap, DNS
+import gzip
+import json
+import logging
+import queue
+import shutil
+import struct
+import threading
+import time
+from dns_parser import ParsedQuery, parse_frame
 
 LOGS_DIR = "logs"
 current_task_id = None
 log_file_path = None
+DNS = None  # Scapy's DNS layer, bound by bind_scapy_layers() once the capture engine imports Scapy
+
+# Session index: task_id -> metadata (start/end time, counts, file sizes), persisted
+# as logs/sessions.json so listing sessions needs no directory scan. The writer
+# thread updates the live session's entry in place and saves the index every
+# INDEX_SAVE_INTERVAL seconds and when the session stops.
+SESSION_INDEX_FILE = "sessions.json"
+INDEX_SAVE_INTERVAL = 30.0  # seconds
+session_index = None
+index_lock = threading.Lock()
+# get_log_details() and read_task_log() return at most this many bytes of task.log.
+LOG_TAIL_BYTES = 64 * 1024
+
+# Console logger for the packet path. Per-packet messages are DEBUG records guarded
+# by `if log_manager.packet_debug:`, so unless debug is enabled they cost one
+# attribute check and are never formatted. Repeated messages are rate limited.
+console = logging.getLogger("janusdns")
+packet_debug = False
+CONSOLE_RATE_LIMIT = 20  # records per second and message template
+
+# Background writer: log lines and pcap records are queued by the packet path and
+# written by one thread that keeps task.log and the capture segment open. Buffers are
+# flushed every LOG_FLUSH_RECORDS records or LOG_FLUSH_INTERVAL seconds, and when
+# the session stops. A full queue drops the record (counted) instead of blocking.
+# If writing fails (e.g. the disk is full) the writer records the error in the
+# session's index entry and exits; later records are dropped.
+LOG_QUEUE_SIZE = 10000
+LOG_FLUSH_RECORDS = 256
+LOG_FLUSH_INTERVAL = 1.0  # seconds
+WRITER_STOP_TIMEOUT = 10.0  # seconds stop_log_session() waits for the writer to drain
+log_queue = None
+writer_thread = None
+writer_stats = {'written': 0, 'dropped': 0}
+_STOP = object()
+
+PCAP_GLOBAL_HEADER = struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1) # LINKTYPE_ETHERNET
+_pcap_record_header = struct.Struct('<IIII')
+# Sidecar index of each capture segment (capture.pcap -> capture.idx): one JSON line
+# per query/response pair, [offset, length, timestamp, rule_id, qname], used to
+# extract filtered pcaps.
+PCAP_INDEX_SUFFIX = ".idx"
+PCAP_STREAM_CHUNK = 1 << 20  # bytes copied per read when streaming a filtered pcap
+
+# Capture rotation. With either limit set, a session writes capture-0001.pcap,
+# capture-0002.pcap, ... and starts a new segment once the current one reaches
+# PCAP_ROTATE_BYTES or is PCAP_ROTATE_SECONDS old; otherwise it writes a single
+# capture.pcap. Closed segments are gzipped in the background if PCAP_COMPRESS is
+# set, and only the newest PCAP_KEEP_SEGMENTS segments of a session are kept.
+PCAP_ROTATE_BYTES = 0      # 0 = no size limit
+PCAP_ROTATE_SECONDS = 0    # 0 = no time limit
+PCAP_COMPRESS = False
+PCAP_KEEP_SEGMENTS = 0     # 0 = keep every segment
+
+class CaptureSegments:
+    """
+    The writer thread's open capture segment and its sidecar index, rotated by
+    size or age. Offsets in the index are relative to the segment they describe.
+    Keeps the session's 'pcap_bytes' at the size of the segments still on disk:
+    compressed segments count with their gzipped size, removed ones not at all.
+    """
+    def __init__(self, task_dir, session):
+        self.task_dir = task_dir
+        self.session = session
+        self.rotating = bool(PCAP_ROTATE_BYTES or PCAP_ROTATE_SECONDS)
+        self.number = 0
+        self.closed_sizes = {}  # number -> bytes on disk of each closed segment
+        self.closed_bytes = 0
+        self.pcap_file = self.index_file = None
+        self.open_next()
+
+    def path(self, number):
+        name = f"capture-{number:04d}.pcap" if self.rotating else "capture.pcap"
+        return os.path.join(self.task_dir, name)
+
+    def open_next(self):
+        self.number += 1
+        pcap_path = self.path(self.number)
+        self.pcap_file = open(pcap_path, 'wb')
+        self.pcap_file.write(PCAP_GLOBAL_HEADER)
+        self.index_file = open(pcap_path[:-len(".pcap")] + PCAP_INDEX_SUFFIX, 'w')
+        self.offset = len(PCAP_GLOBAL_HEADER)
+        self.session['pcap_bytes'] = self.closed_bytes + self.offset
+        self.records = 0
+        self.opened_at = time.monotonic()
+
+    def write(self, data, meta):
+        """
+        Appends one record pair with its index line.
+        """
+        self.pcap_file.write(data)
+        self.index_file.write(json.dumps([self.offset, len(data), *meta]) + "\n")
+        self.offset += len(data)
+        self.session['pcap_bytes'] = self.closed_bytes + self.offset
+        self.records += 1
+        if PCAP_ROTATE_BYTES and self.offset >= PCAP_ROTATE_BYTES:
+            self.rotate()
+        return len(data)
+
+    def flush(self):
+        self.pcap_file.flush()
+        self.index_file.flush()  # After the pcap, so indexed offsets are always on disk
+
+    def rotate_if_due(self):
+        if (PCAP_ROTATE_SECONDS and self.records
+                and time.monotonic() - self.opened_at >= PCAP_ROTATE_SECONDS):
+            self.rotate()
+
+    def rotate(self):
+        self.close()
+        self.open_next()
+        if PCAP_KEEP_SEGMENTS:
+            for number in range(self.number - PCAP_KEEP_SEGMENTS, 0, -1):
+                if not _remove_segment(self.path(number)):
+                    break  # Older ones are already gone
+                self._resize(number, 0)
+
+    def close(self):
+        self.pcap_file.close()
+        self.index_file.close()
+        with index_lock:
+            self.closed_sizes[self.number] = self.offset
+            self.closed_bytes += self.offset
+            self.offset = 0
+        if PCAP_COMPRESS:
+            threading.Thread(target=self._compress, args=(self.number,)).start()
+
+    def _compress(self, number):
+        compressed_size = _compress_segment(self.path(number))
+        if compressed_size is not None:
+            self._resize(number, compressed_size)
+            with index_lock:
+                try:
+                    _save_session_index()  # The session may have ended meanwhile
+                except OSError as e:
+                    console.warning("Could not save the session index: %s", e)
+
+    def _resize(self, number, size):
+        """
+        Records the new size on disk of a closed segment; 0 once it has been removed.
+        """
+        with index_lock:
+            if number not in self.closed_sizes:
+                return  # Removed by retention before it was compressed
+            self.closed_bytes += size - self.closed_sizes.pop(number)
+            if size:
+                self.closed_sizes[number] = size
+            self.session['pcap_bytes'] = self.closed_bytes + self.offset
+
+def _compress_segment(pcap_path):
+    """
+    Gzips a closed capture segment next to the original, then removes the original.
+    :return: the size of the gzipped segment, or None if it could not be compressed.
+    """
+    temp_path = pcap_path + ".gz.tmp"
+    try:
+        with open(pcap_path, 'rb') as source, gzip.open(temp_path, 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target, PCAP_STREAM_CHUNK)
+        os.replace(temp_path, pcap_path + ".gz")
+        os.remove(pcap_path)
+        return os.path.getsize(pcap_path + ".gz")
+    except OSError as e:  # E.g. the segment was removed by retention meanwhile
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if os.path.exists(pcap_path):
+            console.warning("Could not compress %s: %s", pcap_path, e)
+        return None
+
+def _remove_segment(pcap_path):
+    """
+    Deletes a segment (plain or gzipped) and its index. Returns False if there was none.
+    """
+    removed = False
+    for path in (pcap_path, pcap_path + ".gz", pcap_path[:-len(".pcap")] + PCAP_INDEX_SUFFIX):
+        try:
+            os.remove(path)
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+def list_capture_segments(task_dir):
+    """
+    Returns the session's capture files (capture.pcap or capture-NNNN.pcap[.gz]) in order.
+    """
+    return sorted(f for f in os.listdir(task_dir)
+                  if f.startswith("capture") and (f.endswith(".pcap") or f.endswith(".pcap.gz")))
+
+def _open_segment(pcap_path):
+    """
+    Opens a segment for reading, whether or not it has been gzipped yet.
+    """
+    try:
+        return open(pcap_path, 'rb')
+    except FileNotFoundError:
+        return gzip.open(pcap_path + ".gz", 'rb')
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` records per second through for each message template and
+    reports how many were suppressed once the next window opens.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.windows = {}  # template -> [window second, emitted, suppressed]
+
+    def filter(self, record):
+        window = int(time.monotonic())
+        state = self.windows.setdefault(record.msg, [window, 0, 0])
+        if state[0] != window:
+            if state[2]:
+                record.msg = f"{record.msg} (+{state[2]} similar messages suppressed)"
+            state[:] = [window, 0, 0]
+        if state[1] >= self.rate:
+            state[2] += 1
+            return False
+        state[1] += 1
+        return True
+
+def configure_console_logging(level="INFO"):
+    """
+    Sets up the rate-limited console handler. DEBUG enables the per-packet messages.
+    """
+    global packet_debug
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    handler.addFilter(RateLimitFilter(CONSOLE_RATE_LIMIT))
+    console.handlers[:] = [handler]
+    console.propagate = False
+    console.setLevel(level)
+    packet_debug = console.isEnabledFor(logging.DEBUG)
 
 def start_new_log_session():
     """
-    Starts a new logging session by creating a unique task directory and a single pcap file.
+    Starts a new logging session by creating a unique task directory; the writer
+    thread creates the capture segments in it.
     """
-    global current_task_id, log_file_path
+    global current_task_id, log_file_path, log_queue, writer_thread
     
+    stop_log_session()
     os.makedirs(LOGS_DIR, exist_ok=True)
     
-    current_task_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    started = datetime.datetime.now()
+    current_task_id = started.strftime("%Y%m%d%H%M%S")
     task_dir = os.path.join(LOGS_DIR, current_task_id)
     os.makedirs(task_dir, exist_ok=True)
     
     log_file_path = os.path.join(task_dir, "task.log")
-    pcap_file_path = os.path.join(task_dir, "capture.pcap")
-    
-    # Create an empty pcap file to append to later
-    wrpcap(pcap_file_path, [])
+    session = _new_session_entry(current_task_id, started.isoformat(timespec='seconds'))
+    segments = CaptureSegments(task_dir, session)
+    with index_lock:
+        _load_session_index()[current_task_id] = session
+        _save_session_index()
+
+    writer_stats.update(written=0, dropped=0)
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    writer_thread = threading.Thread(target=_write_records, args=(log_queue, log_file_path, segments, session),
+                                     daemon=True)
+    writer_thread.start()
     
-    print(f"[*] New log session started. Task ID: {current_task_id}")
+    console.info("New log session started. Task ID: %s", current_task_id)
     return current_task_id
 
+def stop_log_session():
+    """
+    Flushes everything still queued for the current session and closes its files.
+    """
+    global log_queue, writer_thread
+    if writer_thread is None:
+        return
+    if writer_thread.is_alive():
+        try:
+            log_queue.put(_STOP, timeout=WRITER_STOP_TIMEOUT)
+            writer_thread.join(timeout=WRITER_STOP_TIMEOUT)
+        except queue.Full:
+            pass
+    if writer_thread.is_alive():
+        console.warning("Log writer of session %s did not stop in time, abandoning it.", current_task_id)
+    writer_stats['dropped'] += log_queue.qsize()
+    log_queue = writer_thread = None
+    with index_lock:
+        session = _load_session_index().get(current_task_id)
+        if session is not None:
+            session['ended'] = datetime.datetime.now().isoformat(timespec='seconds')
+        _save_session_index()
+    console.info("Log session %s closed: %s records written, %s dropped.",
+                 current_task_id, writer_stats['written'], writer_stats['dropped'])
+
+def _write_records(records, log_path, segments, session):
+    """
+    Writer thread body: appends queued records to the open log file and capture
+    segment (rotating it when due) and keeps the session's index entry up to date.
+    """
+    try:
+        _write_loop(records, log_path, segments, session)
+    except Exception as e:
+        console.error("Log session %s failed, dropping its records from now on: %s", session['task_id'], e)
+        with index_lock:
+            session['error'] = str(e)
+            try:
+                _save_session_index()
+            except OSError:
+                pass  # Most likely the same full disk; the entry is saved with the next session
+
+def _write_loop(records, log_path, segments, session):
+    try:
+        with open(log_path, 'a') as log_file:
+            pending = 0
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            index_deadline = time.monotonic() + INDEX_SAVE_INTERVAL
+            while True:
+                try:
+                    record = records.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    record = None
+                if record is _STOP:
+                    break
+                if record is not None:
+                    kind, data, meta = record
+                    if kind == 'log':
+                        log_file.write(data)
+                        session['triggered'] += 1
+                        session['log_bytes'] += len(data.encode())
+                    else:
+                        segments.write(data, meta)
+                        session['packets'] += 2  # query and response
+                    writer_stats['written'] += 1
+                    pending += 1
+                if pending >= LOG_FLUSH_RECORDS or time.monotonic() >= deadline:
+                    if pending:
+                        log_file.flush()
+                        segments.flush()
+                        pending = 0
+                    segments.rotate_if_due()
+                    deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+                    if time.monotonic() >= index_deadline:
+                        with index_lock:
+                            _save_session_index()
+                        index_deadline = time.monotonic() + INDEX_SAVE_INTERVAL
+    finally:
+        segments.close()
+
+def _enqueue(kind, data, meta=None):
+    if log_queue is None:
+        return
+    try:
+        log_queue.put_nowait((kind, data, meta))
+    except queue.Full:
+        writer_stats['dropped'] += 1
+
+def _pcap_record(packet, timestamp):
+    """
+    Serializes one pcap record. Sniffed Scapy packets reuse their original bytes.
+    """
+    if not isinstance(packet, bytes):
+        timestamp = float(packet.time)
+        packet = getattr(packet, 'original', None) or bytes(packet)
+    seconds = int(timestamp)
+    return _pcap_record_header.pack(seconds, int((timestamp - seconds) * 1e6), len(packet), len(packet)) + packet
+
+def _query_qname(query_packet):
+    """
+    The query name without the trailing dot, from a ParsedQuery, a Scapy packet or a raw frame.
+    """
+    if isinstance(query_packet, bytes):
+        query_packet = parse_frame(query_packet)
+        if query_packet is None:
+            return ''
+    if isinstance(query_packet, ParsedQuery):
+        return query_packet.qname.decode(errors='replace').rstrip('.')
+    return query_packet[DNS].qd.qname.decode(errors='replace').rstrip('.')
+
+def bind_scapy_layers():
+    """
+    Resolves the Scapy DNS layer used to log dissected packets. Called by packet_handler.
+    """
+    global DNS
+    from scapy.layers.dns import DNS
+
 def log_triggered_rule(rule, query_packet):
     """
     Writes a log entry for a triggered rule.
@@ -35,51 +400,265 @@ def log_triggered_rule(rule, query_packet):
         return
         
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    qname = query_packet[DNS].qd.qname.decode().rstrip('.')
+    qname = _query_qname(query_packet)
     rule_name = rule.get('name', rule.get('rule_id'))
     
     log_message = f"{timestamp} - Rule '{rule_name}' triggered by query for '{qname}'.\n"
     
-    with open(log_file_path, 'a') as f:
-        f.write(log_message)
+    _enqueue('log', log_message)
 
-def save_pcap_files(rule, query_packet, response_packet):
+def save_pcap_files(rule, query_packet, response_packet, query=None):
     """
-    Appends the query and response packets to the single pcap file for the current session.
+    Queues the query and response packets for the single pcap file of the current session,
+    together with their capture.idx entry (time, rule_id, qname).
+    Packets may be Scapy packets or raw Ethernet frames (raw engine, response templates);
+    'query' is the already parsed query, if the caller has one.
     """
     if not current_task_id:
         return
         
-    task_dir = os.path.join(LOGS_DIR, current_task_id)
-    pcap_filepath = os.path.join(task_dir, "capture.pcap")
-    
-    # Append both packets to the existing pcap file
-    wrpcap(pcap_filepath, [query_packet, response_packet], append=True)
+    now = time.time()
+    meta = (now, rule.get('rule_id'), _query_qname(query if query is not None else query_packet).lower())
+    # Both records go out as one write so the pair is never split by a dropped record
+    _enqueue('pcap', _pcap_record(query_packet, now) + _pcap_record(response_packet, now), meta)
     
-    print(f"[*] Appended query and response to {pcap_filepath}")
+    if packet_debug:
+        console.debug("Queued query and response for session %s", current_task_id)
 
-def get_log_sessions():
+def _new_session_entry(task_id, started):
+    return {'task_id': task_id, 'started': started, 'ended': None,
+            'triggered': 0, 'packets': 0, 'log_bytes': 0, 'pcap_bytes': 0, 'error': None}
+
+def _index_path():
+    return os.path.join(LOGS_DIR, SESSION_INDEX_FILE)
+
+def _load_session_index():
     """
-    Lists all available log session directories.
+    Returns the in-memory session index, loading or rebuilding it on first use.
+    Callers hold index_lock.
+    """
+    global session_index
+    if session_index is None:
+        try:
+            with open(_index_path(), 'r') as f:
+                session_index = json.load(f)
+        except (OSError, ValueError):
+            session_index = _scan_sessions()
+            if session_index:
+                _save_session_index()
+    return session_index
+
+def _save_session_index():
     """
+    Writes the index to a temporary file and renames it over sessions.json.
+    Callers hold index_lock.
+    """
+    if session_index is None:
+        return
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    temp_path = _index_path() + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(session_index, f)
+    os.replace(temp_path, _index_path())
+
+def _count_lines(path):
+    count = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            count += chunk.count(b'\n')
+    return count
+
+def _count_pcap_records(pcap_path):
+    count = 0
+    with _open_segment(pcap_path) as f:
+        f.seek(len(PCAP_GLOBAL_HEADER))
+        while True:
+            header = f.read(_pcap_record_header.size)
+            if len(header) < _pcap_record_header.size:
+                return count
+            count += 1
+            f.seek(_pcap_record_header.unpack(header)[2], os.SEEK_CUR)
+
+def _scan_sessions():
+    """
+    Rebuilds the index from the session directories. Only needed once, when
+    sessions.json is missing (e.g. logs written by an older version).
+    """
+    index = {}
     if not os.path.exists(LOGS_DIR):
-        return []
-    return [d for d in os.listdir(LOGS_DIR) if os.path.isdir(os.path.join(LOGS_DIR, d))]
+        return index
+    for task_id in os.listdir(LOGS_DIR):
+        task_dir = os.path.join(LOGS_DIR, task_id)
+        if not os.path.isdir(task_dir):
+            continue
+        try:
+            started = datetime.datetime.strptime(task_id, "%Y%m%d%H%M%S").isoformat(timespec='seconds')
+        except ValueError:
+            started = None
+        entry = _new_session_entry(task_id, started)
+        log_path = os.path.join(task_dir, "task.log")
+        if os.path.exists(log_path):
+            entry['log_bytes'] = os.path.getsize(log_path)
+            entry['triggered'] = _count_lines(log_path)
+        for name in list_capture_segments(task_dir):
+            pcap_path = os.path.join(task_dir, name)
+            entry['pcap_bytes'] += os.path.getsize(pcap_path)
+            entry['packets'] += _count_pcap_records(pcap_path[:-3] if pcap_path.endswith(".gz") else pcap_path)
+        entry['ended'] = datetime.datetime.fromtimestamp(os.path.getmtime(task_dir)).isoformat(timespec='seconds')
+        index[task_id] = entry
+    return index
 
-def get_log_details(task_id):
+def get_log_sessions():
     """
-    Gets the log entries and pcap files for a specific task_id.
+    Lists the metadata of all log sessions from the session index.
     """
+    with index_lock:
+        return [dict(entry) for entry in _load_session_index().values()]
+
+def _task_dir(task_id):
+    """
+    Returns the directory of an existing session, or None. Task IDs are plain
+    timestamps, so anything else (e.g. '..') is rejected.
+    """
+    if not task_id.isalnum():
+        return None
     task_dir = os.path.join(LOGS_DIR, task_id)
-    if not os.path.isdir(task_dir):
+    return task_dir if os.path.isdir(task_dir) else None
+
+def delete_log_session(task_id):
+    """
+    Deletes a session's directory and its index entry.
+    :return: False if there is no such session.
+    """
+    task_dir = _task_dir(task_id)
+    if task_dir is None:
+        return False
+    shutil.rmtree(task_dir)
+    with index_lock:
+        if _load_session_index().pop(task_id, None) is not None:
+            _save_session_index()
+    return True
+
+def read_task_log(task_id, offset=None, length=LOG_TAIL_BYTES, end=None):
+    """
+    Reads part of a session's task.log without loading the whole file:
+    - with 'offset': up to 'length' bytes from there, cut after the last complete line
+    - otherwise: up to 'length' bytes ending at 'end' (default: end of file),
+      starting at the first complete line
+    :return: dict with 'content', 'offset' (where content starts), 'next_offset'
+             (where to continue reading) and 'size', or None if the session does not exist.
+    """
+    task_dir = _task_dir(task_id)
+    if task_dir is None:
         return None
-    
-    log_content = ""
-    log_file = os.path.join(task_dir, "task.log")
-    if os.path.exists(log_file):
-        with open(log_file, 'r') as f:
-            log_content = f.read()
-            
-    pcap_files = [f for f in os.listdir(task_dir) if f.endswith(".pcap")]
-    
-    return {"log_content": log_content, "pcap_files": pcap_files}
+    log_path = os.path.join(task_dir, "task.log")
+    length = max(0, min(length, LOG_TAIL_BYTES))
+    if not os.path.exists(log_path):
+        return {'content': '', 'offset': 0, 'next_offset': 0, 'size': 0}
+
+    with open(log_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset is None:
+            stop = size if end is None else min(max(0, end), size)
+            start = max(0, stop - length)
+        else:
+            start = min(max(0, offset), size)
+            stop = min(size, start + length)
+        f.seek(start)
+        data = f.read(stop - start)
+
+    if offset is None and start > 0:
+        cut = data.find(b'\n') + 1
+        start += cut
+        data = data[cut:]
+    elif offset is not None and stop < size and b'\n' in data:
+        data = data[:data.rfind(b'\n') + 1]
+    return {'content': data.decode(errors='replace'), 'offset': start,
+            'next_offset': start + len(data), 'size': size}
+
+def _qname_filter(pattern):
+    """
+    Returns a predicate for an exact qname or a '*.suffix' wildcard.
+    """
+    pattern = pattern.rstrip('.').lower()
+    if pattern.startswith('*.'):
+        return lambda qname: qname.endswith(pattern[1:])
+    return lambda qname: qname == pattern
+
+def iter_filtered_pcap(task_id, rule_id=None, qname=None, start=None, end=None):
+    """
+    Streams a pcap holding only the query/response pairs of a session that match
+    all given filters (rule_id, qname or '*.suffix', [start, end] epoch seconds).
+    Matching records are located through each segment's .idx file and copied from
+    the segment by offset, so the capture is never parsed or loaded as a whole.
+    :return: a generator of bytes, or None if the session or its index does not exist.
+    """
+    task_dir = _task_dir(task_id)
+    if task_dir is None:
+        return None
+    index_names = sorted(f for f in os.listdir(task_dir) if f.startswith("capture") and f.endswith(PCAP_INDEX_SUFFIX))
+    if not index_names:
+        return None
+    qname_matches = _qname_filter(qname) if qname else None
+
+    def matching_ranges(index_file):
+        """
+        Yields (offset, length) of matching pairs, merging adjacent ones.
+        """
+        pending = None
+        for line in index_file:
+            try:
+                offset, length, timestamp, entry_rule_id, entry_qname = json.loads(line)
+            except ValueError:
+                break  # A line cut short by a live writer; the rest is not flushed yet
+            if ((rule_id is not None and entry_rule_id != rule_id)
+                    or (qname_matches and not qname_matches(entry_qname))
+                    or (start is not None and timestamp < start)
+                    or (end is not None and timestamp > end)):
+                continue
+            if pending and pending[0] + pending[1] == offset:
+                pending[1] += length
+            else:
+                if pending:
+                    yield pending
+                pending = [offset, length]
+        if pending:
+            yield pending
+
+    def generate():
+        yield PCAP_GLOBAL_HEADER
+        for index_name in index_names:
+            index_path = os.path.join(task_dir, index_name)
+            pcap_path = index_path[:-len(PCAP_INDEX_SUFFIX)] + ".pcap"
+            try:
+                pcap_file = _open_segment(pcap_path)
+            except FileNotFoundError:
+                continue  # Removed by retention meanwhile
+            with pcap_file, open(index_path, 'r') as index_file:
+                # Offsets only grow, so gzipped segments are decompressed in one forward pass
+                for offset, length in matching_ranges(index_file):
+                    pcap_file.seek(offset)
+                    while length > 0:
+                        chunk = pcap_file.read(min(length, PCAP_STREAM_CHUNK))
+                        if not chunk:
+                            break
+                        length -= len(chunk)
+                        yield chunk
+
+    return generate()
+
+def get_log_details(task_id):
+    """
+    Gets the tail of the log and the capture segments for a specific task_id.
+    """
+    task_dir = _task_dir(task_id)
+    if task_dir is None:
+        return None
+
+    log = read_task_log(task_id)
+    pcap_files = list_capture_segments(task_dir)
+    with index_lock:
+        session = dict(_load_session_index().get(task_id) or {})
+
+    return {"log_content": log['content'], "log_offset": log['offset'], "log_size": log['size'],
+            "pcap_files": pcap_files, "session": session}
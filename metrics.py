@@ -0,0 +1,156 @@
+import bisect
+import threading
+import time
+
+# --- Globals ---
+# Hot-path counters are kept per thread (a plain dict and bucket list reached
+# through a threading.local), so incrementing them takes no lock. Readers sum the
+# per-thread tallies when /api/metrics is scraped.
+METRIC_PREFIX = "janusdns"
+# Upper bounds (seconds) of the capture-to-send latency histogram buckets.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+COUNTERS = {
+    'packets_captured': "Packets handed to the responder by the capture engine",
+    'packets_filtered': "Captured packets discarded before matching (not a DNS query to a local address)",
+    'queries_unmatched': "DNS queries that matched no rule",
+    'responses_sent': "Responses sent",
+    'send_errors': "Responses that could not be sent",
+    'responses_suppressed_client': "Matched queries not answered normally because their source exceeded its rate",
+    'responses_suppressed_rule': "Matched queries not answered normally because their rule exceeded its rate",
+    'responses_slipped': "Rate-limited queries answered with a truncated reply instead of being dropped",
+}
+
+_local = threading.local()
+_thread_tallies = []  # one ThreadTally per thread that has recorded something
+_registry_lock = threading.Lock()
+# Snapshots reported by responder processes (fanout mode), by worker id, and the
+# totals of workers that have exited, so the exported counters never go backwards.
+_remote_snapshots = {}
+_retired = None
+
+class ThreadTally:
+    """
+    One thread's counters. Only the owning thread writes to it.
+    """
+    __slots__ = ('counters', 'rule_matches', 'latency_buckets', 'latency_sum')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.rule_matches = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # The last one is +Inf
+        self.latency_sum = 0.0
+
+def _tally():
+    try:
+        return _local.tally
+    except AttributeError:
+        tally = _local.tally = ThreadTally()
+        with _registry_lock:
+            _thread_tallies.append(tally)
+        return tally
+
+def inc(name, amount=1):
+    """
+    Increments one of the COUNTERS for the calling thread.
+    """
+    _tally().counters[name] += amount
+
+def rule_matched(rule_id):
+    matches = _tally().rule_matches
+    matches[rule_id] = matches.get(rule_id, 0) + 1
+
+def observe_latency(captured_at):
+    """
+    Records the time from capture (a Unix timestamp, e.g. packet.time) until now.
+    """
+    if captured_at is None:
+        return
+    latency = max(time.time() - float(captured_at), 0.0)
+    tally = _tally()
+    tally.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+    tally.latency_sum += latency
+
+def _add(total, counters, rule_matches, buckets, latency_sum):
+    for name, value in counters.items():
+        total[0][name] = total[0].get(name, 0) + value
+    for rule_id, value in list(rule_matches.items()):
+        total[1][rule_id] = total[1].get(rule_id, 0) + value
+    for i, value in enumerate(buckets):
+        total[2][i] += value
+    total[3] += latency_sum
+
+def _empty():
+    return [dict.fromkeys(COUNTERS, 0), {}, [0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+
+def snapshot():
+    """
+    Sums the per-thread tallies, and those reported by responder processes.
+    Values may be a few increments behind the writers, which is fine for monitoring.
+    :return: (counters, rule_matches, latency buckets, latency sum)
+    """
+    with _registry_lock:
+        tallies = list(_thread_tallies)
+        remote = list(_remote_snapshots.values())
+        if _retired is not None:
+            remote.append(_retired)
+    total = _empty()
+    for tally in tallies:
+        _add(total, tally.counters, tally.rule_matches, tally.latency_buckets, tally.latency_sum)
+    for remote_snapshot in remote:
+        _add(total, *remote_snapshot)
+    return tuple(total)
+
+def set_remote(worker_id, worker_snapshot):
+    """
+    Stores the latest snapshot() of a responder process.
+    """
+    with _registry_lock:
+        _remote_snapshots[worker_id] = worker_snapshot
+
+def retire_remote():
+    """
+    Folds the snapshots of responder processes that have exited into the retired totals.
+    """
+    global _retired
+    with _registry_lock:
+        total = _empty() if _retired is None else [dict(_retired[0]), dict(_retired[1]), list(_retired[2]), _retired[3]]
+        for remote_snapshot in _remote_snapshots.values():
+            _add(total, *remote_snapshot)
+        _remote_snapshots.clear()
+        _retired = tuple(total)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus(totals=None, gauges=None):
+    """
+    Renders all counters, the latency histogram, and the given totals (counters
+    kept elsewhere) and gauges, both {name: (help, value)}, in the Prometheus text
+    exposition format.
+    """
+    counters, rule_matches, buckets, latency_sum = snapshot()
+    lines = []
+    for name, help_text in COUNTERS.items():
+        metric = f"{METRIC_PREFIX}_{name}_total"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter", f"{metric} {counters[name]}"]
+
+    metric = f"{METRIC_PREFIX}_rule_matches_total"
+    lines += [f"# HELP {metric} Queries matched, per rule", f"# TYPE {metric} counter"]
+    for rule_id, value in sorted(rule_matches.items(), key=lambda item: str(item[0])):
+        lines.append(f'{metric}{{rule_id="{_escape_label(rule_id)}"}} {value}')
+
+    metric = f"{METRIC_PREFIX}_response_latency_seconds"
+    lines += [f"# HELP {metric} Time from packet capture until the response was sent",
+              f"# TYPE {metric} histogram"]
+    cumulative = 0
+    for bound, value in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+        cumulative += value
+        lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+    lines += [f"{metric}_sum {latency_sum}", f"{metric}_count {cumulative}"]
+
+    for kind, metrics in (('counter', totals), ('gauge', gauges)):
+        for name, (help_text, value) in (metrics or {}).items():
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
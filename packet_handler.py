@@ -1,25 +1,116 @@
 import threading
+from collections import namedtuple
 # 从 scapy.all 导入 get_if_addr
-from scapy.all import sniff, IP, UDP, Ether, get_if_addr, get_if_hwaddr, sendp
-# 核心修正：移除对不存在的类的导入，只导入通用的 DNSRR
-from scapy.layers.dns import DNS, DNSQR, DNSRR
+from scapy.all import AsyncSniffer, conf, IP, IPv6, UDP, Ether, Raw, get_if_addr, get_if_hwaddr, sendp
+from scapy.all import in6_getifaddr
+from scapy.layers.l2 import Dot1Q
+from scapy.layers.dns import DNS
+import errno
+import ipaddress
+import queue
+import random
+import select
 import socket
+import struct
+import time
 import rules_manager
 import log_manager
+import fanout
+import metrics
+import rate_limiter
+import response_template
+import dns_encoder
+import dns_parser
 # 核心改动：从 scapy.arch 导入 get_if_list，用于获取接口名称
 from scapy.arch import get_if_list
 
+# Scapy is loaded now; let the modules that avoid importing it match and log dissected packets
+rules_manager.bind_scapy_layers()
+log_manager.bind_scapy_layers()
+
 # --- Globals ---
 stop_sniffing = threading.Event()
+STOP_TIMEOUT = 5  # seconds callers wait for start_sniffing() to return once stop_sniffing is set
 active_interfaces = []
+# Capture engine used by start_sniffing(): 'scapy' (AsyncSniffer + full dissection, the
+# reference path) or 'raw' (AF_PACKET sockets + dns_parser, no Scapy per packet).
+CAPTURE_ENGINES = ('scapy', 'raw')
+capture_engine = 'scapy'
+ETH_P_ALL = 0x0003  # IPv4 and IPv6; the capture filter narrows it down in the kernel
+RAW_RECV_BUFFER = 65535
+# The kernel strips the outer VLAN tag of received frames and reports it in the
+# PACKET_AUXDATA control message; the raw engine puts it back into the frame.
+PACKET_AUXDATA = 8
+TP_STATUS_VLAN_VALID = 1 << 4
+TP_STATUS_VLAN_TPID_VALID = 1 << 6
+ETH_P_8021Q = 0x8100
+_auxdata = struct.Struct('=IIIHHHH')  # struct tpacket_auxdata
+AUXDATA_BUFFER = socket.CMSG_SPACE(_auxdata.size) if hasattr(socket, 'CMSG_SPACE') else 0
+# Kernel capture statistics (Linux PACKET_STATISTICS), accumulated from the
+# capture sockets every STATS_POLL_INTERVAL seconds while sniffing.
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+PACKET_FANOUT = 18
+PACKET_FANOUT_HASH = 0  # Spread by flow hash, so a client's flow stays on one socket
+# Has the kernel pick a group id no other group uses (Linux 4.5+); older kernels
+# get a random id instead.
+PACKET_FANOUT_FLAG_UNIQUEID = 0x2000
+STATS_POLL_INTERVAL = 1  # seconds
+capture_stats = {'packets': 0, 'drops': 0}
+# Optional processing pipeline: the capture thread only enqueues packets and a pool
+# of PIPELINE_WORKERS threads matches and answers them; logging is handed on to
+# log_manager's writer thread. 0 workers keeps everything inline in the capture
+# thread. The queue is bounded; when full, packets are dropped (and counted)
+# instead of blocking capture.
+PIPELINE_WORKERS = 0
+PIPELINE_QUEUE_SIZE = 10000
+work_queue = None
+pipeline_threads = []
+pipeline_stats = {'capture_drops': 0}
+# Long-lived send sockets, one per active interface (iface name -> socket), shared
+# by all pipeline workers. The Scapy engine opens L2 sockets in start_sniffing();
+# the raw engine reuses its capture sockets. Both are closed when the sniffer stops.
+send_sockets = {}
+# Responses can be queued and flushed together: SEND_BATCH_SIZE > 1 enables it,
+# and a queued response waits at most SEND_BATCH_TIMEOUT seconds.
+SEND_BATCH_SIZE = 1
+SEND_BATCH_TIMEOUT = 0.005
+send_queue = []
+send_lock = threading.Lock()
+# Interface address cache, built by get_active_interfaces() and refreshed in the
+# background while sniffing so address changes are still picked up.
+# 'ip6' is the address used for 'auto' fields of IPv6 responses (global scope
+# preferred), 'ips6' all IPv6 addresses of the interface.
+InterfaceAddress = namedtuple('InterfaceAddress', ['mac', 'ip', 'packed_mac', 'packed_ip',
+                                                   'ip6', 'packed_ip6', 'ips6'])
+INTERFACE_REFRESH_INTERVAL = 5  # seconds
+IPV6_SCOPE_GLOBAL = 0  # Scope value in6_getifaddr() reports for global addresses
+interface_addresses = {}  # iface name -> InterfaceAddress
+local_ips = frozenset()   # local IPv4/IPv6 addresses used for O(1) destination filtering
+local_ips_packed = frozenset()  # the same, packed, for the raw engine
+# Kernel-side capture filter, regenerated whenever the rule index or the local
+# addresses change. The Python-side checks stay in place, so an unfiltered
+# capture (e.g. when libpcap cannot compile the filter) is still correct.
+BASE_CAPTURE_FILTER = "udp dst port 53"
+# The expression is repeated for untagged, single- and double-tagged frames, so
+# alternations are kept small enough for the BPF program size limit.
+MAX_FILTER_VALUES = 24
+capture_filter = BASE_CAPTURE_FILTER
+capture_filter_source = (None, None)  # (rule snapshot, local_ips) the filter was built from
+# Compiled responses: id(rule) -> (rule, template, encoded records). Dropped whenever
+# rules_manager activates a new rule snapshot, so edited rules are recompiled on next use.
+# The encoded records (dns_encoder) are shared by the template and the Scapy path.
+response_templates = {}
+response_templates_index = None
+# Truncated variants of rules, sent instead of dropping when rate limiting slips:
+# id(rule) -> (rule, variant). Cleared together with response_templates.
+slip_rules = {}
 
 def get_active_interfaces():
     """
     Gets a list of active non-loopback interface names for Scapy to sniff on.
     此函数已被重构，以返回 Scapy 需要的接口名称，而不是 IP 地址。
     """
-    global active_interfaces
-    
     # 清空旧列表
     active_interfaces.clear()
     
@@ -42,45 +133,457 @@ def get_active_interfaces():
 
     # 如果没有找到合适的接口（例如只剩下环回），则给出警告
     if not active_interfaces:
-        print("[!] Warning: Could not find any active non-loopback interfaces. Sniffing might fail.")
+        log_manager.console.warning("Could not find any active non-loopback interfaces. Sniffing might fail.")
         # 在某些情况下，可以让 Scapy 自动选择，但这可能不符合预期
         # return []
     
-    print(f"[*] Active interfaces found for sniffing: {active_interfaces}")
+    log_manager.console.info("Active interfaces found for sniffing: %s", active_interfaces)
+    refresh_interface_addresses()
     return active_interfaces
 
-def process_packet(packet):
+def resolve_interface_address(iface, ipv6_addresses=None):
     """
-    Callback function to process each sniffed packet.
+    Queries the MAC, IPv4 and IPv6 addresses of an interface (ioctl calls and
+    /proc reads, keep off the hot path). ipv6_addresses is the output of
+    in6_getifaddr(), passed in when resolving several interfaces at once.
+    """
+    mac = get_if_hwaddr(iface)
+    ip = get_if_addr(iface)
+    if ipv6_addresses is None:
+        ipv6_addresses = in6_getifaddr()
+    # Global addresses sort first; normalized to the form Scapy and dns_parser report
+    ips6 = tuple(
+        dns_parser.ip_to_text(socket.inet_pton(socket.AF_INET6, address))
+        for address, scope, name in sorted(ipv6_addresses, key=lambda entry: entry[1] != IPV6_SCOPE_GLOBAL)
+        if name == iface
+    )
+    ip6 = ips6[0] if ips6 else None
+    return InterfaceAddress(mac, ip, response_template.mac2str(mac), socket.inet_aton(ip),
+                            ip6, ip6 and socket.inet_pton(socket.AF_INET6, ip6), ips6)
+
+def set_local_ips(ips):
+    """
+    Replaces the set of local addresses queries must be sent to (strings, IPv4 or IPv6).
+    """
+    global local_ips, local_ips_packed
+    local_ips = frozenset(ips)
+    local_ips_packed = frozenset(response_template.pack_ip(ip) for ip in local_ips)
+
+def refresh_interface_addresses():
+    """
+    Rebuilds the interface address cache and the local IP set for active_interfaces.
+    The new containers are swapped in whole, so readers never see a partial update.
+    """
+    global interface_addresses
+    addresses = {}
+    try:
+        ipv6_addresses = in6_getifaddr()
+    except OSError:
+        ipv6_addresses = []
+    for iface in active_interfaces:
+        try:
+            addresses[iface] = resolve_interface_address(iface, ipv6_addresses)
+        except (OSError, ValueError) as e:
+            log_manager.console.warning("Could not read addresses of interface %s: %s", iface, e)
+
+    ips = frozenset(
+        address.ip for address in addresses.values()
+        if address.ip and address.ip != "0.0.0.0" and not address.ip.startswith("127.")
+    ) | frozenset(ip6 for address in addresses.values() for ip6 in address.ips6 if ip6 != "::1")
+    interface_addresses = addresses
+    if ips != local_ips: # Unchanged addresses keep the same set, so the capture filter stays as it is
+        log_manager.console.info("Active IPs for filtering: %s", sorted(ips))
+        set_local_ips(ips)
+
+def get_interface_address(iface):
+    """
+    Returns the cached InterfaceAddress of an interface, resolving it on a cache miss.
+    """
+    address = interface_addresses.get(iface)
+    if address is None:
+        address = resolve_interface_address(iface)
+        interface_addresses[iface] = address
+    return address
+
+def refresh_interface_addresses_periodically():
+    """
+    Refreshes the interface address cache every INTERFACE_REFRESH_INTERVAL seconds until sniffing stops.
+    """
+    while not stop_sniffing.wait(INTERFACE_REFRESH_INTERVAL):
+        refresh_interface_addresses()
+
+def _bpf_alternatives(primitive, values):
+    """
+    Renders e.g. "(src host 10.0.0.1 or src host 10.0.0.2)".
+    """
+    return "(" + " or ".join(f"{primitive} {value}" for value in values) + ")"
+
+def _shared_rule_values(rules, layer, field, render):
+    """
+    Collects a trigger condition field across rules, rendered as BPF primitives.
+    Returns None unless every rule constrains it with a valid value, since one
+    unconstrained rule accepts anything.
+    """
+    values = set()
+    for rule in rules:
+        value = rule.get("trigger_condition", {}).get(layer, {}).get(field)
+        if value is None:
+            return None
+        try:
+            values.add(render(value))
+        except (OSError, ValueError, TypeError):
+            return None
+    if not values or len(values) > MAX_FILTER_VALUES:
+        return None
+    return sorted(values)
+
+def _render_ip(direction):
+    def render(value):
+        first, last = rules_manager.parse_ip_range(value)
+        if first == last:
+            return f"{direction} host {value}"
+        return f"{direction} net {ipaddress.ip_network(value, strict=False)}"
+    return render
+
+def _render_port(direction):
+    def render(value):
+        first, last = rules_manager.parse_port_range(value)
+        if first == last:
+            return f"{direction} port {first}"
+        return f"{direction} portrange {first}-{last}"
+    return render
+
+def build_capture_filter():
+    """
+    Builds the BPF expression for the capture: UDP queries to one of our own
+    addresses, narrowed by L3/L4 conditions that all enabled rules share, for
+    untagged frames and frames with one or two VLAN tags.
+    """
+    clauses = [BASE_CAPTURE_FILTER]
+    if local_ips:
+        clauses.append(_bpf_alternatives("dst host", sorted(local_ips)))
+
+    rules = rules_manager.snapshot.active
+    if rules:
+        for layer, field, render in (
+            ('l3', 'src_ip', _render_ip('src')),
+            ('l3', 'dst_ip', _render_ip('dst')),
+            ('l4', 'src_port', _render_port('src')),
+            ('l4', 'dst_port', _render_port('dst')),
+        ):
+            primitives = _shared_rule_values(rules, layer, field, render)
+            if primitives:
+                clauses.append("(" + " or ".join(primitives) + ")")
+    expression = " and ".join(clauses)
+    # Each 'vlan' shifts the offsets of everything after it, hence the nesting
+    return f"({expression}) or (vlan and (({expression}) or (vlan and {expression})))"
+
+def refresh_capture_filter(raw_sockets=()):
+    """
+    Regenerates the capture filter if the rules or local addresses changed since
+    it was last built, attaching it to the given raw sockets.
+    :return: True if a new filter was built.
+    """
+    global capture_filter, capture_filter_source
+    ruleset, ips = capture_filter_source
+    if ruleset is rules_manager.snapshot and ips == local_ips:
+        return False
+
+    capture_filter_source = (rules_manager.snapshot, local_ips)
+    capture_filter = build_capture_filter()
+    log_manager.console.info("Capture filter: %s", capture_filter)
+    if raw_sockets:
+        from scapy.arch.linux import attach_filter # The raw engine is Linux-only
+    for sock, iface in raw_sockets:
+        try:
+            attach_filter(sock, capture_filter, iface)
+        except (OSError, ImportError) as e:
+            log_manager.console.warning("Could not attach capture filter on %s, filtering in Python only: %s",
+                                        iface, e)
+    return True
+
+def poll_kernel_stats(sockets):
+    """
+    Adds the kernel's per-socket packet and drop counters to capture_stats.
+    The kernel resets them on every read, so each call only sees new events.
+    """
+    for sock in sockets:
+        try:
+            raw_stats = getattr(sock, 'ins', sock).getsockopt(SOL_PACKET, PACKET_STATISTICS, 8)
+        except (OSError, AttributeError):
+            continue # Not an AF_PACKET socket (non-Linux capture)
+        packets, drops = struct.unpack('II', raw_stats)
+        capture_stats['packets'] += packets
+        capture_stats['drops'] += drops
+        if drops:
+            log_manager.console.warning("Kernel dropped %d packets on the capture socket.", drops)
+
+def respond_to_packet(packet):
+    """
+    Filters, matches and answers a dissected Scapy packet without sending anything.
+    :return: (matched_rule, response_frame) or None if the packet is not answered.
     """
-    print("[*] Packet captured, processing...")
     # Step 1: Filter by destination IP
-    # --- 修复：使用 Scapy 从已激活的接口直接获取 IP 地址，替代不可靠的 hostname 解析 ---
-    # 我们遍历 `active_interfaces` 列表，并使用 `get_if_addr` 获取每个接口的 IP
-    active_ips = [get_if_addr(iface) for iface in active_interfaces]
-    # 清理掉可能为空或环回地址的结果
-    active_ips = [ip for ip in active_ips if ip and not ip.startswith("127.")]
-    
-    print(f"[*] Active IPs for filtering: {active_ips}")
-    if not IP in packet or packet[IP].dst not in active_ips:
-        return
+    # local_ips 由 get_active_interfaces() 构建并定期刷新，避免每个包都调用 get_if_addr
+    ip_layer = packet.getlayer(IP)
+    if ip_layer is None:
+        ip_layer = packet.getlayer(IPv6)
+    if ip_layer is None or ip_layer.dst not in local_ips:
+        metrics.inc('packets_filtered')
+        return None
 
     # Step 2: Check for valid DNS Query
     if not (packet.haslayer(DNS) and packet[DNS].qr == 0): # qr=0 means query
-        return
+        metrics.inc('packets_filtered')
+        return None
         
-    print(f"[*] DNS Query captured for: {packet[DNS].qd.qname.decode()}")
+    if log_manager.packet_debug:
+        log_manager.console.debug("DNS Query captured for: %s", packet[DNS].qd.qname.decode())
     
     matched_rule = rules_manager.find_matching_rule(packet)
-    if matched_rule:
-        print(f"[*] Rule '{matched_rule.get('name')}' matched. Generating response...")
-        response_packet = generate_response(packet, matched_rule)
-        if response_packet:
-            sendp(response_packet, verbose=0)
-            print(f"[*] Response sent for {packet[DNS].qd.qname.decode()}")
-            # Log the event
-            log_manager.log_triggered_rule(matched_rule, packet)
-            log_manager.save_pcap_files(matched_rule, packet, response_packet)
+    if not matched_rule:
+        metrics.inc('queries_unmatched')
+        return None
+    metrics.rule_matched(matched_rule.get('rule_id'))
+    if rate_limiter.enabled:
+        matched_rule = limit_response(ip_layer.src, matched_rule)
+        if matched_rule is None:
+            return None
+    if log_manager.packet_debug:
+        log_manager.console.debug("Rule '%s' matched. Generating response...", matched_rule.get('name'))
+    response_packet = generate_response(packet, matched_rule)
+    if not response_packet:
+        return None
+    return matched_rule, response_packet
+
+def respond_to_frame(frame, iface, timestamp=None):
+    """
+    Raw-engine counterpart of respond_to_packet(): parses the frame with dns_parser
+    instead of Scapy. :return: (query, matched_rule, response_frame) or None.
+    """
+    query = dns_parser.parse_frame(frame)
+    if query is None or query.qr or query.ip_dst not in local_ips_packed:
+        metrics.inc('packets_filtered')
+        return None
+    query.sniffed_on = iface
+    query.time = timestamp
+
+    matched_rule = rules_manager.find_matching_rule(query)
+    if not matched_rule:
+        metrics.inc('queries_unmatched')
+        return None
+    metrics.rule_matched(matched_rule.get('rule_id'))
+    if rate_limiter.enabled:
+        matched_rule = limit_response(query.ip_src, matched_rule)
+        if matched_rule is None:
+            return None
+    response_packet = generate_response(query, matched_rule)
+    if not response_packet:
+        return None
+    return query, matched_rule, response_packet
+
+def limit_response(client, rule):
+    """
+    Applies the per-client and per-rule rate limits to a matched query.
+    :return: The rule to answer with (the matched rule, or its truncated variant
+             when the limiter slips), or None if the response is suppressed.
+    """
+    limit, verdict = rate_limiter.check(client, rule.get('rule_id'))
+    if verdict == rate_limiter.ALLOW:
+        return rule
+    metrics.inc('responses_suppressed_' + limit)
+    if verdict == rate_limiter.SLIPPED:
+        metrics.inc('responses_slipped')
+        return get_slip_rule(rule)
+    return None
+
+def get_slip_rule(rule):
+    """
+    Returns a variant of the rule that answers with TC=1 and empty record
+    sections, addressed exactly like the rule's normal response.
+    """
+    entry = slip_rules.get(id(rule))
+    if entry is None or entry[0] is not rule:
+        action = rule.get('response_action', {})
+        header = action.get('dns_header', {})
+        flags = dict(header.get('flags', {}), tc={'value': 1}, rcode={'value': 0})
+        slip_action = dict(action, dns_header=dict(header, flags=flags),
+                           dns_answers=[], dns_authority=[], dns_additional=[])
+        entry = (rule, dict(rule, response_action=slip_action))
+        slip_rules[id(rule)] = entry
+    return entry[1]
+
+def process_packet(packet):
+    """
+    Callback function to process each sniffed packet.
+    """
+    if log_manager.packet_debug:
+        log_manager.console.debug("Packet captured, processing...")
+    metrics.inc('packets_captured')
+    result = respond_to_packet(packet)
+    if result:
+        matched_rule, response_packet = result
+        send_response(packet.sniffed_on, response_packet, packet.time)
+        if log_manager.packet_debug:
+            log_manager.console.debug("Response sent for %s", packet[DNS].qd.qname.decode())
+        # Log the event
+        log_exchange(matched_rule, packet, packet, response_packet)
+
+def process_frame(frame, iface, timestamp=None):
+    """
+    Raw-engine callback: answers a captured frame on the interface it arrived on.
+    """
+    metrics.inc('packets_captured')
+    result = respond_to_frame(frame, iface, timestamp)
+    if result:
+        query, matched_rule, response_packet = result
+        send_response(iface, response_packet, timestamp)
+        if log_manager.packet_debug:
+            log_manager.console.debug("Response sent for %s", query.qname.decode(errors='replace'))
+        log_exchange(matched_rule, query, frame, response_packet)
+
+def dispatch(handler, *args):
+    """
+    Capture-stage entry point: runs the handler inline, or hands it to the
+    worker pool when the pipeline is running.
+    """
+    if work_queue is None:
+        handler(*args)
+        return
+    try:
+        work_queue.put_nowait((handler, args))
+    except queue.Full:
+        pipeline_stats['capture_drops'] += 1
+
+def capture_packet(packet):
+    """
+    prn callback of the Scapy engine.
+    """
+    dispatch(process_packet, packet)
+
+def log_exchange(rule, query, query_packet, response_packet):
+    """
+    Records a triggered rule and its query/response pair. log_manager only queues
+    them for its background writer, so this never blocks on disk I/O.
+    """
+    log_manager.log_triggered_rule(rule, query)
+    log_manager.save_pcap_files(rule, query_packet, response_packet, query)
+
+def pipeline_worker():
+    """
+    Matcher/responder worker: processes captured packets until it gets a None sentinel.
+    """
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        handler, args = item
+        try:
+            handler(*args)
+        except Exception as e:
+            log_manager.console.warning("Worker failed to process packet: %s", e)
+
+def start_pipeline():
+    """
+    Starts the worker pool if PIPELINE_WORKERS > 0.
+    """
+    global work_queue
+    pipeline_stats.update(capture_drops=0)
+    if PIPELINE_WORKERS <= 0:
+        return
+    work_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    for i in range(PIPELINE_WORKERS):
+        pipeline_threads.append(threading.Thread(target=pipeline_worker, name=f"responder-{i}", daemon=True))
+    for thread in pipeline_threads:
+        thread.start()
+    log_manager.console.info("Pipeline started with %s workers.", PIPELINE_WORKERS)
+
+def stop_pipeline():
+    """
+    Lets the workers drain the queue, then stops them.
+    """
+    global work_queue
+    if work_queue is None:
+        return
+    for _ in pipeline_threads:
+        work_queue.put(None)
+    for thread in pipeline_threads:
+        thread.join()
+    pipeline_threads.clear()
+    work_queue = None
+    log_manager.console.info("Pipeline stopped. Dropped %s packets on a full queue.", pipeline_stats['capture_drops'])
+
+def send_response(iface, frame, captured_at=None):
+    """
+    Sends a response frame on the interface's persistent socket, or queues it
+    when batching is enabled. Falls back to sendp() for unknown interfaces.
+    captured_at is the query's capture timestamp, used for the latency histogram.
+    """
+    sock = send_sockets.get(iface)
+    if sock is None or SEND_BATCH_SIZE <= 1:
+        try:
+            if sock is None:
+                sendp(Raw(frame), iface=iface, verbose=0)
+            else:
+                sock.send(frame)
+        except (OSError, ValueError) as e:
+            metrics.inc('send_errors')
+            log_manager.console.warning("Failed to send response: %s", e)
+            return
+        metrics.inc('responses_sent')
+        metrics.observe_latency(captured_at)
+        return
+
+    with send_lock:
+        send_queue.append((sock, frame, captured_at))
+        if len(send_queue) < SEND_BATCH_SIZE:
+            return
+    flush_send_queue()
+
+def flush_send_queue():
+    """
+    Sends all queued responses back-to-back.
+    """
+    with send_lock:
+        if not send_queue:
+            return
+        batch = send_queue[:]
+        send_queue.clear()
+    for sock, frame, captured_at in batch:
+        try:
+            sock.send(frame)
+        except OSError as e:
+            metrics.inc('send_errors')
+            log_manager.console.warning("Failed to send queued response: %s", e)
+            continue
+        metrics.inc('responses_sent')
+        metrics.observe_latency(captured_at)
+
+def flush_send_queue_periodically():
+    """
+    Bounds the wait of a partially filled batch to SEND_BATCH_TIMEOUT seconds.
+    """
+    while not stop_sniffing.wait(SEND_BATCH_TIMEOUT):
+        flush_send_queue()
+
+def open_send_sockets(interfaces):
+    """
+    Opens one long-lived Scapy L2 socket per interface for sending responses.
+    """
+    for iface in interfaces:
+        try:
+            send_sockets[iface] = conf.L2socket(iface=iface)
+        except OSError as e:
+            log_manager.console.warning("Could not open send socket on %s: %s", iface, e)
+
+def close_send_sockets():
+    """
+    Flushes pending responses and closes all send sockets.
+    """
+    flush_send_queue()
+    for sock in send_sockets.values():
+        sock.close()
+    send_sockets.clear()
 
 def get_response_value(config, query_value, auto_value=None):
     """
@@ -94,48 +597,6 @@ def get_response_value(config, query_value, auto_value=None):
     # Default is "inherit"
     return query_value
 
-def build_rr_section(section_config, query_packet):
-    """
-    Builds a Scapy DNS Resource Record section (an, ns, ar) from a configuration list.
-    """
-    section = None
-    if not section_config:
-        return None
-        
-    qname = query_packet[DNS].qd.qname
-
-    for rr_conf in section_config:
-        # Resolve RR name based on its mode
-        rrname_conf = rr_conf.get("name", {})
-        rrname = get_response_value(rrname_conf, qname, qname)
-
-        # Handle special case for OPT record (EDNS0)
-        if rr_conf.get("type") == 41:
-            # Per Readme, UDP payload size is a key parameter. It's stored in 'rclass' for OPT.
-            udp_payload_size = rr_conf.get("udp_payload_size", 1232)
-            # 核心修正：使用通用的 DNSRR 手动构造 EDNS0 OPT 记录，以兼容旧版 Scapy
-            rr = DNSRR(
-                rrname='',  # OPT 记录的名称字段是根，即一个空字符串
-                type=41,    # 记录类型为 OPT
-                rclass=udp_payload_size, # rclass 字段用于存放 UDP 载荷大小
-                ttl=0       # ttl 字段可用于扩展标志，0 是安全的默认值
-            )
-        else:  # Standard Resource Record
-            rr = DNSRR(
-                rrname=rrname,
-                type=rr_conf.get("type"),
-                ttl=rr_conf.get("ttl"),
-                rdata=rr_conf.get("rdata")
-            )
-
-        # Chain the records together
-        if section is None:
-            section = rr
-        else:
-            section = section / rr
-            
-    return section
-
 def get_flag_value(flags_conf, flag_name, default):
     """
     Safely gets a flag's integer value from the rule configuration, ensuring type safety.
@@ -150,9 +611,77 @@ def get_flag_value(flags_conf, flag_name, default):
     # If anything fails (not a dict, no 'value', or value is not int), return the default
     return default
 
+def _compiled_response(rule):
+    """
+    Returns the (rule, template, encoded records) entry of a rule, compiling it on first use.
+    """
+    global response_templates_index
+    if response_templates_index is not rules_manager.snapshot:
+        response_templates.clear()
+        slip_rules.clear()
+        response_templates_index = rules_manager.snapshot
+
+    entry = response_templates.get(id(rule))
+    if entry is None or entry[0] is not rule:
+        template = response_template.compile_response_template(rule)
+        if template is not None:
+            records = template.records
+        else:
+            try:
+                records = dns_encoder.compile_records(rule.get("response_action", {}))
+            except ValueError as e:
+                log_manager.console.warning("Rule %s: cannot encode its response records: %s",
+                                            rule.get('rule_id'), e)
+                records = None
+        entry = (rule, template, records)
+        response_templates[id(rule)] = entry
+    return entry
+
+def get_response_template(rule):
+    """
+    Returns the compiled response template for a rule, compiling it on first use.
+    """
+    return _compiled_response(rule)[1]
+
+def get_response_records(rule):
+    """
+    Returns the rule's encoded RR sections, or None if they cannot be encoded.
+    """
+    return _compiled_response(rule)[2]
+
 def generate_response(query_packet, rule):
+    """
+    Builds the raw response frame for a matched query.
+    Uses the rule's precompiled template so only the inherited fields are filled
+    in per query; rules the template cannot express go through build_response_packet.
+    """
+    template = get_response_template(rule)
+    if template is not None:
+        if isinstance(query_packet, dns_parser.ParsedQuery):
+            query = query_packet
+        else:
+            query = response_template.query_fields_from_packet(query_packet)
+        local_mac = local_ip = None
+        if template.eth_src[0] == 'auto' or template.ip_src[0] == 'auto':
+            address = get_interface_address(query_packet.sniffed_on)
+            local_mac = address.packed_mac
+            local_ip = address.packed_ip if len(query.ip_dst) == 4 else address.packed_ip6
+        frame = response_template.render_response(template, query, local_mac, local_ip)
+        if frame is not None:
+            return frame
+
+    if isinstance(query_packet, dns_parser.ParsedQuery):
+        # Only reached for rules the templates cannot express; dissect once with Scapy.
+        iface = query_packet.sniffed_on
+        query_packet = Ether(query_packet.frame)
+        query_packet.sniffed_on = iface
+    response_packet = build_response_packet(query_packet, rule)
+    return bytes(response_packet) if response_packet else None
+
+def build_response_packet(query_packet, rule):
     """
     Constructs a DNS response packet based on the detailed rule schema from the README.md.
+    This is the reference Scapy implementation the response templates must match.
     """
     action = rule.get("response_action", {})
     if not action:
@@ -160,14 +689,19 @@ def generate_response(query_packet, rule):
 
     # --- Resolve L2/L3/L4 values based on README logic ---
     iface = query_packet.sniffed_on
-    my_mac = get_if_hwaddr(iface)
-    my_ip = get_if_addr(iface)
+    address = get_interface_address(iface)
+    query_ip = query_packet.getlayer(IP)
+    if query_ip is None:
+        query_ip = query_packet[IPv6]
+    my_ip = address.ip6 if isinstance(query_ip, IPv6) else address.ip
 
-    eth_src = get_response_value(action.get('l2', {}).get('src_mac', {}), query_packet[Ether].dst, my_mac)
+    eth_src = get_response_value(action.get('l2', {}).get('src_mac', {}), query_packet[Ether].dst, address.mac)
     eth_dst = get_response_value(action.get('l2', {}).get('dst_mac', {}), query_packet[Ether].src)
     
-    ip_src = get_response_value(action.get('l3', {}).get('src_ip', {}), query_packet[IP].dst, my_ip)
-    ip_dst = get_response_value(action.get('l3', {}).get('dst_ip', {}), query_packet[IP].src)
+    ip_src = get_response_value(action.get('l3', {}).get('src_ip', {}), query_ip.dst, my_ip)
+    ip_dst = get_response_value(action.get('l3', {}).get('dst_ip', {}), query_ip.src)
+    if ip_src is None or ip_dst is None or (':' in ip_src) != (':' in ip_dst):
+        return None  # No address of this IP version, or a custom address of the other one
 
     udp_sport = get_response_value(action.get('l4', {}).get('src_port', {}), query_packet[UDP].dport)
     udp_dport = get_response_value(action.get('l4', {}).get('dst_port', {}), query_packet[UDP].sport)
@@ -176,14 +710,10 @@ def generate_response(query_packet, rule):
     header_conf = action.get('dns_header', {})
     flags_conf = header_conf.get('flags', {})
 
-    # Build all three RR sections
-    dns_answers_conf = action.get('dns_answers', [])
-    dns_authority_conf = action.get('dns_authority', [])
-    dns_additional_conf = action.get('dns_additional', [])
-    
-    an_section = build_rr_section(dns_answers_conf, query_packet)
-    ns_section = build_rr_section(dns_authority_conf, query_packet)
-    ar_section = build_rr_section(dns_additional_conf, query_packet)
+    # The RR sections are encoded once per rule (name-compressed, see dns_encoder)
+    records = get_response_records(rule)
+    if records is None:
+        return None
 
     # --- Resolve DNS Flags based on the new, detailed schema from Readme.md ---
     # Flags with simple 'value'
@@ -216,65 +746,221 @@ def generate_response(query_packet, rule):
         ad=ad_flag,
         cd=cd_flag,
         rcode=rcode_flag,
-        
-        # Manually set counts to ensure correctness, overriding Scapy's auto-calculation
-        ancount=len(dns_answers_conf),
-        nscount=len(dns_authority_conf),
-        arcount=len(dns_additional_conf),
-
-        # Assign the built sections
-        an=an_section,
-        ns=ns_section,
-        ar=ar_section
     )
+
+    # Fit the records behind the question, within the query's UDP size limit
+    header = bytes(response_dns)
+    encoded = dns_encoder.encode_records(records, len(header), response_template.edns_payload_size(query_packet[DNS]))
+    if encoded is None:
+        return None
+    (response_dns.ancount, response_dns.nscount, response_dns.arcount), sections, truncated = encoded
+    if truncated:
+        response_dns.tc = 1
+    # Dissected from the finished message, so the layer keeps these exact bytes
+    response_dns = DNS(bytes(response_dns) + sections)
     
     # --- Assemble and return the full packet ---
+    # The response carries the query's VLAN tags
+    l2 = Ether(src=eth_src, dst=eth_dst)
+    tag = query_packet[Ether].payload
+    while isinstance(tag, Dot1Q):  # Also covers Dot1AD
+        l2 = l2 / type(tag)(prio=tag.prio, dei=tag.dei, vlan=tag.vlan)
+        tag = tag.payload
+    ip_class = IPv6 if ':' in ip_src else IP
     response_packet = (
-        Ether(src=eth_src, dst=eth_dst) /
-        IP(src=ip_src, dst=ip_dst) /
+        l2 /
+        ip_class(src=ip_src, dst=ip_dst) /
         UDP(sport=udp_sport, dport=udp_dport) /
         response_dns
     )
     
     return response_packet
 
+def create_fanout_group(sock):
+    """
+    Makes a bound AF_PACKET socket the first member of a new PACKET_FANOUT group.
+    :return: the group id, for other sockets to join.
+    """
+    try:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, (PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_UNIQUEID) << 16)
+        return sock.getsockopt(SOL_PACKET, PACKET_FANOUT) & 0xFFFF
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+    group = random.SystemRandom().randrange(1, 0x10000)
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, group | PACKET_FANOUT_HASH << 16)
+    return group
+
+def open_raw_sockets(interfaces, fanout_groups=None):
+    """
+    Opens one AF_PACKET socket per interface for the raw capture engine.
+    fanout_groups (iface -> PACKET_FANOUT group id) makes each socket join its
+    interface's group, so the kernel spreads flows across the group's sockets.
+    Interfaces whose group id is None get a new group, whose id is stored in
+    fanout_groups.
+    :return: dict mapping each socket to its interface name.
+    """
+    sockets = {}
+    for iface in interfaces:
+        try:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+            sock.bind((iface, ETH_P_ALL))
+            sock.setsockopt(SOL_PACKET, PACKET_AUXDATA, 1)
+            if fanout_groups is not None:
+                if fanout_groups.get(iface) is None:
+                    fanout_groups[iface] = create_fanout_group(sock)
+                else:
+                    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, fanout_groups[iface] | PACKET_FANOUT_HASH << 16)
+        except OSError as e:
+            log_manager.console.warning("Could not open raw socket on %s: %s", iface, e)
+            continue
+        sockets[sock] = iface
+    return sockets
+
+def restore_vlan_tag(frame, auxdata):
+    """
+    Re-inserts the VLAN tag the kernel stripped from a received frame, if any.
+    """
+    status, _, _, _, _, tci, tpid = _auxdata.unpack_from(auxdata)
+    if not status & TP_STATUS_VLAN_VALID:
+        return frame
+    if not status & TP_STATUS_VLAN_TPID_VALID:
+        tpid = ETH_P_8021Q
+    return frame[:12] + struct.pack('!HH', tpid, tci) + frame[12:]
+
+def run_raw_engine():
+    """
+    Capture loop of the raw engine: reads frames from AF_PACKET sockets and hands
+    them to process_frame() without any Scapy dissection.
+    """
+    sockets = open_raw_sockets(active_interfaces)
+    if not sockets:
+        log_manager.console.warning("No raw sockets could be opened. Aborting.")
+        return
+    raw_capture_loop(sockets, lambda: not stop_sniffing.is_set())
+
+def raw_capture_loop(sockets, running, on_poll=None):
+    """
+    Reads and answers frames from raw sockets (socket -> iface) while running()
+    returns True. on_poll() is called after every kernel statistics poll.
+    """
+    # Responses go out on the same sockets the queries arrived on; they are closed
+    # together with the send sockets once the pipeline has drained
+    send_sockets.update({iface: sock for sock, iface in sockets.items()})
+    buffer = bytearray(RAW_RECV_BUFFER)
+    view = memoryview(buffer)
+    next_stats_poll = 0
+    try:
+        while running():
+            refresh_capture_filter(sockets.items())
+            if time.monotonic() >= next_stats_poll:
+                poll_kernel_stats(sockets)
+                if on_poll is not None:
+                    on_poll()
+                next_stats_poll = time.monotonic() + STATS_POLL_INTERVAL
+            readable, _, _ = select.select(list(sockets), [], [], STATS_POLL_INTERVAL)
+            for sock in readable:
+                nbytes, ancdata, _, address = sock.recvmsg_into([buffer], AUXDATA_BUFFER)
+                if address[2] == socket.PACKET_OUTGOING: # Skip our own responses
+                    continue
+                frame = bytes(view[:nbytes])
+                for _, kind, data in ancdata:
+                    if kind == PACKET_AUXDATA:
+                        frame = restore_vlan_tag(frame, data)
+                dispatch(process_frame, frame, sockets[sock], time.time())
+    finally:
+        poll_kernel_stats(sockets)
+
+def open_capture_sockets():
+    """
+    Opens one persistent Scapy listen socket per active interface, with the current capture filter.
+    :return: dict mapping each socket to its interface name (used as packet.sniffed_on).
+    """
+    return {conf.L2listen(iface=iface, filter=capture_filter): iface for iface in active_interfaces}
+
+def run_scapy_engine():
+    """
+    Capture loop of the Scapy engine: a single long-lived AsyncSniffer over
+    persistent listen sockets, so there is no gap in the capture. This thread
+    only polls kernel statistics and filter updates until sniffing is stopped.
+    """
+    open_send_sockets(active_interfaces)
+    refresh_capture_filter()
+    sockets = open_capture_sockets()
+    sniffer = AsyncSniffer(opened_socket=sockets, prn=capture_packet, store=False)
+    sniffer.start()
+    try:
+        while not stop_sniffing.wait(STATS_POLL_INTERVAL):
+            poll_kernel_stats(sockets)
+            if hasattr(socket, 'AF_PACKET'):
+                refresh_capture_filter([(sock.ins, iface) for sock, iface in sockets.items()])
+            elif refresh_capture_filter():
+                # No SO_ATTACH_FILTER on this platform: reopen the capture with the new filter
+                sniffer.stop()
+                for sock in sockets:
+                    sock.close()
+                sockets = open_capture_sockets()
+                sniffer = AsyncSniffer(opened_socket=sockets, prn=capture_packet, store=False)
+                sniffer.start()
+    finally:
+        if sniffer.running:
+            sniffer.stop()
+        poll_kernel_stats(sockets)
+        for sock in sockets:
+            sock.close()
+
 def start_sniffing():
     """
     Starts the packet sniffer in a separate thread.
     """
-    global stop_sniffing
+    global capture_filter_source
     if stop_sniffing.is_set():
         stop_sniffing.clear()
         
     # 调用重构后的函数获取接口名称列表
     if not get_active_interfaces():
-        print("[!] No active interfaces found to sniff on. Aborting.")
+        log_manager.console.warning("No active interfaces found to sniff on. Aborting.")
         return
     
-    print("[*] Starting packet sniffer...")
-    # The sniff function will block, so it runs in a thread.
-    # We use a loop with a timeout to make the sniffer responsive to the stop event.
-    while not stop_sniffing.is_set():
-        sniff(iface=active_interfaces, filter="udp dst port 53", prn=process_packet, store=False, timeout=1)
+    threading.Thread(target=refresh_interface_addresses_periodically, daemon=True).start()
+    if SEND_BATCH_SIZE > 1:
+        threading.Thread(target=flush_send_queue_periodically, daemon=True).start()
+
+    log_manager.console.info("Starting packet sniffer (%s engine)...", capture_engine)
+    capture_filter_source = (None, None)
+    capture_stats.update(packets=0, drops=0)
+    start_pipeline()
+    try:
+        if capture_engine == 'raw' and fanout.PROCESSES > 1:
+            fanout.run_fanout_engine()
+        elif capture_engine == 'raw':
+            run_raw_engine()
+        else:
+            run_scapy_engine()
+    finally:
+        # Drain the pipeline first: queued responses still need the send sockets
+        stop_pipeline()
+        close_send_sockets()
         
-    print("[*] Packet sniffer stopped.")
+    log_manager.console.info("Packet sniffer stopped. Kernel stats: %s packets, %s dropped.",
+                             capture_stats['packets'], capture_stats['drops'])
 
 
 def stop_sniffing_handler():
     """
     Sets the event to stop the sniffer.
     """
-    global stop_sniffing
-    print("[*] Stopping packet sniffer...")
+    log_manager.console.info("Stopping packet sniffer...")
     stop_sniffing.set()
 
 if __name__ == '__main__':
     # For direct testing of this module
+    log_manager.configure_console_logging()
     sniffer_thread = threading.Thread(target=start_sniffing, daemon=True)
     sniffer_thread.start()
     try:
         input("Sniffing... Press Enter to stop.\n")
     finally:
         stop_sniffing_handler()
-        sniffer_thread.join(timeout=5)
-        print("[*] Sniffer thread joined.")
+        sniffer_thread.join(timeout=STOP_TIMEOUT)
+        log_manager.console.info("Sniffer thread joined.")
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+import log_manager
+
+# --- Globals ---
+# Response rate limiting, checked right after a query matched a rule. Each source
+# address and each rule gets a token bucket refilled at CLIENT_RATE / RULE_RATE
+# responses per second, holding at most CLIENT_BURST / RULE_BURST tokens; a rate
+# of 0 disables that limit. Suppressed queries are neither answered nor logged.
+# With SLIP = N, every Nth suppressed query still gets a truncated (TC=1, no
+# records) reply, so a legitimate client behind a spoofed flood can retry over TCP.
+CLIENT_RATE = 0.0
+CLIENT_BURST = 0  # 0 means one second's worth of tokens
+RULE_RATE = 0.0
+RULE_BURST = 0
+# Client buckets are kept in a bounded table; the least recently seen source is
+# evicted when it is full (an evicted client simply starts with a full bucket).
+TABLE_SIZE = 65536
+SLIP = 0
+
+ALLOW, DROP, SLIPPED = 0, 1, 2
+enabled = False
+client_buckets = None
+rule_buckets = None
+slip_counter = 0
+
+class TokenBucketTable:
+    """
+    Token buckets keyed by client or rule, with LRU eviction beyond 'size' keys.
+    Each bucket is [tokens, last refill time].
+    """
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, now):
+        """
+        Takes one token from the key's bucket. Returns False if it is empty.
+        """
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.size:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def refund(self, key):
+        """
+        Gives back a token taken for a query that was then suppressed by another limit.
+        """
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+def configure():
+    """
+    (Re)builds the bucket tables from the settings above, dropping all state.
+    """
+    global enabled, client_buckets, rule_buckets, slip_counter
+    client_buckets = TokenBucketTable(CLIENT_RATE, CLIENT_BURST, TABLE_SIZE) if CLIENT_RATE > 0 else None
+    rule_buckets = TokenBucketTable(RULE_RATE, RULE_BURST, TABLE_SIZE) if RULE_RATE > 0 else None
+    slip_counter = 0
+    enabled = client_buckets is not None or rule_buckets is not None
+    if enabled:
+        limits = [f"{CLIENT_RATE:g}/s per client" if client_buckets else "",
+                  f"{RULE_RATE:g}/s per rule" if rule_buckets else ""]
+        log_manager.console.info("Response rate limiting: %s, slip %s.", ', '.join(filter(None, limits)), SLIP or 'off')
+
+def check(client, rule_id):
+    """
+    Decides whether a matched query from 'client' (its source address) is answered.
+    :return: ('client' or 'rule' for the bucket that ran dry, or None, verdict),
+             with verdict ALLOW, DROP or SLIPPED (answer with a truncated reply).
+    """
+    global slip_counter
+    now = time.monotonic()
+    if client_buckets is not None and not client_buckets.take(client, now):
+        limit = 'client'
+    elif rule_buckets is not None and not rule_buckets.take(rule_id, now):
+        limit = 'rule'
+        if client_buckets is not None:
+            client_buckets.refund(client)  # A query the rule limit drops costs the client nothing
+    else:
+        return None, ALLOW
+
+    if SLIP:
+        slip_counter += 1  # Unlocked: an occasional lost increment only shifts the slip pattern
+        if slip_counter % SLIP == 0:
+            return limit, SLIPPED
+    return limit, DROP
@@ -0,0 +1,247 @@
+import socket
+import struct
+from collections import namedtuple
+from scapy.all import Ether, IP, IPv6, UDP, DNS
+from scapy.layers.l2 import Dot1Q
+from scapy.layers.dns import dns_encode
+from scapy.utils import checksum, mac2str
+import dns_encoder
+
+# The per-query inputs a response template needs. Addresses are packed bytes
+# (4 for IPv4, 16 for IPv6), 'vlan' the query's VLAN tags as sent on the wire,
+# 'question' is the wire-format question section and 'edns_size' the UDP payload
+# size of the query's OPT record, 0 without EDNS.
+QueryFields = namedtuple('QueryFields', [
+    'vlan', 'eth_src', 'eth_dst', 'ip_src', 'ip_dst', 'sport', 'dport',
+    'dns_id', 'dns_flags', 'qdcount', 'question', 'edns_size',
+])
+
+# Bit offsets of the DNS header flags inside the 16-bit flags word.
+FLAG_BITS = {
+    'qr': (15, 1), 'opcode': (11, 4), 'aa': (10, 1), 'tc': (9, 1), 'rd': (8, 1),
+    'ra': (7, 1), 'z': (6, 1), 'ad': (5, 1), 'cd': (4, 1), 'rcode': (0, 4),
+}
+# Flags resolved once per rule, with the same defaults generate_response uses.
+FIXED_FLAG_DEFAULTS = {'qr': 1, 'opcode': 0, 'aa': 0, 'tc': 0, 'ra': 1, 'z': 0, 'rcode': 0}
+# Flags that may be inherited from the query.
+INHERITED_FLAGS = ('rd', 'ad', 'cd')
+TC_FLAG = 1 << FLAG_BITS['tc'][0]
+
+ETH_TYPE_IPV4 = b'\x08\x00'
+ETH_TYPE_IPV6 = b'\x86\xdd'
+IP_DEFAULT_ID = 1    # Scapy's IP() defaults, kept so output is byte-identical
+IP_DEFAULT_TTL = 64
+IPV6_VERSION_FLOW = 0x60000000  # Version 6, traffic class and flow label 0 (Scapy's IPv6() defaults)
+IPV6_DEFAULT_HLIM = 64
+
+class ResponseTemplate:
+    """
+    A rule's response_action compiled once: fixed DNS header bits, the encoded
+    RR sections (dns_encoder.EncodedRecords) and the source of every inherited
+    L2/L3/L4 field.
+    """
+    __slots__ = ('eth_src', 'eth_dst', 'ip_src', 'ip_dst', 'sport', 'dport',
+                 'fixed_flags', 'inherit_mask', 'records')
+
+class UnsupportedTemplate(Exception):
+    """
+    Raised when a response_action cannot be expressed as a template; callers
+    fall back to building the response with Scapy.
+    """
+
+def pack_ip(value):
+    """
+    Packs an IPv4 or IPv6 address string.
+    """
+    if ':' in value:
+        return socket.inet_pton(socket.AF_INET6, value)
+    return socket.inet_aton(value)
+
+def vlan_tags(packet):
+    """
+    Returns the VLAN tags of a dissected frame as they appear on the wire (TPID
+    and TCI of each, outermost first), or b'' for an untagged frame.
+    """
+    tags = []
+    tpid = packet[Ether].type
+    layer = packet[Ether].payload
+    while isinstance(layer, Dot1Q):  # Also covers Dot1AD
+        tags.append(struct.pack('!HH', tpid, layer.prio << 13 | layer.dei << 12 | layer.vlan))
+        tpid = layer.type
+        layer = layer.payload
+    return b''.join(tags)
+
+def query_fields_from_packet(packet):
+    """
+    Extracts the QueryFields of a dissected Scapy DNS query.
+    """
+    ip_layer = packet.getlayer(IP)
+    if ip_layer is None:
+        ip_layer = packet[IPv6]
+    dns_layer = packet[DNS]
+    questions = dns_layer.qd or []
+    question = b''.join(
+        dns_encode(q.qname) + struct.pack('!HH', q.qtype, q.qclass) for q in questions
+    )
+    flags = 0
+    for name, (shift, _) in FLAG_BITS.items():
+        flags |= (getattr(dns_layer, name) or 0) << shift
+    return QueryFields(
+        vlan=vlan_tags(packet),
+        eth_src=mac2str(packet[Ether].src),
+        eth_dst=mac2str(packet[Ether].dst),
+        ip_src=pack_ip(ip_layer.src),
+        ip_dst=pack_ip(ip_layer.dst),
+        sport=packet[UDP].sport,
+        dport=packet[UDP].dport,
+        dns_id=dns_layer.id,
+        dns_flags=flags,
+        qdcount=len(questions),
+        question=question,
+        edns_size=edns_payload_size(dns_layer),
+    )
+
+def edns_payload_size(dns_layer):
+    """
+    Returns the UDP payload size a dissected query advertises in its OPT record,
+    or 0 if it has none.
+    """
+    for rr in dns_layer.ar or []:
+        if rr.type == dns_encoder.TYPE_OPT:
+            return rr.rclass
+    return 0
+
+def _compile_field(config, pack, allow_auto):
+    """
+    Turns a {'mode', 'value'} response field into ('custom', packed), ('auto', None)
+    or ('inherit', None).
+    """
+    mode = config.get('mode', 'inherit')
+    if mode == 'custom':
+        value = config.get('value')
+        if value is None:
+            raise UnsupportedTemplate("custom field without a value")
+        try:
+            return ('custom', pack(value))
+        except (OSError, ValueError, TypeError, struct.error) as e:
+            raise UnsupportedTemplate(str(e))
+    if mode == 'auto':
+        if not allow_auto:
+            raise UnsupportedTemplate("field has no auto value")
+        return ('auto', None)
+    return ('inherit', None)
+
+def _pack_port(value):
+    return struct.pack('!H', value)
+
+def compile_response_template(rule):
+    """
+    Compiles a rule's response_action into a ResponseTemplate.
+    Returns None if the rule has no response action or uses values only the
+    Scapy path can resolve.
+    """
+    action = rule.get("response_action", {})
+    if not action:
+        return None
+
+    try:
+        template = ResponseTemplate()
+        l2, l3, l4 = action.get('l2', {}), action.get('l3', {}), action.get('l4', {})
+        template.eth_src = _compile_field(l2.get('src_mac', {}), mac2str, True)
+        template.eth_dst = _compile_field(l2.get('dst_mac', {}), mac2str, False)
+        template.ip_src = _compile_field(l3.get('src_ip', {}), pack_ip, True)
+        template.ip_dst = _compile_field(l3.get('dst_ip', {}), pack_ip, False)
+        template.sport = _compile_field(l4.get('src_port', {}), _pack_port, False)
+        template.dport = _compile_field(l4.get('dst_port', {}), _pack_port, False)
+
+        flags_conf = action.get('dns_header', {}).get('flags', {})
+        fixed_flags = 0
+        for name, default in FIXED_FLAG_DEFAULTS.items():
+            flag_config = flags_conf.get(name, {})
+            value = flag_config.get('value') if isinstance(flag_config, dict) else None
+            if not isinstance(value, int):
+                value = default
+            shift, width = FLAG_BITS[name]
+            if not 0 <= value < (1 << width):
+                raise UnsupportedTemplate(f"flag {name} out of range")
+            fixed_flags |= value << shift
+
+        inherit_mask = 0
+        for name in INHERITED_FLAGS:
+            flag_config = flags_conf.get(name, {})
+            shift, _ = FLAG_BITS[name]
+            mode = flag_config.get('mode', 'inherit')
+            if mode == 'custom' and flag_config.get('value') in (0, 1):
+                fixed_flags |= flag_config['value'] << shift
+            elif mode == 'inherit':
+                inherit_mask |= 1 << shift
+            else:
+                raise UnsupportedTemplate(f"flag {name} has no fixed value")
+        template.fixed_flags = fixed_flags
+        template.inherit_mask = inherit_mask
+
+        try:
+            template.records = dns_encoder.compile_records(action)
+        except ValueError as e:
+            raise UnsupportedTemplate(str(e))
+    except UnsupportedTemplate:
+        return None
+    return template
+
+def _resolve(field, inherited, auto):
+    mode, value = field
+    if mode == 'custom':
+        return value
+    if mode == 'auto':
+        return auto
+    return inherited
+
+def render_response(template, query, local_mac=None, local_ip=None):
+    """
+    Renders a complete Ethernet frame for a query from a compiled template, with
+    the query's VLAN tags and IP version, sized for its EDNS buffer (see
+    dns_encoder.encode_records). local_mac/local_ip are packed bytes (an address
+    of the query's IP version) and only needed for 'auto' fields.
+    Returns None if an address is missing or of the other IP version, or the
+    records cannot follow the query's question.
+    """
+    eth_src = _resolve(template.eth_src, query.eth_dst, local_mac)
+    eth_dst = _resolve(template.eth_dst, query.eth_src, None)
+    ip_src = _resolve(template.ip_src, query.ip_dst, local_ip)
+    ip_dst = _resolve(template.ip_dst, query.ip_src, None)
+    sport = _resolve(template.sport, None, None) or struct.pack('!H', query.dport)
+    dport = _resolve(template.dport, None, None) or struct.pack('!H', query.sport)
+    if eth_src is None or ip_src is None or len(ip_src) != len(ip_dst):
+        return None
+
+    encoded = dns_encoder.encode_records(template.records, dns_encoder.DNS_HEADER_LEN + len(query.question),
+                                         query.edns_size)
+    if encoded is None:
+        return None
+    counts, records, truncated = encoded
+    flags = template.fixed_flags | (query.dns_flags & template.inherit_mask)
+    if truncated:
+        flags |= TC_FLAG
+    dns_payload = b''.join((
+        struct.pack('!HHHHHH', query.dns_id, flags, query.qdcount, *counts), query.question, records,
+    ))
+
+    udp_length = 8 + len(dns_payload)
+    udp_header = sport + dport + struct.pack('!H', udp_length)
+    if len(ip_src) == 4:
+        pseudo_header = ip_src + ip_dst + struct.pack('!BBH', 0, socket.IPPROTO_UDP, udp_length)
+        ip_header = struct.pack('!BBHHHBB', 0x45, 0, 20 + udp_length, IP_DEFAULT_ID, 0,
+                                IP_DEFAULT_TTL, socket.IPPROTO_UDP)
+        ip_header += struct.pack('!H', checksum(ip_header + b'\x00\x00' + ip_src + ip_dst)) + ip_src + ip_dst
+        eth_type = ETH_TYPE_IPV4
+    else:
+        pseudo_header = ip_src + ip_dst + struct.pack('!IxxxB', udp_length, socket.IPPROTO_UDP)
+        ip_header = struct.pack('!IHBB', IPV6_VERSION_FLOW, udp_length, socket.IPPROTO_UDP,
+                                IPV6_DEFAULT_HLIM) + ip_src + ip_dst
+        eth_type = ETH_TYPE_IPV6
+    udp_checksum = checksum(pseudo_header + udp_header + b'\x00\x00' + dns_payload) or 0xFFFF
+
+    return b''.join((
+        eth_dst, eth_src, query.vlan, eth_type, ip_header,
+        udp_header, struct.pack('!H', udp_checksum), dns_payload,
+    ))
@@ -1,53 +1,998 @@
+import atexit
+import gc
+import heapq
+import ipaddress
 import json
 import os
-from scapy.all import IP, UDP, DNS, Ether
+import pickle
+import socket
+import threading
+from bisect import bisect_right
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from itertools import compress
+from operator import itemgetter, methodcaller
+from dns_parser import ParsedQuery
+import log_manager
 
 RULES_FILE = "rules.json"
-rules = []
+# Wildcard qname patterns ('*.example.com') live in a reversed-label trie.
+WILDCARD_PREFIX = '*.'
 
-def load_rules():
+# The active RuleSet. It is never modified: edits compile a new one and rebind
+# this name, so readers only ever see a complete snapshot and never take a lock.
+snapshot = None
+# Serializes writers (API edits, file reloads); readers do not use it.
+_write_lock = threading.Lock()
+# Bumped for every activated snapshot; the API exposes it as the rules ETag.
+rules_version = 0
+# Recent incremental edits, (version they produced, change), so the fanout
+# control plane can send responder processes the edits instead of the whole
+# snapshot. Any other activation leaves a gap in the versions, which tells
+# edits_since() that a full snapshot is needed.
+EDIT_LOG_SIZE = 1000
+edit_log = deque(maxlen=EDIT_LOG_SIZE)
+# Set once rules.json has been loaded (or replaced as a whole) in this process.
+# Until then the active snapshot is an empty placeholder, so edits load first
+# and save_rules() refuses to write it over rules.json.
+rules_loaded = False
+_load_lock = threading.Lock()
+
+# rules.json is polled for external edits every RULES_WATCH_INTERVAL seconds.
+RULES_WATCH_INTERVAL = 1.0
+rules_file_signature = None  # (mtime_ns, size) of the last version we loaded or wrote
+stop_watching = threading.Event()
+watcher_thread = None
+
+# Edits are coalesced: rules.json is rewritten (atomically, via a temp file) at
+# most once per SAVE_DELAY seconds, however many edits arrive in between.
+SAVE_DELAY = 0.5
+save_timer = None
+# Optional append-only journal: each edit appends one JSON line, and rules.json is
+# only rewritten once JOURNAL_COMPACT_ENTRIES edits have piled up. A journal left
+# behind by a crash is replayed on top of rules.json at load time.
+JOURNAL_FILE = RULES_FILE + ".journal"
+JOURNAL_COMPACT_ENTRIES = 1000
+journal_enabled = False
+journal_entries = 0
+# Compiled rules cache: the active snapshot, pickled next to rules.json with the
+# (mtime_ns, size) of the rules.json it matches. load_rules() unpickles it instead
+# of parsing and compiling rules.json as long as that file is unchanged. It is
+# rewritten in the background (from the immutable snapshot) whenever rules.json
+# is loaded or saved. Like rules.json itself, it must only be writable by us, and
+# its rules are still run through validate_rules() when it is read.
+COMPILED_CACHE_FILE = RULES_FILE + ".compiled"
+COMPILED_CACHE_FORMAT = 2  # Bump whenever RuleSet or the structures in it change
+cache_pending = None  # (snapshot, signature) waiting to be written
+cache_writer = None
+# Scapy layer classes for matching dissected packets (Scapy engine). They are
+# bound by bind_scapy_layers() when the capture engine is imported, so importing
+# this module does not import Scapy.
+IP = IPv6 = UDP = DNS = Ether = None
+
+# L3/L4 conditions that accept a single value or a range ('10.0.0.0/8', '2001:db8::/32',
+# '1024-65535'), compiled to inclusive (first, last) integer intervals. IPv4 addresses
+# are their plain integer value; IPv6 addresses are offset by IPV6_KEY_OFFSET, so
+# the two families never overlap and IPv4 keys cost nothing extra to compute.
+RangeConditions = namedtuple('RangeConditions', ['src_ip', 'dst_ip', 'src_port', 'dst_port'])
+NO_RANGES = RangeConditions(None, None, None, None)
+# Buckets with at least this many src_ip-constrained candidates get a SourceRangeIndex.
+RANGE_INDEX_MIN = 4
+IPV6_KEY_OFFSET = 1 << 128
+ADDRESS_KEY_MAX = IPV6_KEY_OFFSET + (1 << 128) - 1
+_second = itemgetter(1)
+
+class RuleSet:
+    """
+    An immutable, compiled snapshot of the rule list:
+    - rules: the rules as stored in rules.json (a tuple, in file order)
+    - index: (qname, qtype) -> candidates, each (rule, needs_full_match, ranges) in
+      priority order; buckets with many source-subnet rules are a SourceRangeIndex
+    - wildcards: SuffixTrie of the '*.suffix' rules
+    - active: all enabled, indexed rules in priority order
+    - version: rules_version at activation time
+    """
+    __slots__ = ('rules', 'index', 'wildcards', 'active', 'version')
+
+class SuffixTrie:
+    """
+    Reversed-label trie of wildcard qname patterns. A pattern '*.example.com'
+    matches any name below example.com (not example.com itself). Lookups walk
+    the query labels right to left, so they cost O(label count) regardless of
+    how many patterns are stored.
+    """
+    __slots__ = ('root',)
+
+    def __init__(self):
+        self.root = ({}, {})  # (children by label, candidates by qtype)
+
+    def insert(self, suffix, qtype, entry):
+        node = self.root
+        for label in reversed(suffix.split('.')):
+            node = node[0].setdefault(label, ({}, {}))
+        node[1].setdefault(qtype, []).append(entry)
+
+    def get(self, suffix, qtype):
+        """
+        Returns the candidates stored for one pattern, or None.
+        """
+        node = self.root
+        for label in reversed(suffix.split('.')):
+            node = node[0].get(label)
+            if node is None:
+                return None
+        return node[1].get(qtype)
+
+    def replaced(self, suffix, qtype, candidates):
+        """
+        Returns a copy with the candidates of one pattern replaced (removed if
+        empty). Only the nodes on the pattern's path are copied; the rest of the
+        trie is shared, so an edit never modifies a published snapshot.
+        """
+        trie = SuffixTrie()
+        node = trie.root = (dict(self.root[0]), dict(self.root[1]))
+        for label in reversed(suffix.split('.')):
+            child = node[0].get(label, ({}, {}))
+            node[0][label] = child = (dict(child[0]), dict(child[1]))
+            node = child
+        if candidates:
+            node[1][qtype] = candidates
+        else:
+            node[1].pop(qtype, None)
+        return trie
+
+    def lookup(self, qname, qtype):
+        """
+        Returns the candidate lists of all patterns matching qname, longest suffix first.
+        """
+        matches = []
+        node = self.root
+        labels = qname.split('.')
+        # Stop before the leftmost label: a wildcard needs at least one label below its suffix
+        for i in range(len(labels) - 1, 0, -1):
+            node = node[0].get(labels[i])
+            if node is None:
+                break
+            candidates = node[1].get(qtype)
+            if candidates:
+                matches.append(candidates)
+        matches.reverse()
+        return matches
+
+    def map_candidates(self, func):
+        """
+        Replaces every stored candidate list with func(list).
+        """
+        stack = [self.root]
+        while stack:
+            children, by_qtype = stack.pop()
+            for qtype, candidates in by_qtype.items():
+                by_qtype[qtype] = func(candidates)
+            stack.extend(children.values())
+
+class SourceRangeIndex:
+    """
+    The candidates of one bucket indexed by source address. The address space is cut
+    into segments at every src_ip range boundary, and the segments are the leaves of
+    a segment tree: each src_ip range is stored in the O(log n) tree nodes that
+    exactly cover it, so the index holds O(n log n) entries however the ranges
+    overlap. Candidates without a src_ip condition are kept once, in 'shared'.
+    A lookup bisects for the leaf and merges, in priority order, the shared list
+    with the lists of the nodes on its path to the root.
+    Entries are stored as (rank, candidate), rank being the position in the bucket.
+    """
+    __slots__ = ('entries', 'starts', 'leaves', 'nodes', 'shared')
+
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        bounds, shared = {0}, []
+        for entry in self.entries:
+            interval = entry[2].src_ip
+            if interval is not None:
+                bounds.add(interval[0])
+                if interval[1] < ADDRESS_KEY_MAX:
+                    bounds.add(interval[1] + 1)
+        self.starts = sorted(bounds)
+        self.leaves = 1 << (len(self.starts) - 1).bit_length()
+
+        nodes = {}
+        for rank, entry in enumerate(self.entries):
+            interval = entry[2].src_ip
+            if interval is None:
+                shared.append((rank, entry))
+                continue
+            # Half-open leaf range [first, last) covered by the interval
+            first = bisect_right(self.starts, interval[0]) - 1 + self.leaves
+            last = bisect_right(self.starts, interval[1]) + self.leaves
+            while first < last:
+                if first & 1:
+                    nodes.setdefault(first, []).append((rank, entry))
+                    first += 1
+                if last & 1:
+                    last -= 1
+                    nodes.setdefault(last, []).append((rank, entry))
+                first >>= 1
+                last >>= 1
+        self.nodes = {node: tuple(ranked) for node, ranked in nodes.items()}
+        self.shared = tuple(shared)
+
+    def size(self):
+        """
+        The number of stored entries, counting each once per node that holds it.
+        """
+        return len(self.shared) + sum(len(ranked) for ranked in self.nodes.values())
+
+    def lookup(self, address):
+        """
+        Yields the candidates whose src_ip covers the address (or that have none), in priority order.
+        """
+        lists = [self.shared] if self.shared else []
+        node = bisect_right(self.starts, address) - 1 + self.leaves
+        while node:
+            ranked = self.nodes.get(node)
+            if ranked:
+                lists.append(ranked)
+            node >>= 1
+        return map(_second, lists[0] if len(lists) == 1 else heapq.merge(*lists))
+
+def parse_ip_range(value):
     """
-    Loads rules from the JSON file into the global rules list.
+    Parses an IPv4 or IPv6 address or CIDR block ('10.0.0.1', '2001:db8::/32')
+    into an inclusive (first, last) interval of address keys.
     """
-    global rules
-    if os.path.exists(RULES_FILE):
-        with open(RULES_FILE, 'r') as f:
-            rules = json.load(f)
-        print(f"[*] Loaded {len(rules)} rules from {RULES_FILE}")
+    if not isinstance(value, str):
+        raise ValueError(f"invalid IP address {value!r}")
+    network = ipaddress.ip_network(value, strict=False)
+    offset = IPV6_KEY_OFFSET if network.version == 6 else 0
+    return int(network.network_address) + offset, int(network.broadcast_address) + offset
+
+def address_key(packed):
+    """
+    The key of a packed IPv4 or IPv6 address in parse_ip_range() intervals.
+    """
+    if len(packed) == 4:
+        return int.from_bytes(packed, 'big')
+    return int.from_bytes(packed, 'big') + IPV6_KEY_OFFSET
+
+def _layer_address_key(ip_layer, address):
+    if ip_layer.version == 6:
+        return address_key(socket.inet_pton(socket.AF_INET6, address))
+    return int.from_bytes(socket.inet_aton(address), 'big')
+
+def bind_scapy_layers():
+    """
+    Resolves the Scapy layer classes match_rule() needs. Called by packet_handler,
+    which imports Scapy anyway.
+    """
+    global IP, IPv6, UDP, DNS, Ether
+    from scapy.all import IP, IPv6, UDP, DNS, Ether
+
+def _ip_layer(packet):
+    ip_layer = packet.getlayer(IP)
+    if ip_layer is None:
+        ip_layer = packet.getlayer(IPv6)
+    return ip_layer
+
+def parse_port_range(value):
+    """
+    Parses 53 or '1024-65535' into an inclusive (first, last) port interval.
+    """
+    if isinstance(value, str) and not value.strip().isdigit():
+        first, sep, last = value.partition('-')
+        if not sep:
+            raise ValueError(f"invalid port range {value!r}")
+        first, last = int(first), int(last)
+    elif isinstance(value, (int, str)) and not isinstance(value, bool):
+        first = last = int(value)
     else:
-        rules = []
-        print(f"[!] Rules file not found ({RULES_FILE}). Starting with an empty rule set.")
-    return rules
+        raise ValueError(f"invalid port {value!r}")
+    if not 0 <= first <= last <= 0xFFFF:
+        raise ValueError(f"invalid port range {value!r}")
+    return first, last
+
+def compile_ranges(rule):
+    """
+    Compiles a rule's src/dst IP and port conditions into RangeConditions.
+    Raises ValueError if one of them is malformed.
+    """
+    condition = rule.get("trigger_condition", {})
+    l3_cond, l4_cond = condition.get('l3', {}), condition.get('l4', {})
+    values = (
+        (l3_cond.get('src_ip'), parse_ip_range),
+        (l3_cond.get('dst_ip'), parse_ip_range),
+        (l4_cond.get('src_port'), parse_port_range),
+        (l4_cond.get('dst_port'), parse_port_range),
+    )
+    if all(value is None for value, _ in values):
+        return NO_RANGES
+    return RangeConditions(*(None if value is None else parse(value) for value, parse in values))
+
+def in_range(interval, value):
+    return interval is None or interval[0] <= value <= interval[1]
+
+def _index_candidates(entries):
+    """
+    Freezes a bucket's candidate list, indexing it by source address when
+    enough candidates are restricted to source subnets.
+    """
+    if sum(entry[2].src_ip is not None for entry in entries) >= RANGE_INDEX_MIN:
+        return SourceRangeIndex(entries)
+    return tuple(entries)
+
+def _source_address(packet):
+    if isinstance(packet, ParsedQuery):
+        return address_key(packet.ip_src)
+    ip_layer = _ip_layer(packet)
+    return _layer_address_key(ip_layer, ip_layer.src)
+
+def normalize_qname(qname):
+    """
+    Normalizes a query name for index lookups (case-insensitive, no trailing dot).
+    """
+    if isinstance(qname, bytes):
+        qname = qname.decode(errors='ignore')
+    return qname.rstrip('.').lower()
+
+def qname_matches(pattern, qname):
+    """
+    Compares a rule qname (exact or '*.suffix' wildcard) with a query name.
+    """
+    pattern = normalize_qname(pattern or '')
+    qname = normalize_qname(qname)
+    if pattern.startswith(WILDCARD_PREFIX):
+        return qname.endswith(pattern[1:]) # keeps the leading dot, so the apex itself does not match
+    return pattern == qname
+
+def _file_signature():
+    try:
+        stat = os.stat(RULES_FILE)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def validate_rules(new_rules):
+    """
+    Checks that a rule list is structurally sound before it is activated.
+    Raises ValueError describing the first problem found.
+    """
+    if not isinstance(new_rules, list):
+        raise ValueError("rules must be a JSON list")
+    for position, rule in enumerate(new_rules):
+        if not isinstance(rule, dict):
+            raise ValueError(f"rule #{position} is not an object")
+        name = rule.get('rule_id', f"#{position}")
+        condition = rule.get('trigger_condition', {})
+        if not isinstance(condition, dict) or not all(
+                isinstance(condition.get(layer, {}), dict) for layer in ('l2', 'l3', 'l4', 'dns')):
+            raise ValueError(f"rule {name}: trigger_condition layers must be objects")
+        if not isinstance(rule.get('response_action', {}), dict):
+            raise ValueError(f"rule {name}: response_action must be an object")
+        if not isinstance(condition.get('dns', {}).get('flags', {}), dict):
+            raise ValueError(f"rule {name}: dns flags must be an object")
+        qname = condition.get('dns', {}).get('qname')
+        if qname is not None and not isinstance(qname, str):
+            raise ValueError(f"rule {name}: qname must be a string")
+        priority = rule.get('priority')
+        if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool)):
+            raise ValueError(f"rule {name}: priority must be an integer")
+        try:
+            compile_ranges(rule)
+        except ValueError as e:
+            raise ValueError(f"rule {name}: {e}")
+
+def activate_rules(new_rules):
+    """
+    Compiles a rule list and makes it the active snapshot. Does not save it.
+    """
+    return activate_snapshot(compile_rules(new_rules))
+
+def activate_snapshot(ruleset):
+    """
+    Makes an already compiled RuleSet (from the compiled cache, or sent by the
+    fanout control plane) the active snapshot.
+    """
+    global snapshot, rules_version
+    rules_version += 1
+    ruleset.version = rules_version
+    snapshot = ruleset
+    return snapshot
+
+def _activate_edit(ruleset, change):
+    """
+    Activates the RuleSet edit_ruleset() made for a change and logs the change.
+    Callers hold _write_lock.
+    """
+    activate_snapshot(ruleset)
+    edit_log.append((rules_version, change))
+
+def edits_since(version):
+    """
+    Returns the active snapshot and the edits that lead to it from the snapshot
+    with the given version, in order. The edits are None if anything but an
+    incremental edit happened in between, or the log no longer reaches back.
+    """
+    with _write_lock:
+        edits = [change for produced, change in edit_log if produced > version]
+        if len(edits) != snapshot.version - version:
+            edits = None
+        return snapshot, edits
+
+def _replay_journal(new_rules):
+    """
+    Applies the journaled edits to a rule list loaded from rules.json.
+    :return: (rules, number of entries applied)
+    """
+    global journal_entries
+    if not os.path.exists(JOURNAL_FILE):
+        journal_entries = 0
+        return new_rules, 0
+
+    new_rules = list(new_rules)
+    positions = {}  # rule_id -> indexes of its rules; deleted rules become None until the end
+    for i, rule in enumerate(new_rules):
+        positions.setdefault(rule.get('rule_id'), []).append(i)
+    applied = 0
+    with open(JOURNAL_FILE, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            try:
+                entry = json.loads(line)
+                rule_id = entry['rule_id']
+                if entry['op'] == 'put':
+                    rule = entry['rule']
+                    if rule_id in positions:
+                        new_rules[positions[rule_id][0]] = rule
+                    else:
+                        positions[rule_id] = [len(new_rules)]
+                        new_rules.append(rule)
+                elif entry['op'] == 'delete':
+                    for i in positions.pop(rule_id, ()):
+                        new_rules[i] = None
+                else:
+                    raise ValueError(f"unknown op {entry['op']!r}")
+            except (ValueError, KeyError, TypeError) as e:
+                # Typically the last line, cut short by a crash mid-append
+                log_manager.console.warning("Skipping %s line %s: %s", JOURNAL_FILE, line_number, e)
+                continue
+            applied += 1
+    journal_entries = applied
+    return [rule for rule in new_rules if rule is not None], applied
+
+def _read_rules_file():
+    """
+    Reads rules.json and replays the journal on top of it.
+    :return: (rules, number of journal entries applied)
+    """
+    with open(RULES_FILE, 'r') as f:
+        new_rules = json.load(f)
+    if not isinstance(new_rules, list):
+        raise ValueError("rules must be a JSON list")
+    return _replay_journal(new_rules)
+
+@contextmanager
+def _gc_paused():
+    """
+    Suspends the cyclic garbage collector while a rule set is built. Parsing or
+    unpickling allocates many containers and no garbage cycles, so collections
+    triggered along the way would only rescan them (over half the load time for
+    100k rules).
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def _read_compiled_cache(signature):
+    """
+    Returns the cached RuleSet if it was compiled from rules.json as it is now
+    and its rules pass validate_rules(), or None.
+    """
+    try:
+        with open(COMPILED_CACHE_FILE, 'rb') as f:
+            if pickle.load(f) != (COMPILED_CACHE_FORMAT, signature):
+                return None
+            ruleset = pickle.load(f)
+        if not isinstance(ruleset, RuleSet) or not isinstance(ruleset.rules, tuple):
+            raise ValueError("not a compiled rule set")
+        validate_rules(list(ruleset.rules))
+    except FileNotFoundError:
+        return None
+    except Exception as e: # A cache from another version, cut short or invalid: rebuild it
+        log_manager.console.warning("Ignoring %s: %s", COMPILED_CACHE_FILE, e)
+        return None
+    return ruleset
+
+def _schedule_cache_write():
+    """
+    Has the compiled cache rewritten for the active snapshot, which must match
+    rules.json as it is now. Requests made while a write is running are
+    coalesced into one more write. Callers hold _write_lock.
+    """
+    global cache_pending, cache_writer
+    cache_pending = (snapshot, rules_file_signature)
+    if cache_writer is None:
+        cache_writer = threading.Thread(target=_write_compiled_cache, daemon=True)
+        cache_writer.start()
+
+def _write_compiled_cache():
+    global cache_pending, cache_writer
+    while True:
+        with _write_lock:
+            pending, cache_pending = cache_pending, None
+            if pending is None:
+                cache_writer = None
+                return
+        ruleset, signature = pending
+        temp_file = COMPILED_CACHE_FILE + ".tmp"
+        try:
+            with open(temp_file, 'wb') as f:
+                pickle.dump((COMPILED_CACHE_FORMAT, signature), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(ruleset, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, COMPILED_CACHE_FILE)
+        except (OSError, pickle.PicklingError) as e:
+            log_manager.console.warning("Could not write %s: %s", COMPILED_CACHE_FILE, e)
+
+def load_rules():
+    """
+    Loads rules from the JSON file (plus any journaled edits) and activates them.
+    An unchanged rules.json without a journal is loaded from the compiled cache.
+    Raises ValueError, leaving the active rules untouched, if rules.json is not
+    valid JSON or its rules fail validate_rules().
+    """
+    global rules_file_signature, rules_loaded
+    with _write_lock, _gc_paused():
+        rules_file_signature = _file_signature()
+        cached = None
+        if rules_file_signature is not None and not os.path.exists(JOURNAL_FILE):
+            cached = _read_compiled_cache(rules_file_signature)
+        if cached is not None:
+            activate_snapshot(cached)
+            rules_loaded = True
+            log_manager.console.info("Loaded %s rules from %s", len(cached.rules), COMPILED_CACHE_FILE)
+            return snapshot.rules
+
+        if os.path.exists(RULES_FILE):
+            new_rules, replayed = _read_rules_file()
+            log_manager.console.info("Loaded %s rules from %s", len(new_rules), RULES_FILE)
+        else:
+            new_rules, replayed = _replay_journal([])
+            log_manager.console.warning("Rules file not found (%s). Starting with an empty rule set.", RULES_FILE)
+        validate_rules(new_rules)
+        activate_rules(new_rules)
+        rules_loaded = True
+        if replayed:
+            log_manager.console.info("Replayed %s journaled edits", replayed)
+            save_rules()
+        elif rules_file_signature is not None:
+            _schedule_cache_write()
+        return snapshot.rules
+
+def ensure_rules_loaded():
+    """
+    Loads the rules on first use in this process, whichever server runs it
+    (flask run, a WSGI server, the reloader's child). The first load then
+    freezes everything allocated so far (gc.freeze), so later collections skip
+    the loaded rules. Raises ValueError like load_rules(), and tries again on
+    the next call.
+    """
+    if rules_loaded:
+        return
+    with _load_lock:
+        if not rules_loaded:
+            load_rules()
+            gc.freeze()
 
 def save_rules():
     """
-    Saves the current rules list to the JSON file.
+    Writes the active rules to the JSON file right away and empties the journal.
+    The file is written to a temporary name and renamed over rules.json, so a
+    crash leaves either the old or the new version, never a truncated one.
+    Callers hold _write_lock. Refuses (RuntimeError) until rules.json has been
+    loaded, so the empty placeholder snapshot never overwrites it.
+    """
+    global rules_file_signature, save_timer, journal_entries
+    if not rules_loaded:
+        raise RuntimeError(f"{RULES_FILE} has not been loaded; refusing to overwrite it")
+    if save_timer is not None:
+        save_timer.cancel()
+        save_timer = None
+    temp_file = RULES_FILE + ".tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(list(snapshot.rules), f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, RULES_FILE)
+    rules_file_signature = _file_signature()
+    # Only once rules.json holds every edit may the journal go
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+    journal_entries = 0
+    log_manager.console.info("Saved %s rules to %s", len(snapshot.rules), RULES_FILE)
+    _schedule_cache_write()
+
+def schedule_save():
     """
-    with open(RULES_FILE, 'w') as f:
-        json.dump(rules, f, indent=2)
-    print(f"[*] Saved {len(rules)} rules to {RULES_FILE}")
+    Saves the rules SAVE_DELAY seconds from now, unless a save is already pending.
+    Callers hold _write_lock.
+    """
+    global save_timer
+    if save_timer is None:
+        save_timer = threading.Timer(SAVE_DELAY, _deferred_save)
+        save_timer.daemon = True
+        save_timer.start()
+
+def _deferred_save():
+    with _write_lock:
+        if save_timer is threading.current_thread():
+            save_rules()
 
-def find_matching_rule(packet):
+def flush_rules():
     """
-    Iterates through the loaded rules and finds the first one that matches the packet.
+    Writes out a pending debounced save immediately (e.g. at shutdown).
+    """
+    with _write_lock:
+        if save_timer is not None:
+            save_rules()
+
+atexit.register(flush_rules)
+
+def _record_edit(entry):
+    """
+    Persists one rule edit: appended to the journal when it is enabled,
+    otherwise folded into the next debounced save. Callers hold _write_lock.
+    """
+    global journal_enabled, journal_entries
+    if journal_enabled:
+        try:
+            with open(JOURNAL_FILE, 'a') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            log_manager.console.warning("Could not append to %s, disabling the journal: %s", JOURNAL_FILE, e)
+            journal_enabled = False
+            schedule_save()
+            return
+        journal_entries += 1
+        if journal_entries < JOURNAL_COMPACT_ENTRIES:
+            return
+    schedule_save()
+
+def replace_rules(new_rules):
+    """
+    Validates a new rule list, swaps it in and saves it. It replaces rules.json
+    as a whole, so it needs no load first.
+    Raises ValueError (leaving the active rules untouched) if validation fails.
+    """
+    global rules_loaded
+    validate_rules(new_rules)
+    with _write_lock:
+        activate_rules(new_rules)
+        rules_loaded = True
+        save_rules()
+    return snapshot
+
+def add_rule(rule):
+    validate_rules([rule])
+    ensure_rules_loaded()
+    with _write_lock:
+        change = ('add', rule)
+        _activate_edit(edit_ruleset(snapshot, change), change)
+        _record_edit({'op': 'put', 'rule_id': rule.get('rule_id'), 'rule': rule})
+
+def update_rule(rule_id, rule):
+    """
+    Replaces the rule with the given rule_id. Returns False if there is none.
+    """
+    validate_rules([rule])
+    ensure_rules_loaded()
+    with _write_lock:
+        change = ('update', rule_id, rule)
+        ruleset = edit_ruleset(snapshot, change)
+        if ruleset is None:
+            return False
+        _activate_edit(ruleset, change)
+        _record_edit({'op': 'put', 'rule_id': rule_id, 'rule': rule})
+    return True
+
+def delete_rule(rule_id):
+    """
+    Removes the rules with the given rule_id. Returns False if there is none.
+    """
+    ensure_rules_loaded()
+    with _write_lock:
+        change = ('delete', rule_id)
+        ruleset = edit_ruleset(snapshot, change)
+        if ruleset is None:
+            return False
+        _activate_edit(ruleset, change)
+        _record_edit({'op': 'delete', 'rule_id': rule_id})
+    return True
+
+def reload_rules_file():
+    """
+    Re-reads rules.json if it changed since we last loaded or wrote it. The new
+    rules (with journaled edits replayed on top) are validated first; an
+    unreadable or invalid file leaves the active rules in place.
+    :return: True if a new snapshot was activated.
+    """
+    global rules_file_signature, save_timer
+    with _write_lock:
+        signature = _file_signature()
+        if not rules_loaded or signature is None or signature == rules_file_signature:
+            return False
+        rules_file_signature = signature
+        try:
+            new_rules, replayed = _read_rules_file()
+            validate_rules(new_rules)
+        except (OSError, ValueError) as e:
+            log_manager.console.warning("Ignoring changed %s, keeping the active rules: %s", RULES_FILE, e)
+            return False
+        if save_timer is not None:
+            log_manager.console.warning("%s changed on disk; unsaved edits from the API are discarded", RULES_FILE)
+            save_timer.cancel()
+            save_timer = None
+        activate_rules(new_rules)
+        log_manager.console.info("Reloaded %s rules from %s", len(new_rules), RULES_FILE)
+        if replayed:
+            save_rules()
+        else:
+            _schedule_cache_write()
+    return True
+
+def watch_rules_file():
+    """
+    Polls rules.json every RULES_WATCH_INTERVAL seconds and hot-reloads external edits.
+    """
+    while not stop_watching.wait(RULES_WATCH_INTERVAL):
+        reload_rules_file()
+
+def start_rules_watcher():
+    global watcher_thread
+    if watcher_thread and watcher_thread.is_alive():
+        return
+    stop_watching.clear()
+    watcher_thread = threading.Thread(target=watch_rules_file, daemon=True)
+    watcher_thread.start()
+
+def has_extra_predicates(rule):
+    """
+    Returns True if the rule constrains anything beyond the DNS qname and qtype,
+    i.e. it still needs a full match_rule() check once the index lookup hits.
+    """
+    condition = rule.get("trigger_condition", {})
+    for layer in ('l2', 'l3', 'l4'):
+        if any(value is not None for value in condition.get(layer, {}).values()):
+            return True
+
+    dns_cond = condition.get('dns', {})
+    for key, value in dns_cond.items():
+        if key in ('qname', 'qtype'):
+            continue
+        if key == 'flags':
+            if any(flag is not None for flag in value.values()):
+                return True
+        elif value is not None:
+            return True
+    return False
+
+def _index_slot(rule):
+    """
+    Where a rule goes in a RuleSet: (is_wildcard, (qname or wildcard suffix, qtype),
+    candidate entry), or None if it is disabled or has no DNS qname condition.
+    """
+    if not rule.get("is_enabled", False):
+        return None
+    dns_cond = rule.get("trigger_condition", {}).get('dns', {})
+    if not dns_cond or dns_cond.get('qname') is None:
+        return None
+    try:
+        ranges = compile_ranges(rule)
+    except ValueError as e:
+        log_manager.console.warning("Skipping rule %s: %s", rule.get('rule_id'), e)
+        return None
+    qname = normalize_qname(dns_cond['qname'])
+    entry = (rule, has_extra_predicates(rule), ranges)
+    if qname.startswith(WILDCARD_PREFIX):
+        return True, (qname[len(WILDCARD_PREFIX):], dns_cond.get('qtype')), entry
+    return False, (qname, dns_cond.get('qtype')), entry
+
+def compile_rules(new_rules):
+    """
+    Compiles a rule list into a RuleSet: the (qname, qtype) hash index and the wildcard trie.
+    Only enabled rules with a DNS condition are indexed. Candidates within a bucket
+    are ordered by ascending 'priority' (lower value wins), ties keep file order.
+    """
+    buckets = {}
+    trie = SuffixTrie()
+    indexed = []
+    ordered = sorted(enumerate(new_rules), key=lambda item: (item[1].get('priority') or 0, item[0]))
+    for _, rule in ordered:
+        slot = _index_slot(rule)
+        if slot is None:
+            continue
+        is_wildcard, key, entry = slot
+        if is_wildcard:
+            trie.insert(key[0], key[1], entry)
+        else:
+            buckets.setdefault(key, []).append(entry)
+        indexed.append(rule)
+
+    trie.map_candidates(_index_candidates)
+    ruleset = RuleSet()
+    ruleset.rules = tuple(new_rules)
+    ruleset.index = {key: _index_candidates(candidates) for key, candidates in buckets.items()}
+    ruleset.wildcards = trie
+    ruleset.active = tuple(indexed)
+    ruleset.version = 0
+    return ruleset
+
+def _priority(rule):
+    return rule.get('priority') or 0
+
+_rule_id = methodcaller('get', 'rule_id')
+
+def _insertion_point(ordered, rule, is_before):
+    """
+    Where a rule goes in a list of rules sorted by priority, then file order.
+    is_before(other) tells whether another rule precedes it in the file.
+    """
+    priority = _priority(rule)
+    lo, hi = 0, len(ordered)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        other = _priority(ordered[mid])
+        if other < priority or (other == priority and is_before(ordered[mid])):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _without(ordered, rule):
+    """
+    Removes one rule (by identity) from a tuple sorted by priority, then file order.
+    :return: (index it had, the tuple without it)
+    """
+    first = _insertion_point(ordered, rule, lambda other: False)
+    last = _insertion_point(ordered, rule, lambda other: True)
+    i = first + list(map(id, ordered[first:last])).index(id(rule))
+    return i, ordered[:i] + ordered[i + 1:]
+
+def edit_ruleset(ruleset, change):
+    """
+    Applies one edit to a compiled RuleSet and returns the result as a new
+    RuleSet, or None if no rule has the rule_id. 'change' is ('add', rule),
+    ('update', rule_id, rule) or ('delete', rule_id). Only the index buckets and
+    trie paths of the changed rules are rebuilt and the new rule is inserted by
+    bisection; everything else is shared with the old RuleSet, which stays
+    untouched. The result equals compile_rules() of the edited list. Finding the
+    rule_id and copying the rule tuples is still linear in the rule count, but a
+    cheap pass compared with a full compilation.
+    """
+    rules = ruleset.rules
+    op = change[0]
+    if op == 'add':
+        position, removed, added = len(rules), (), change[1]
+        new_rules = rules + (added,)
+    elif op in ('update', 'delete'):
+        rule_id = change[1]
+        rule_ids = list(map(_rule_id, rules))
+        matches = []
+        try:
+            while True:
+                matches.append(rule_ids.index(rule_id, matches[-1] + 1 if matches else 0))
+        except ValueError:
+            pass
+        if not matches:
+            return None
+        position = matches[0]
+        if op == 'update':
+            removed, added = (rules[position],), change[2]
+            new_rules = rules[:position] + (added,) + rules[position + 1:]
+        else:
+            removed, added = tuple(rules[i] for i in matches), None
+            new_rules = tuple(compress(rules, [other != rule_id for other in rule_ids]))
+    else:
+        raise ValueError(f"unknown edit {op!r}")
+
+    before = None
+
+    def is_before(other):
+        # Added rules go last; an updated rule takes the place of the one it replaces
+        nonlocal before
+        if op == 'add':
+            return True
+        if before is None:
+            before = set(map(id, rules[:position]))
+        return id(other) in before
+
+    removed_ids = set(map(id, removed))
+    changed = {}  # (is_wildcard, key) -> entry to insert in that bucket, or None
+    active, vacated = ruleset.active, None
+    for rule in removed:
+        slot = _index_slot(rule)
+        if slot is not None:
+            changed.setdefault(slot[:2], None)
+            vacated, active = _without(active, rule)
+    added_slot = _index_slot(added) if added is not None else None
+    if added_slot is not None:
+        changed[added_slot[:2]] = added_slot[2]
+        if vacated is not None and _priority(added) == _priority(removed[0]):
+            i = vacated  # Same priority and file position as the rule it replaces
+        else:
+            i = _insertion_point(active, added, is_before)
+        active = active[:i] + (added,) + active[i:]
+
+    index, trie = dict(ruleset.index), ruleset.wildcards
+    for (is_wildcard, key), entry in changed.items():
+        candidates = trie.get(*key) if is_wildcard else index.get(key)
+        if isinstance(candidates, SourceRangeIndex):
+            candidates = candidates.entries
+        candidates = [candidate for candidate in candidates or () if id(candidate[0]) not in removed_ids]
+        if entry is not None:
+            candidates.insert(_insertion_point([candidate[0] for candidate in candidates], added, is_before), entry)
+        candidates = _index_candidates(candidates) if candidates else None
+        if is_wildcard:
+            trie = trie.replaced(key[0], key[1], candidates)
+        elif candidates:
+            index[key] = candidates
+        else:
+            del index[key]
+
+    edited = RuleSet()
+    edited.rules = new_rules
+    edited.index = index
+    edited.wildcards = trie
+    edited.active = active
+    edited.version = 0
+    return edited
+
+def find_matching_rule(packet, ruleset=None):
+    """
+    Finds the highest-priority enabled rule that matches the packet.
+    Exact (qname, qtype) rules are tried first, then wildcard patterns with the
+    longest matching suffix first. Only rules with extra L2/L3/L4/DNS header
+    predicates are run through match_rule()/match_query().
     
-    :param packet: The incoming Scapy packet.
+    :param packet: The incoming Scapy packet, or a dns_parser.ParsedQuery from the raw engine.
+    :param ruleset: The RuleSet to match against; defaults to the active snapshot.
     :return: The matching rule dictionary or None if no match is found.
     """
-    for rule in rules:
-        if not rule.get("is_enabled", False):
-            continue
+    if isinstance(packet, ParsedQuery):
+        qname, qtype, matcher = packet.qname, packet.qtype, match_query
+    else:
+        question = packet.getlayer(DNS).qd
+        qname, qtype, matcher = question.qname, question.qtype, match_rule
+
+    ruleset = ruleset or snapshot
+    qname = normalize_qname(qname)
+    buckets = ruleset.wildcards.lookup(qname, qtype)
+    candidates = ruleset.index.get((qname, qtype))
+    if candidates:
+        buckets.insert(0, candidates)
 
-        if match_rule(packet, rule):
-            return rule
+    address = None
+    for candidates in buckets:
+        if isinstance(candidates, SourceRangeIndex):
+            if address is None:
+                address = _source_address(packet)
+            candidates = candidates.lookup(address)
+        for rule, needs_full_match, ranges in candidates:
+            if not needs_full_match or matcher(packet, rule, ranges):
+                return rule
     return None
 
-def match_rule(packet, rule):
+def match_rule(packet, rule, ranges=None):
     """
     Checks if a single packet matches a given rule based on the detailed nested schema
     from the README.md. Follows the "layer-by-layer, field-by-field" validation principle.
+    'ranges' are the rule's precompiled RangeConditions; they are compiled on the fly if omitted.
     """
     condition = rule.get("trigger_condition", {})
+    if ranges is None:
+        ranges = compile_ranges(rule)
 
     # Helper for safe field checking. Returns True if rule field is not set (ANY) or matches packet.
     def check(rule_value, packet_value):
@@ -59,22 +1004,26 @@ def match_rule(packet, rule):
         if not check(l2_cond.get('src_mac'), packet.getlayer(Ether).src): return False
         if not check(l2_cond.get('dst_mac'), packet.getlayer(Ether).dst): return False
 
-    # --- L3 Matching (IP) ---
+    # --- L3 Matching (IPv4, or IPv6 with ttl/protocol meaning hop limit/next header) ---
     l3_cond = condition.get('l3', {})
     if l3_cond:
-        ip_layer = packet.getlayer(IP)
-        if not check(l3_cond.get('src_ip'), ip_layer.src): return False
-        if not check(l3_cond.get('dst_ip'), ip_layer.dst): return False
-        if not check(l3_cond.get('ttl'), ip_layer.ttl): return False
-        if not check(l3_cond.get('protocol'), ip_layer.proto): return False
-        # Note: ip_version is implicitly checked by the presence of the IP layer.
+        ip_layer = _ip_layer(packet)
+        if ranges.src_ip and not in_range(ranges.src_ip, _layer_address_key(ip_layer, ip_layer.src)): return False
+        if ranges.dst_ip and not in_range(ranges.dst_ip, _layer_address_key(ip_layer, ip_layer.dst)): return False
+        if ip_layer.version == 6:
+            if not check(l3_cond.get('ttl'), ip_layer.hlim): return False
+            if not check(l3_cond.get('protocol'), ip_layer.nh): return False
+        else:
+            if not check(l3_cond.get('ttl'), ip_layer.ttl): return False
+            if not check(l3_cond.get('protocol'), ip_layer.proto): return False
+        if not check(l3_cond.get('ip_version'), ip_layer.version): return False
 
     # --- L4 Matching (UDP) ---
     l4_cond = condition.get('l4', {})
     if l4_cond:
         udp_layer = packet.getlayer(UDP)
-        if not check(l4_cond.get('src_port'), udp_layer.sport): return False
-        if not check(l4_cond.get('dst_port'), udp_layer.dport): return False
+        if not in_range(ranges.src_port, udp_layer.sport): return False
+        if not in_range(ranges.dst_port, udp_layer.dport): return False
 
     # --- L5 Matching (DNS) ---
     dns_cond = condition.get('dns', {})
@@ -84,8 +1033,7 @@ def match_rule(packet, rule):
     dns_layer = packet.getlayer(DNS)
     
     # Step 1: Mandatory fields (qname, qtype)
-    packet_qname = dns_layer.qd.qname.decode().rstrip('.')
-    if dns_cond.get('qname') != packet_qname: return False
+    if not qname_matches(dns_cond.get('qname'), dns_layer.qd.qname): return False
     if dns_cond.get('qtype') != dns_layer.qd.qtype: return False
 
     # Step 2: Optional DNS header and count fields
@@ -110,8 +1058,72 @@ def match_rule(packet, rule):
         if not check(flags_cond.get('ad'), dns_layer.ad): return False
         if not check(flags_cond.get('cd'), dns_layer.cd): return False
 
-    print(f"[*] Packet matched rule: {rule.get('name', rule.get('rule_id'))}")
+    if log_manager.packet_debug:
+        log_manager.console.debug("Packet matched rule: %s", rule.get('name', rule.get('rule_id')))
+    return True
+
+def match_query(query, rule, ranges=None):
+    """
+    Same checks as match_rule(), evaluated on a dns_parser.ParsedQuery instead
+    of a dissected Scapy packet.
+    """
+    condition = rule.get("trigger_condition", {})
+    if ranges is None:
+        ranges = compile_ranges(rule)
+
+    def check(rule_value, packet_value):
+        return rule_value is None or rule_value == packet_value
+
+    # --- L2 Matching (Ethernet) ---
+    l2_cond = condition.get('l2', {})
+    if l2_cond:
+        if not check(l2_cond.get('src_mac'), query.src_mac): return False
+        if not check(l2_cond.get('dst_mac'), query.dst_mac): return False
+
+    # --- L3 Matching (IP) ---
+    l3_cond = condition.get('l3', {})
+    if l3_cond:
+        if ranges.src_ip and not in_range(ranges.src_ip, address_key(query.ip_src)): return False
+        if ranges.dst_ip and not in_range(ranges.dst_ip, address_key(query.ip_dst)): return False
+        if not check(l3_cond.get('ttl'), query.ttl): return False
+        if not check(l3_cond.get('protocol'), query.proto): return False
+        if not check(l3_cond.get('ip_version'), query.ip_version): return False
+
+    # --- L4 Matching (UDP) ---
+    l4_cond = condition.get('l4', {})
+    if l4_cond:
+        if not in_range(ranges.src_port, query.sport): return False
+        if not in_range(ranges.dst_port, query.dport): return False
+
+    # --- L5 Matching (DNS) ---
+    dns_cond = condition.get('dns', {})
+    if not dns_cond:
+        return False
+
+    if not qname_matches(dns_cond.get('qname'), query.qname): return False
+    if dns_cond.get('qtype') != query.qtype: return False
+
+    if not check(dns_cond.get('transaction_id'), query.dns_id): return False
+
+    if not check(dns_cond.get('qd_count'), query.qdcount): return False
+    if not check(dns_cond.get('an_count'), query.ancount): return False
+    if not check(dns_cond.get('ns_count'), query.nscount): return False
+    if not check(dns_cond.get('ar_count'), query.arcount): return False
+
+    flags_cond = dns_cond.get('flags', {})
+    if flags_cond:
+        if not check(flags_cond.get('qr'), query.flag(15)): return False
+        if not check(flags_cond.get('opcode'), query.flag(11, 4)): return False
+        if not check(flags_cond.get('tc'), query.flag(9)): return False
+        if not check(flags_cond.get('rd'), query.flag(8)): return False
+        if not check(flags_cond.get('z'), query.flag(6)): return False
+        if not check(flags_cond.get('ad'), query.flag(5)): return False
+        if not check(flags_cond.get('cd'), query.flag(4)): return False
+
+    if log_manager.packet_debug:
+        log_manager.console.debug("Packet matched rule: %s", rule.get('name', rule.get('rule_id')))
     return True
 
-# Initialize by loading rules on startup
-load_rules()
+# Start empty; app.py loads rules.json once the command line is parsed, so that
+# importing this module stays cheap.
+activate_rules([])
@@ -1,13 +1,25 @@
 document.addEventListener('DOMContentLoaded', () => {
     // --- Global State ---
-    let currentRules = [];
+    let currentRules = []; // Summaries (RULE_LIST_FIELDS) of the rules on the current page
     let selectedRuleId = null;
+    let selectedRule = null; // Full copy of the selected rule, fetched on demand
+    const RULE_LIST_FIELDS = 'rule_id,name,is_enabled';
+    const rulesPerPage = 50;
+    let rulesPage = 1;
+    let totalRulePages = 1;
+    let totalRuleCount = 0;
+    let ruleSearch = '';
+    let rulesListUrl = null; // URL and ETag of the last list response, for If-None-Match
+    let rulesEtag = null;
+    let ruleSearchTimeout;
     let logSessions = [];
     let logSort = { column: 'id', order: 'desc' };
     let logsPerPage = 10;
     let currentPage = 1;
     let totalLogPages = 1;
     let totalLogCount = 0;
+    let modalLogTaskId = null;
+    let modalLogOffset = 0; // Byte offset in task.log where the shown content starts
 
     // --- i18n State ---
     let currentLang = 'en';
@@ -19,6 +31,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const statusIndicator = document.getElementById('status-indicator');
     const statusText = document.getElementById('status-text');
     const rulesListContainer = document.getElementById('rules-list-container');
+    const ruleSearchInput = document.getElementById('rule-search');
+    const rulesPagination = document.getElementById('rules-pagination');
     const newRuleBtn = document.getElementById('new-rule-btn');
     const saveRuleBtn = document.getElementById('save-rule-btn');
     const deleteRuleBtn = document.getElementById('delete-rule-btn');
@@ -42,7 +56,11 @@ document.addEventListener('DOMContentLoaded', () => {
     const modalCloseBtn = document.getElementById('modal-close-btn');
     const modalTaskId = document.getElementById('modal-task-id');
     const modalLogContent = document.getElementById('modal-log-content');
+    const modalLoadEarlierBtn = document.getElementById('modal-load-earlier');
     const modalDownloadLink = document.getElementById('modal-download-pcap');
+    const modalPcapSegments = document.getElementById('modal-pcap-segments');
+    const modalPcapQnameInput = document.getElementById('modal-pcap-qname');
+    const modalDownloadFilteredLink = document.getElementById('modal-download-filtered-pcap');
     const toast = document.getElementById('toast');
     const toastMessage = document.getElementById('toast-message');
     const toastCopyBtn = document.getElementById('toast-copy-btn');
@@ -318,11 +336,58 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Event Handlers ---
+    function renderRulesPagination() {
+        rulesPagination.innerHTML = '';
+        if (totalRulePages <= 1) return;
+        rulesPagination.innerHTML = `
+            <button id="rules-prev-btn" class="px-2 py-1 bg-gray-700 rounded hover:bg-gray-600 disabled:opacity-50 disabled:cursor-not-allowed" ${rulesPage === 1 ? 'disabled' : ''}>
+                <i class="fas fa-chevron-left"></i>
+            </button>
+            <span class="text-gray-400">${rulesPage} / ${totalRulePages} (${totalRuleCount})</span>
+            <button id="rules-next-btn" class="px-2 py-1 bg-gray-700 rounded hover:bg-gray-600 disabled:opacity-50 disabled:cursor-not-allowed" ${rulesPage === totalRulePages ? 'disabled' : ''}>
+                <i class="fas fa-chevron-right"></i>
+            </button>
+        `;
+    }
+
+    async function fetchSelectedRule(force) {
+        if (!selectedRuleId) {
+            selectedRule = null;
+            return;
+        }
+        if (!force && selectedRule && selectedRule.rule_id === selectedRuleId) return;
+        const rule = await api.get(`/api/rules/${selectedRuleId}`);
+        selectedRule = rule.rule_id ? rule : null;
+    }
+
     async function fetchAndRenderRules() {
         try {
-            currentRules = await api.get('/api/rules');
+            const params = new URLSearchParams({
+                page: rulesPage,
+                limit: rulesPerPage,
+                q: ruleSearch,
+                fields: RULE_LIST_FIELDS
+            });
+            const url = `/api/rules?${params.toString()}`;
+            // Revalidate the list on screen; a 304 means the rules have not changed since
+            const headers = (url === rulesListUrl && rulesEtag) ? { 'If-None-Match': rulesEtag } : {};
+            const response = await fetch(url, { headers, cache: 'no-store' });
+            const changed = response.status !== 304;
+            if (changed) {
+                const data = await response.json();
+                currentRules = data.rules;
+                totalRulePages = Math.max(data.pages, 1);
+                totalRuleCount = data.total;
+                rulesListUrl = url;
+                rulesEtag = response.headers.get('ETag');
+                if (rulesPage > totalRulePages) { // The page emptied, e.g. after a delete
+                    rulesPage = totalRulePages;
+                    return fetchAndRenderRules();
+                }
+            }
+            await fetchSelectedRule(changed);
             renderRulesList();
-            const selectedRule = currentRules.find(r => r.rule_id === selectedRuleId);
+            renderRulesPagination();
             displayRuleInEditor(selectedRule);
         } catch (error) {
             console.error("Failed to fetch rules:", error);
@@ -391,7 +456,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // Handle copy button click
         if (e.target.closest('.copy-rule-btn')) {
             try {
-                const newRuleData = { ...rule };
+                const newRuleData = { ...(await api.get(`/api/rules/${ruleId}`)) };
                 delete newRuleData.rule_id; // Remove id to create a new one
                 newRuleData.name = `${rule.name}-bak`;
                 const newRule = await api.post('/api/rules', newRuleData);
@@ -411,7 +476,9 @@ document.addEventListener('DOMContentLoaded', () => {
             if (rule) {
                 rule.is_enabled = checkbox.checked;
                 try {
-                    await api.put(`/api/rules/${ruleId}`, rule);
+                    const fullRule = await api.get(`/api/rules/${ruleId}`);
+                    fullRule.is_enabled = checkbox.checked;
+                    await api.put(`/api/rules/${ruleId}`, fullRule);
                     showToast(`Rule '${rule.name}' ${rule.is_enabled ? 'enabled' : 'disabled'}.`);
                     if (statusText.textContent === 'Running') {
                         await api.post('/api/control/stop');
@@ -701,20 +768,39 @@ document.addEventListener('DOMContentLoaded', () => {
         return `${year}-${month}-${day} ${hour}:${minute}:${second}`;
     }
 
+    function formatBytes(bytes) {
+        const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+        let value = bytes || 0;
+        let unit = 0;
+        while (value >= 1024 && unit < units.length - 1) {
+            value /= 1024;
+            unit++;
+        }
+        return `${unit ? value.toFixed(1) : value} ${units[unit]}`;
+    }
+
+    function setModalLogOffset(offset) {
+        modalLogOffset = offset;
+        modalLoadEarlierBtn.classList.toggle('hidden', offset <= 0);
+    }
+
     function renderLogs(sessions) {
         logTableBody.innerHTML = '';
 
         if (!sessions || sessions.length === 0) {
             const noLogsMessage = translations.noLogsMessage || 'No log sessions found.';
-            logTableBody.innerHTML = `<tr><td colspan="2" class="text-center py-4">${noLogsMessage}</td></tr>`;
+            logTableBody.innerHTML = `<tr><td colspan="4" class="text-center py-4">${noLogsMessage}</td></tr>`;
             return;
         }
 
-        sessions.forEach(sessionId => {
+        sessions.forEach(session => {
+            const sessionId = session.task_id;
             const row = document.createElement('tr');
             row.className = 'bg-gray-800 border-b border-gray-700 hover:bg-gray-600';
             row.innerHTML = `
                 <td class="px-6 py-4 font-medium whitespace-nowrap">${formatTaskId(sessionId)}</td>
+                <td class="px-6 py-4">${session.packets}</td>
+                <td class="px-6 py-4 whitespace-nowrap">${formatBytes(session.log_bytes + session.pcap_bytes)}</td>
                 <td class="px-6 py-4">
                     <button class="view-log-details-btn bg-blue-600 hover:bg-blue-700 text-white text-xs py-1 px-2 rounded" data-task-id="${sessionId}">${translations.logDetailsBtn || 'Details'}</button>
                     <button class="delete-log-btn bg-red-600 hover:bg-red-700 text-white text-xs py-1 px-2 rounded ml-2" data-task-id="${sessionId}">${translations.logDeleteBtn || 'Delete'}</button>
@@ -773,7 +859,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         } catch (error) {
             console.error("Failed to fetch logs:", error);
-            logTableBody.innerHTML = '<tr><td colspan="2" class="text-center text-red-400 p-4">Failed to load log sessions.</td></tr>';
+            logTableBody.innerHTML = '<tr><td colspan="4" class="text-center text-red-400 p-4">Failed to load log sessions.</td></tr>';
         }
     }
 
@@ -802,9 +888,26 @@ document.addEventListener('DOMContentLoaded', () => {
             try {
                 const details = await api.get(`/api/logs/${taskId}`);
                 modalTaskId.textContent = formatTaskId(taskId);
+                // Only the tail of task.log is sent; earlier parts are loaded on demand
                 modalLogContent.textContent = details.log_content || 'No log entries found.';
-                // Assuming only one pcap file named 'capture.pcap'
-                modalDownloadLink.href = `/api/logs/${taskId}/download/capture.pcap`;
+                modalLogTaskId = taskId;
+                setModalLogOffset(details.log_offset || 0);
+                // A single capture.pcap, or rotated capture-NNNN.pcap[.gz] segments
+                const pcapFiles = details.pcap_files || [];
+                modalDownloadLink.href = `/api/logs/${taskId}/download/${pcapFiles[pcapFiles.length - 1] || 'capture.pcap'}`;
+                modalPcapSegments.innerHTML = '';
+                if (pcapFiles.length > 1) {
+                    pcapFiles.forEach(name => {
+                        const link = document.createElement('a');
+                        link.href = `/api/logs/${taskId}/download/${name}`;
+                        link.textContent = name;
+                        link.className = 'mr-3 underline hover:text-white';
+                        modalPcapSegments.appendChild(link);
+                    });
+                }
+                modalPcapSegments.classList.toggle('hidden', pcapFiles.length <= 1);
+                modalPcapQnameInput.value = '';
+                updateFilteredPcapLink();
                 modal.classList.remove('hidden');
                 modal.classList.add('flex');
             } catch (error) {
@@ -825,6 +928,24 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    function updateFilteredPcapLink() {
+        const params = new URLSearchParams({ qname: modalPcapQnameInput.value.trim() });
+        modalDownloadFilteredLink.href = `/api/logs/${modalLogTaskId}/pcap?${params.toString()}`;
+    }
+
+    modalPcapQnameInput.addEventListener('input', updateFilteredPcapLink);
+
+    modalLoadEarlierBtn.addEventListener('click', async () => {
+        try {
+            const params = new URLSearchParams({ end: modalLogOffset });
+            const log = await api.get(`/api/logs/${modalLogTaskId}/log?${params.toString()}`);
+            modalLogContent.textContent = log.content + modalLogContent.textContent;
+            setModalLogOffset(log.offset);
+        } catch (error) {
+            alert(`Failed to load earlier log entries for task ${modalLogTaskId}`);
+        }
+    });
+
     modalCloseBtn.addEventListener('click', () => {
         modal.classList.add('hidden');
         modal.classList.remove('flex');
@@ -859,6 +980,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    ruleSearchInput.addEventListener('input', () => {
+        clearTimeout(ruleSearchTimeout);
+        ruleSearchTimeout = setTimeout(() => {
+            ruleSearch = ruleSearchInput.value.trim();
+            rulesPage = 1;
+            fetchAndRenderRules();
+        }, 300);
+    });
+
+    rulesPagination.addEventListener('click', (e) => {
+        if (e.target.closest('#rules-prev-btn') && rulesPage > 1) {
+            rulesPage--;
+            fetchAndRenderRules();
+        } else if (e.target.closest('#rules-next-btn') && rulesPage < totalRulePages) {
+            rulesPage++;
+            fetchAndRenderRules();
+        }
+    });
+
     langEnBtn.addEventListener('click', () => setLanguage('en'));
     langZhBtn.addEventListener('click', () => setLanguage('zh'));
 
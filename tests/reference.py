@@ -0,0 +1,60 @@
+# An independent encoding of rule response records: the oracle for the records
+# both response paths produce through dns_encoder.
+from scapy.all import Ether, DNS, DNSRR, DNSRROPT
+
+def _record_fields(section):
+    return [(rr.fields.get('rrname'), rr.type, rr.fields.get('rclass'), rr.fields.get('ttl'), rr.fields.get('rdata'))
+            for rr in section or []]
+
+def _query_edns_size(query):
+    return next((rr.rclass for rr in query[DNS].ar or [] if rr.type == 41), 0)
+
+def reference_records(query, rule):
+    """
+    The answer, authority and additional records (each a list of field tuples)
+    of an untruncated response to 'query', built from the rule with plain Scapy
+    records and no compression, then dissected. It is independent of
+    dns_encoder, which both response paths use. The OPT record is only expected
+    in answers to EDNS queries.
+    """
+    qd = query[DNS].qd
+    sections, opt = [], None
+    for key in ('dns_answers', 'dns_authority', 'dns_additional'):
+        records = []
+        for rr_conf in rule['response_action'].get(key) or []:
+            if rr_conf.get('type') == 41:
+                opt = opt or DNSRROPT(rclass=rr_conf.get('udp_payload_size', 1232))
+                continue
+            name_conf = rr_conf.get('name', {})
+            name = name_conf.get('value') if name_conf.get('mode') == 'custom' else qd.qname
+            records.append(DNSRR(rrname=name, type=rr_conf['type'], ttl=rr_conf.get('ttl'), rdata=rr_conf.get('rdata')))
+        sections.append(records)
+    if opt is not None and _query_edns_size(query):
+        sections[2].append(opt)
+    message = DNS(bytes(DNS(qd=qd, an=sections[0] or None, ns=sections[1] or None, ar=sections[2] or None)))
+    return [_record_fields(message.an), _record_fields(message.ns), _record_fields(message.ar)]
+
+def check_records(query, rule, frame):
+    """
+    Decodes a response frame and checks its records against reference_records():
+    records may only be left out from the end (the OPT record stays), the message
+    must fit the query's UDP size limit, and TC must be set exactly when an
+    answer or authority record was left out.
+    """
+    response = Ether(frame)[DNS]
+    actual = [_record_fields(response.an), _record_fields(response.ns), _record_fields(response.ar)]
+    expected = reference_records(query, rule)
+    actual_opt = [rr for rr in actual[2] if rr[1] == 41]
+    expected_opt = [rr for rr in expected[2] if rr[1] == 41]
+    actual[2] = [rr for rr in actual[2] if rr[1] != 41]
+    expected[2] = [rr for rr in expected[2] if rr[1] != 41]
+    if actual_opt != expected_opt:
+        return False
+    complete = True
+    for got, wanted in zip(actual, expected):
+        if got != wanted[:len(got)] or (got and not complete):
+            return False
+        complete = complete and len(got) == len(wanted)
+    dropped_answers = len(actual[0]) < len(expected[0]) or len(actual[1]) < len(expected[1])
+    limit = max(_query_edns_size(query), 512) if _query_edns_size(query) else 512
+    return bool(response.tc) == dropped_answers and len(bytes(response)) <= limit
@@ -0,0 +1,97 @@
+import json
+import pytest
+import app
+import log_manager
+import rules_manager
+
+def rule(rule_id, qname, priority=1):
+    return {"rule_id": rule_id, "name": f"rule {rule_id}", "is_enabled": True, "priority": priority,
+            "trigger_condition": {"dns": {"qname": qname, "qtype": 1}}, "response_action": {}}
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rules_manager, 'rules_loaded', False)
+    monkeypatch.setattr(log_manager, 'session_index', None)
+    rules_manager.activate_rules([])
+    yield tmp_path
+    rules_manager.flush_rules()
+    rules_manager.stop_watching.set()
+    if rules_manager.watcher_thread is not None:
+        rules_manager.watcher_thread.join()
+    if rules_manager.cache_writer is not None:
+        rules_manager.cache_writer.join()
+    rules_manager.activate_rules([])
+
+@pytest.fixture
+def client(workdir):
+    return app.app.test_client()
+
+def write_rules(rules):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump(rules, f)
+
+def test_rules_load_on_the_first_request(client):
+    write_rules([rule("a", "a.example"), rule("b", "b.example")])
+    response = client.get('/api/rules')
+    assert [r['rule_id'] for r in response.get_json()['rules']] == ["a", "b"]
+    assert rules_manager.watcher_thread.is_alive()
+
+def test_unloadable_rules_file_answers_503_and_is_not_overwritten(client):
+    write_rules([rule("a", "a.example", priority="high")])
+    assert client.get('/api/rules').status_code == 503
+    assert client.post('/api/rules', json=rule("b", "b.example")).status_code == 503
+    with open(rules_manager.RULES_FILE) as f:
+        assert [r['rule_id'] for r in json.load(f)] == ["a"]
+
+def test_rules_are_paged_searched_and_projected(client):
+    write_rules([rule(f"r{i}", f"host{i}.example") for i in range(120)])
+    page = client.get('/api/rules?page=2&limit=50').get_json()
+    assert [r['rule_id'] for r in page['rules']] == [f"r{i}" for i in range(50, 100)]
+    assert (page['page'], page['pages'], page['total']) == (2, 3, 120)
+    found = client.get('/api/rules?q=HOST11&fields=rule_id,name&limit=0').get_json()
+    assert found['rules'] == [{"rule_id": f"r{i}", "name": f"rule r{i}"} for i in [11] + list(range(110, 120))]
+    assert found['pages'] == 1
+
+def test_rules_etag_answers_304_until_an_edit(client):
+    write_rules([rule("a", "a.example")])
+    first = client.get('/api/rules')
+    etag = first.headers['ETag']
+    assert client.get('/api/rules', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/rules/a', headers={'If-None-Match': etag}).status_code == 304
+    assert client.post('/api/rules', json=rule("b", "b.example")).status_code == 201
+    changed = client.get('/api/rules', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert changed.get_json()['total'] == 2
+
+def write_sessions(workdir, line_counts):
+    for i, lines in enumerate(line_counts):
+        task_dir = workdir / log_manager.LOGS_DIR / f"2024010100000{i}"
+        task_dir.mkdir(parents=True)
+        (task_dir / "task.log").write_text(''.join(f"line {n}\n" for n in range(lines)))
+
+def test_log_sessions_are_sorted_and_paged(client, workdir):
+    write_sessions(workdir, [5, 50, 20])
+    page = client.get('/api/logs?sort=size&order=desc&limit=2').get_json()
+    assert [s['task_id'] for s in page['sessions']] == ["20240101000001", "20240101000002"]
+    assert (page['pages'], page['total']) == (2, 3)
+    last = client.get('/api/logs?sort=id&order=asc&limit=2&page=2').get_json()
+    assert [s['task_id'] for s in last['sessions']] == ["20240101000002"]
+
+def test_task_log_is_read_in_ranges(client, workdir):
+    write_sessions(workdir, [3])
+    log = client.get('/api/logs/20240101000000/log?offset=0&length=7').get_json()
+    assert (log['content'], log['next_offset'], log['size']) == ("line 0\n", 7, 21)
+    assert client.get('/api/logs/20240101000009/log').status_code == 404
+
+def test_filtered_pcap_needs_an_indexed_capture(client, workdir):
+    write_sessions(workdir, [1])
+    response = client.get('/api/logs/20240101000000/pcap?rule_id=r1')
+    assert response.status_code == 404
+
+def test_metrics_endpoint_works_before_the_engine_is_loaded(client):
+    write_rules([rule("a", "a.example")])
+    response = client.get('/api/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert "\njanusdns_running 0\n" in text and "\njanusdns_rules_active 1\n" in text
@@ -0,0 +1,95 @@
+import struct
+import pytest
+from scapy.all import DNS
+import dns_encoder
+
+QUESTION = b'\x03www\x07example\x03com\x00\x00\x01\x00\x01'
+
+def message(records, question=QUESTION, edns_size=0):
+    """
+    Assembles a response around the encoded records and dissects it with Scapy.
+    """
+    counts, block, truncated = dns_encoder.encode_records(records, dns_encoder.DNS_HEADER_LEN + len(question),
+                                                          edns_size)
+    header = struct.pack('!HHHHHH', 1, 0x8000 | (0x0200 if truncated else 0), 1, *counts)
+    return DNS(header + question + block), truncated
+
+def names(section):
+    return [(rr.rrname, rr.type, rr.rdata) for rr in section if rr.type != dns_encoder.TYPE_OPT]
+
+def referral(count):
+    return {
+        "dns_authority": [{"name": {"mode": "custom", "value": "example.net"}, "type": 2, "ttl": 3600,
+                           "rdata": f"ns{i}.example.net"} for i in range(count)],
+        "dns_additional": [{"name": {"mode": "custom", "value": f"ns{i}.example.net"}, "type": 1, "ttl": 3600,
+                            "rdata": f"192.0.2.{i + 1}"} for i in range(count)] +
+                          [{"name": {"mode": "custom", "value": f"ns{i}.example.net"}, "type": 28, "ttl": 3600,
+                            "rdata": f"2001:db8::{i + 1:x}"} for i in range(count)] +
+                          [{"type": 41, "udp_payload_size": 1232}],
+    }
+
+def test_inherited_names_point_to_the_question():
+    records = dns_encoder.compile_records({"dns_answers": [
+        {"name": {"mode": "inherit"}, "type": 1, "ttl": 60, "rdata": "192.0.2.1"},
+        {"name": {"mode": "inherit"}, "type": 5, "ttl": 60, "rdata": "alias.example.com"},
+    ]})
+    response, truncated = message(records)
+    assert not truncated
+    assert names(response.an) == [(b'www.example.com.', 1, '192.0.2.1'),
+                                  (b'www.example.com.', 5, b'alias.example.com.')]
+    assert records.block.count(dns_encoder.QNAME_POINTER) == 2
+
+def test_shared_suffixes_are_compressed_for_any_question_length():
+    records = dns_encoder.compile_records(referral(4))
+    expected = None
+    for question in (QUESTION, b'\x01a\x00\x00\x01\x00\x01', b'\x3f' + b'x' * 63 + QUESTION):
+        response, _ = message(records, question, edns_size=4096)
+        decoded = (names(response.ns), names(response.ar))
+        assert expected is None or decoded == expected
+        expected = decoded
+    assert expected[0][0] == (b'example.net.', 2, b'ns0.example.net.')
+    assert expected[1][3] == (b'ns3.example.net.', 1, '192.0.2.4')
+    # Each NS rdata is its own label plus a pointer, not a full name
+    assert len(records.block) < sum(len(name) + 12 for name, _, _ in expected[0] + expected[1])
+
+def test_opt_record_only_for_edns_queries_and_last():
+    records = dns_encoder.compile_records(referral(2))
+    plain, _ = message(records)
+    assert all(rr.type != dns_encoder.TYPE_OPT for rr in plain.ar)
+    edns, _ = message(records, edns_size=1232)
+    assert edns.ar[-1].type == dns_encoder.TYPE_OPT and edns.ar[-1].rclass == 1232
+    assert edns.arcount == len(plain.ar) + 1
+
+def test_additional_records_are_dropped_without_tc():
+    records = dns_encoder.compile_records(referral(13))
+    response, truncated = message(records)
+    assert not truncated
+    assert len(response.ns) == 13 and len(response.ar) < 26
+    assert len(bytes(response)) <= dns_encoder.CLASSIC_UDP_SIZE
+
+def test_answers_that_do_not_fit_set_tc():
+    records = dns_encoder.compile_records({"dns_answers": [
+        {"name": {"mode": "inherit"}, "type": 16, "ttl": 60, "rdata": "x" * 200} for _ in range(4)]})
+    response, truncated = message(records)
+    assert truncated and response.ancount == 2
+    _, truncated = message(records, edns_size=4096)
+    assert not truncated
+
+def test_small_edns_buffers_count_as_512():
+    records = dns_encoder.compile_records(referral(13))
+    tiny, _ = message(records, edns_size=100)
+    plain, _ = message(records)
+    assert len(tiny.ar) == len(plain.ar) + 1  # The same glue, plus the OPT record
+
+def test_inherited_names_need_a_question():
+    records = dns_encoder.compile_records({"dns_answers": [
+        {"name": {"mode": "inherit"}, "type": 1, "ttl": 60, "rdata": "192.0.2.1"}]})
+    assert dns_encoder.encode_records(records, dns_encoder.DNS_HEADER_LEN, 0) is None
+
+def test_invalid_records_raise_value_error():
+    with pytest.raises(ValueError):
+        dns_encoder.compile_records({"dns_answers": [
+            {"name": {"mode": "custom", "value": "x" * 64 + ".com"}, "type": 1, "ttl": 60, "rdata": "192.0.2.1"}]})
+    with pytest.raises(ValueError):
+        dns_encoder.compile_records({"dns_answers": [
+            {"name": {"mode": "inherit"}, "type": 1, "ttl": 60, "rdata": "not an address"}]})
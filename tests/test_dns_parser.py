@@ -0,0 +1,59 @@
+import socket
+from scapy.all import Ether, IP, IPv6, UDP, TCP, DNS, DNSQR, DNSRROPT, Raw
+from scapy.layers.l2 import Dot1Q, Dot1AD
+import dns_parser
+
+ETHER = Ether(src="02:00:00:00:00:02", dst="02:00:00:00:00:03")  # Explicit, so Scapy never resolves addresses
+
+def query(l3=None, l2=None, **dns_fields):
+    dns_fields.setdefault('qd', DNSQR(qname="www.Example.com", qtype=28))
+    l2 = l2 if l2 is not None else ETHER
+    l3 = l3 if l3 is not None else IP(src="10.0.0.1", dst="10.0.0.53", ttl=42)
+    return bytes(l2 / l3 / UDP(sport=40000, dport=53) / DNS(id=0x1234, rd=1, **dns_fields))
+
+def test_parses_ipv4_query():
+    parsed = dns_parser.parse_frame(query())
+    assert parsed.ip_src == socket.inet_aton("10.0.0.1")
+    assert parsed.dst_ip == "10.0.0.53"
+    assert parsed.src_mac == "02:00:00:00:00:02"
+    assert (parsed.ttl, parsed.proto, parsed.sport, parsed.dport) == (42, 17, 40000, 53)
+    assert (parsed.dns_id, parsed.flag(8), parsed.qr, parsed.qdcount) == (0x1234, 1, 0, 1)
+    assert (parsed.qname, parsed.qtype, parsed.qclass) == (b"www.Example.com.", 28, 1)
+    assert parsed.vlan == b'' and parsed.edns_size == 0
+    assert parsed.ip_version == 4
+
+def test_question_is_the_wire_question():
+    frame = query()
+    parsed = dns_parser.parse_frame(frame)
+    assert parsed.question == b'\x03www\x07Example\x03com\x00\x00\x1c\x00\x01'
+    assert frame.endswith(parsed.question)
+
+def test_parses_ipv6_query_with_hop_limit():
+    parsed = dns_parser.parse_frame(query(IPv6(src="fd00::1", dst="fd00::53", hlim=7)))
+    assert parsed.ip_version == 6
+    assert parsed.src_ip == "fd00::1"
+    assert parsed.ttl == 7 and parsed.proto == 17
+
+def test_keeps_vlan_tags_outermost_first():
+    l2 = ETHER / Dot1AD(vlan=10) / Dot1Q(vlan=100, prio=3)
+    parsed = dns_parser.parse_frame(query(l2=l2))
+    assert parsed.vlan == b'\x88\xa8\x00\x0a\x81\x00\x60\x64'
+    assert parsed.qname == b"www.Example.com."
+
+def test_reads_edns_buffer_size():
+    parsed = dns_parser.parse_frame(query(ar=DNSRROPT(rclass=4096)))
+    assert parsed.edns_size == 4096
+
+def test_rejects_what_it_cannot_answer():
+    frame = query()
+    assert dns_parser.parse_frame(frame[:-3]) is None  # Question cut short
+    assert dns_parser.parse_frame(query(qd=[])) is None  # No question
+    assert dns_parser.parse_frame(query(IP(src="10.0.0.1", dst="10.0.0.53", flags="MF"))) is None
+    assert dns_parser.parse_frame(bytes(ETHER / IP() / UDP(sport=53, dport=5353) / DNS())) is None
+    assert dns_parser.parse_frame(bytes(ETHER / IP() / TCP(dport=53))) is None
+
+def test_rejects_compressed_question_names():
+    header = b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+    frame = ETHER / IP(dst="10.0.0.53") / UDP(sport=40000, dport=53)
+    assert dns_parser.parse_frame(bytes(frame / Raw(header + b'\x03www\x00\x00\x01\x00\x01'))) is not None
+    assert dns_parser.parse_frame(bytes(frame / Raw(header + b'\xc0\x0c\x00\x01\x00\x01'))) is None
@@ -0,0 +1,52 @@
+import os
+import pytest
+from scapy.all import Ether, rdpcap
+import benchmark
+import packet_handler
+import rules_manager
+
+# Queries to 10.0.0.53 / fd00::53, untagged and VLAN-tagged, with and without EDNS,
+# plus frames neither engine may answer: another destination, a response, TCP and
+# a truncated DNS header.
+QUERIES_PCAP = os.path.join(os.path.dirname(__file__), "data", "queries.pcap")
+IFACE = 'lo'
+
+def rule(rule_id, shape, qname, **conditions):
+    rule = benchmark.make_rule(shape)
+    rule['rule_id'] = rule_id
+    rule['trigger_condition']['dns']['qname'] = qname
+    rule['trigger_condition'].update(conditions)
+    return rule
+
+@pytest.fixture
+def replay(monkeypatch):
+    frames = [bytes(packet) for packet in rdpcap(QUERIES_PCAP)]
+    monkeypatch.setattr(packet_handler, 'local_ips', packet_handler.local_ips)
+    monkeypatch.setattr(packet_handler, 'local_ips_packed', packet_handler.local_ips_packed)
+    packet_handler.set_local_ips({"10.0.0.53", "fd00::53"})
+    rules_manager.activate_rules([
+        rule("host0", "nxdomain", "host0.example.com"),
+        rule("host1", "answers", "host1.example.com", l4={"src_port": "1024-30000"}),
+        rule("host2", "referral", "host2.example.com"),
+        rule("wild", "answers", "*.wild.example.com"),
+        rule("subnet-v4", "nxdomain", "subnet.example.com", l3={"src_ip": "10.0.1.0/24"}),
+        rule("subnet-v6", "answers", "subnet.example.com", l3={"src_ip": "fd00:1::/32"}),
+    ])
+    yield frames
+    rules_manager.activate_rules([])
+
+def test_both_engines_answer_a_capture_identically(replay):
+    answered = set()
+    for frame in replay:
+        packet = Ether(frame)
+        packet.sniffed_on = IFACE
+        expected = packet_handler.respond_to_packet(packet)
+        result = packet_handler.respond_to_frame(frame, IFACE)
+        assert (result and result[1:]) == expected
+        if expected:
+            answered.add(expected[0]['rule_id'])
+    assert answered == {"host0", "host1", "host2", "wild", "subnet-v4", "subnet-v6"}
+
+def test_unanswerable_frames_are_ignored(replay):
+    for frame in replay[-4:]:
+        assert packet_handler.respond_to_frame(frame, IFACE) is None
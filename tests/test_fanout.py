@@ -0,0 +1,81 @@
+import multiprocessing
+import pickle
+import pytest
+import fanout
+import rules_manager
+
+def rule(rule_id, qname, priority=1):
+    return {"rule_id": rule_id, "is_enabled": True, "priority": priority,
+            "trigger_condition": {"dns": {"qname": qname, "qtype": 1}}, "response_action": {}}
+
+@pytest.fixture
+def control_plane(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rules_manager, 'SAVE_DELAY', 3600)  # Nothing needs to reach the disk
+    monkeypatch.setattr(rules_manager, 'rules_loaded', False)
+    rules_manager.replace_rules([rule("a", "a.example"), rule("b", "b.example", priority=2)])
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    control = multiprocessing.RawArray('Q', 2)
+    yield reader, writer, control
+    with rules_manager._write_lock:
+        if rules_manager.save_timer is not None:
+            rules_manager.save_timer.cancel()
+            rules_manager.save_timer = None
+    if rules_manager.cache_writer is not None:
+        rules_manager.cache_writer.join()
+    rules_manager.activate_rules([])
+
+def sync(synced, writer, generation, control):
+    """
+    One round of the control plane's loop: sends what changed since 'synced'.
+    """
+    current, edits = rules_manager.edits_since(synced.version)
+    if edits is None:
+        control[fanout.SNAPSHOT] = generation
+        fanout._send_rules(writer, generation, 'snapshot', pickle.dumps(current))
+    else:
+        fanout._send_rules(writer, generation, 'edits', pickle.dumps(edits))
+    return current, edits
+
+def rule_ids(ruleset):
+    return [r['rule_id'] for r in ruleset.active]
+
+def test_edits_are_sent_as_edits_and_rebuild_the_same_snapshot(control_plane):
+    reader, writer, control = control_plane
+    synced = rules_manager.snapshot
+    worker_copy = pickle.loads(pickle.dumps(synced))
+    rules_manager.add_rule(rule("c", "c.example", priority=0))
+    rules_manager.update_rule("a", rule("a", "a2.example", priority=3))
+    rules_manager.delete_rule("b")
+    control_side, edits = sync(synced, writer, 1, control)
+    assert [change[0] for change in edits] == ['add', 'update', 'delete']
+
+    rules_manager.activate_snapshot(worker_copy)  # This process plays the worker now
+    fanout._receive_rules(reader, control)
+    assert rule_ids(rules_manager.snapshot) == rule_ids(control_side) == ["c", "a"]
+    assert rules_manager.snapshot.index.keys() == control_side.index.keys()
+
+def test_a_full_activation_sends_the_snapshot_and_supersedes_queued_edits(control_plane):
+    reader, writer, control = control_plane
+    synced = rules_manager.snapshot
+    rules_manager.add_rule(rule("c", "c.example"))
+    synced, edits = sync(synced, writer, 1, control)
+    assert edits is not None
+    rules_manager.replace_rules([rule("z", "z.example")])
+    synced, edits = sync(synced, writer, 2, control)
+    assert edits is None
+
+    rules_manager.activate_rules([])
+    fanout._receive_rules(reader, control)  # The edits: skipped, a newer snapshot follows
+    assert rules_manager.snapshot.rules == ()
+    fanout._receive_rules(reader, control)
+    assert rule_ids(rules_manager.snapshot) == ["z"]
+
+def test_edit_log_only_reaches_back_so_far(control_plane, monkeypatch):
+    monkeypatch.setattr(rules_manager, 'edit_log', rules_manager.deque(maxlen=2))
+    synced = rules_manager.snapshot
+    for i in range(3):
+        rules_manager.add_rule(rule(f"r{i}", f"r{i}.example"))
+    assert rules_manager.edits_since(synced.version)[1] is None
+    assert len(rules_manager.edits_since(synced.version + 1)[1]) == 2
+    assert rules_manager.edits_since(rules_manager.snapshot.version) == (rules_manager.snapshot, [])
@@ -0,0 +1,160 @@
+import errno
+import time
+import pytest
+import log_manager
+
+RULE = {"rule_id": "r1", "name": "rule one"}
+
+def frame(qname):
+    """
+    A minimal Ethernet/IPv4/UDP DNS query, enough for the writer to index its qname.
+    """
+    labels = b''.join(bytes([len(label)]) + label.encode() for label in qname.split('.')) + b'\x00'
+    dns = b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' + labels + b'\x00\x01\x00\x01'
+    udp = b'\x9c\x40\x00\x35' + (8 + len(dns)).to_bytes(2, 'big') + b'\x00\x00'
+    ip = (b'\x45\x00' + (20 + len(udp) + len(dns)).to_bytes(2, 'big') + b'\x00\x00\x00\x00\x40\x11\x00\x00'
+          + bytes([10, 0, 0, 7, 10, 0, 0, 53]))
+    return b'\x02\x00\x00\x00\x00\x03\x02\x00\x00\x00\x00\x02\x08\x00' + ip + udp + dns
+
+@pytest.fixture
+def logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(log_manager, 'session_index', None)
+    yield tmp_path / log_manager.LOGS_DIR
+    log_manager.stop_log_session()
+    monkeypatch.undo()
+    log_manager.current_task_id = log_manager.log_file_path = None
+
+def log_pair(qname, rule=RULE):
+    query = frame(qname)
+    log_manager.log_triggered_rule(rule, query)
+    log_manager.save_pcap_files(rule, query, query)
+
+def session(task_id):
+    return next(entry for entry in log_manager.get_log_sessions() if entry['task_id'] == task_id)
+
+def test_writer_flushes_everything_on_stop(logs):
+    task_id = log_manager.start_new_log_session()
+    for i in range(3):
+        log_pair(f"host{i}.example.com")
+    log_manager.stop_log_session()
+    entry = session(task_id)
+    assert (entry['triggered'], entry['packets'], entry['error']) == (3, 6, None)
+    assert entry['ended'] is not None
+    log_lines = (logs / task_id / "task.log").read_text().splitlines()
+    assert len(log_lines) == 3 and "host2.example.com" in log_lines[2]
+    assert entry['pcap_bytes'] == (logs / task_id / "capture.pcap").stat().st_size
+
+def test_failed_writer_marks_the_session_and_stop_does_not_hang(logs, monkeypatch):
+    def disk_full(self, data, meta):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(log_manager.CaptureSegments, 'write', disk_full)
+    monkeypatch.setattr(log_manager, 'LOG_QUEUE_SIZE', 4)
+    monkeypatch.setattr(log_manager, 'WRITER_STOP_TIMEOUT', 0.2)
+    task_id = log_manager.start_new_log_session()
+    log_pair("example.com")
+    log_manager.writer_thread.join(timeout=5)
+    for _ in range(10):  # Fills the queue nobody reads any more
+        log_pair("example.com")
+    started = time.monotonic()
+    log_manager.stop_log_session()
+    assert time.monotonic() - started < 1
+    assert "No space left" in session(task_id)['error']
+    assert log_manager.writer_stats['dropped'] >= 10
+
+def eventually(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_rotation_compression_and_retention(logs, monkeypatch):
+    monkeypatch.setattr(log_manager, 'PCAP_ROTATE_BYTES', 1000)
+    monkeypatch.setattr(log_manager, 'PCAP_COMPRESS', True)
+    monkeypatch.setattr(log_manager, 'PCAP_KEEP_SEGMENTS', 2)
+    task_id = log_manager.start_new_log_session()
+    for i in range(40):
+        log_pair(f"host{i}.example.com")
+    log_manager.stop_log_session()
+    task_dir = logs / task_id
+
+    def compressed():
+        segments = log_manager.list_capture_segments(str(task_dir))
+        # Only what is left on disk counts, with its compressed size
+        return (all(name.endswith(".pcap.gz") for name in segments) and session(task_id)['pcap_bytes']
+                == sum((task_dir / name).stat().st_size for name in segments))
+
+    assert eventually(compressed)
+    segments = log_manager.list_capture_segments(str(task_dir))
+    assert len(segments) == 2
+    assert segments[0] > "capture-0002.pcap.gz"  # The oldest ones are gone
+
+def test_session_index_is_kept_on_disk_and_rebuilt_when_missing(logs):
+    task_id = log_manager.start_new_log_session()
+    for i in range(2):
+        log_pair(f"host{i}.example.com")
+    log_manager.stop_log_session()
+    indexed = session(task_id)
+    log_manager.session_index = None  # A restart reads sessions.json
+    assert session(task_id) == indexed
+
+    (logs / log_manager.SESSION_INDEX_FILE).unlink()
+    log_manager.session_index = None  # sessions.json lost: scanned once and written again
+    rebuilt = session(task_id)
+    for key in ('triggered', 'packets', 'log_bytes', 'pcap_bytes'):
+        assert rebuilt[key] == indexed[key]
+    assert (logs / log_manager.SESSION_INDEX_FILE).exists()
+
+def write_task_log(logs, task_id, lines):
+    (logs / task_id).mkdir(parents=True)
+    (logs / task_id / "task.log").write_bytes(b''.join(b"line %02d\n" % i for i in range(lines)))
+
+def test_log_tail_and_ranges_stop_at_line_boundaries(logs):
+    write_task_log(logs, "20240101000000", 100)  # 8 bytes per line
+    tail = log_manager.read_task_log("20240101000000", length=20)
+    assert (tail['content'], tail['offset'], tail['size']) == ("line 98\nline 99\n", 784, 800)
+    head = log_manager.read_task_log("20240101000000", offset=0, length=20)
+    assert (head['content'], head['next_offset']) == ("line 00\nline 01\n", 16)
+    following = log_manager.read_task_log("20240101000000", offset=head['next_offset'], length=8)
+    assert following['content'] == "line 02\n"
+    before = log_manager.read_task_log("20240101000000", end=tail['offset'], length=12)
+    assert (before['content'], before['offset']) == ("line 97\n", 776)
+
+def test_log_reads_reject_paths_outside_the_logs(logs):
+    write_task_log(logs, "20240101000000", 1)
+    assert log_manager.read_task_log("..") is None
+    assert log_manager.read_task_log("20240101000001") is None
+
+def pcap_qnames(data):
+    """
+    The qname of every record in a pcap stream (queries and responses alike).
+    """
+    assert data.startswith(log_manager.PCAP_GLOBAL_HEADER)
+    qnames, offset = [], len(log_manager.PCAP_GLOBAL_HEADER)
+    while offset < len(data):
+        length = log_manager._pcap_record_header.unpack_from(data, offset)[2]
+        offset += log_manager._pcap_record_header.size
+        qnames.append(log_manager._query_qname(data[offset:offset + length]))
+        offset += length
+    return qnames
+
+def test_filtered_pcap_streams_matching_pairs_across_segments(logs, monkeypatch):
+    monkeypatch.setattr(log_manager, 'PCAP_ROTATE_BYTES', 1000)
+    monkeypatch.setattr(log_manager, 'PCAP_COMPRESS', True)
+    task_id = log_manager.start_new_log_session()
+    for i in range(20):
+        log_pair(f"host{i}.example.com", RULE if i % 2 else {"rule_id": "r2"})
+    log_pair("other.test")
+    log_manager.stop_log_session()
+    assert eventually(lambda: all(name.endswith(".gz") for name in
+                                  log_manager.list_capture_segments(str(logs / task_id))))
+    assert len(log_manager.list_capture_segments(str(logs / task_id))) > 2
+
+    def filtered(**filters):
+        return pcap_qnames(b''.join(log_manager.iter_filtered_pcap(task_id, **filters)))
+
+    assert filtered(rule_id="r2") == [f"host{i}.example.com" for i in range(0, 20, 2) for _ in range(2)]
+    assert filtered(qname="*.Example.com.") == [f"host{i}.example.com" for i in range(20) for _ in range(2)]
+    assert filtered(qname="other.test", rule_id="r1") == ["other.test"] * 2
+    assert filtered(start=time.time() + 60) == []
+    assert log_manager.iter_filtered_pcap("20240101000000") is None
@@ -0,0 +1,60 @@
+import threading
+import time
+import metrics
+
+def exported(text):
+    """
+    Parses the Prometheus text format into {metric with labels: value}.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+def delta(before, after):
+    return {name: value - before.get(name, 0) for name, value in after.items() if value != before.get(name, 0)}
+
+def test_per_thread_counters_are_summed_on_read():
+    before = exported(metrics.render_prometheus())
+
+    def work():
+        for _ in range(1000):
+            metrics.inc('packets_captured')
+        metrics.rule_matched('r"1')
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert delta(before, exported(metrics.render_prometheus())) == {
+        'janusdns_packets_captured_total': 4000,
+        'janusdns_rule_matches_total{rule_id="r\\"1"}': 4,
+    }
+
+def test_latency_histogram_is_cumulative():
+    before = exported(metrics.render_prometheus())
+    metrics.observe_latency(time.time() - 0.003)
+    metrics.observe_latency(time.time() - 5)
+    metrics.observe_latency(None)  # No capture timestamp: not observed
+    changed = delta(before, exported(metrics.render_prometheus()))
+    bucket = 'janusdns_response_latency_seconds_bucket{le="%s"}'
+    assert bucket % 0.001 not in changed
+    assert changed[bucket % 0.005] == changed[bucket % 1.0] == 1
+    assert changed[bucket % '+Inf'] == changed['janusdns_response_latency_seconds_count'] == 2
+    assert 5 < changed['janusdns_response_latency_seconds_sum'] < 6
+
+def test_responder_process_totals_never_go_backwards():
+    before = metrics.snapshot()[0]['responses_sent']
+    worker = metrics._empty()
+    worker[0]['responses_sent'] = 7
+    metrics.set_remote(1, tuple(worker))
+    assert metrics.snapshot()[0]['responses_sent'] == before + 7
+    metrics.retire_remote()  # The worker exited; its totals stay
+    assert metrics.snapshot()[0]['responses_sent'] == before + 7
+
+def test_extra_totals_and_gauges_are_rendered():
+    text = metrics.render_prometheus({"kernel_drops_total": ("Dropped", 3)}, {"running": ("Running", 0)})
+    assert "# TYPE janusdns_kernel_drops_total counter\njanusdns_kernel_drops_total 3\n" in text
+    assert "# TYPE janusdns_running gauge\njanusdns_running 0\n" in text
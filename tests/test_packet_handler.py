@@ -0,0 +1,96 @@
+import threading
+import time
+import pytest
+import packet_handler
+import rules_manager
+
+def rule(rule_id, **conditions):
+    trigger = {"dns": {"qname": f"{rule_id}.example", "qtype": 1}}
+    trigger.update(conditions)
+    return {"rule_id": rule_id, "is_enabled": True, "priority": 1, "trigger_condition": trigger,
+            "response_action": {}}
+
+@pytest.fixture
+def addresses(monkeypatch):
+    monkeypatch.setattr(packet_handler, 'local_ips', packet_handler.local_ips)
+    monkeypatch.setattr(packet_handler, 'local_ips_packed', packet_handler.local_ips_packed)
+    monkeypatch.setattr(packet_handler, 'capture_filter', packet_handler.capture_filter)
+    monkeypatch.setattr(packet_handler, 'capture_filter_source', (None, None))
+    packet_handler.set_local_ips({"10.0.0.53", "fd00::53"})
+    yield
+    rules_manager.activate_rules([])
+
+def test_capture_filter_keeps_only_queries_to_our_addresses(addresses):
+    rules_manager.activate_rules([rule("a"), rule("b")])
+    expression = "udp dst port 53 and (dst host 10.0.0.53 or dst host fd00::53)"
+    assert packet_handler.build_capture_filter() == (
+        f"({expression}) or (vlan and (({expression}) or (vlan and {expression})))")
+
+def test_capture_filter_adds_conditions_every_rule_shares(addresses):
+    rules_manager.activate_rules([
+        rule("a", l3={"src_ip": "10.1.0.0/16"}, l4={"src_port": "1024-65535"}),
+        rule("b", l3={"src_ip": "192.0.2.7"}, l4={"src_port": 5353}),
+        dict(rule("disabled"), is_enabled=False),  # Disabled rules never widen the filter
+    ])
+    expression = packet_handler.build_capture_filter()
+    assert "(src host 192.0.2.7 or src net 10.1.0.0/16)" in expression
+    assert "(src port 5353 or src portrange 1024-65535)" in expression
+
+    rules_manager.activate_rules([rule("a", l3={"src_ip": "10.1.0.0/16"}), rule("b")])
+    assert "src net" not in packet_handler.build_capture_filter()  # Rule b accepts any source
+
+def test_capture_filter_is_rebuilt_only_when_rules_or_addresses_change(addresses):
+    rules_manager.activate_rules([rule("a")])
+    assert packet_handler.refresh_capture_filter()
+    assert not packet_handler.refresh_capture_filter()
+    rules_manager.activate_rules([rule("a", l3={"dst_ip": "10.0.0.53"})])
+    assert packet_handler.refresh_capture_filter()
+    assert "(dst host 10.0.0.53)" in packet_handler.capture_filter
+    packet_handler.set_local_ips({"10.0.0.54"})
+    assert packet_handler.refresh_capture_filter()
+    assert "dst host 10.0.0.54" in packet_handler.capture_filter
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(packet_handler, 'PIPELINE_WORKERS', 2)
+    yield monkeypatch
+    packet_handler.stop_pipeline()
+
+def test_pipeline_drains_everything_queued_before_it_stops(pipeline):
+    handled = []
+    packet_handler.start_pipeline()
+    assert len(packet_handler.pipeline_threads) == 2
+    for i in range(100):
+        packet_handler.dispatch(handled.append, i)
+    packet_handler.stop_pipeline()
+    assert sorted(handled) == list(range(100))
+    assert packet_handler.work_queue is None and not packet_handler.pipeline_threads
+
+def test_full_pipeline_drops_instead_of_blocking_capture(pipeline):
+    pipeline.setattr(packet_handler, 'PIPELINE_QUEUE_SIZE', 2)
+    release = threading.Event()
+    packet_handler.start_pipeline()
+    for _ in range(2):  # Both workers busy
+        packet_handler.dispatch(release.wait)
+    while packet_handler.work_queue.qsize():
+        time.sleep(0.01)
+    for _ in range(5):
+        packet_handler.dispatch(release.wait)
+    assert packet_handler.pipeline_stats['capture_drops'] == 3
+    release.set()
+
+def test_pipeline_worker_survives_a_failing_handler(pipeline):
+    handled = []
+
+    def fail():
+        raise ValueError("bad packet")
+    packet_handler.start_pipeline()
+    packet_handler.dispatch(fail)
+    packet_handler.dispatch(handled.append, 1)
+    packet_handler.stop_pipeline()
+    assert handled == [1]
+
+def test_without_workers_dispatch_runs_inline():
+    handled = []
+    packet_handler.dispatch(handled.append, 1)
+    assert handled == [1]
@@ -0,0 +1,59 @@
+import pytest
+import rate_limiter
+
+@pytest.fixture
+def limits(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: clock[0])
+
+    def configure(client_rate=0.0, client_burst=0, rule_rate=0.0, rule_burst=0, slip=0):
+        monkeypatch.setattr(rate_limiter, 'CLIENT_RATE', client_rate)
+        monkeypatch.setattr(rate_limiter, 'CLIENT_BURST', client_burst)
+        monkeypatch.setattr(rate_limiter, 'RULE_RATE', rule_rate)
+        monkeypatch.setattr(rate_limiter, 'RULE_BURST', rule_burst)
+        monkeypatch.setattr(rate_limiter, 'SLIP', slip)
+        rate_limiter.configure()
+        return clock
+
+    yield configure
+    monkeypatch.undo()
+    rate_limiter.configure()
+
+def verdicts(client, rule_id, count):
+    return [rate_limiter.check(client, rule_id)[1] for _ in range(count)]
+
+def test_disabled_without_rates(limits):
+    limits()
+    assert not rate_limiter.enabled
+
+def test_client_burst_then_refill(limits):
+    clock = limits(client_rate=2, client_burst=3)
+    assert verdicts("10.0.0.1", "r", 4) == [rate_limiter.ALLOW] * 3 + [rate_limiter.DROP]
+    assert rate_limiter.check("10.0.0.2", "r") == (None, rate_limiter.ALLOW)  # Separate bucket
+    clock[0] += 1.0  # Two tokens at 2/s
+    assert verdicts("10.0.0.1", "r", 3) == [rate_limiter.ALLOW] * 2 + [rate_limiter.DROP]
+    assert rate_limiter.check("10.0.0.1", "r") == ('client', rate_limiter.DROP)
+
+def test_rule_limit_does_not_spend_the_client_budget(limits):
+    limits(client_rate=1, client_burst=4, rule_rate=1, rule_burst=1)
+    assert verdicts("10.0.0.1", "busy", 3) == [rate_limiter.ALLOW, rate_limiter.DROP, rate_limiter.DROP]
+    assert rate_limiter.check("10.0.0.1", "busy") == ('rule', rate_limiter.DROP)
+    # Only the one answered query was charged to the client
+    assert verdicts("10.0.0.1", "other", 1) == [rate_limiter.ALLOW]
+    assert [rate_limiter.check("10.0.0.1", f"rule{i}")[1] for i in range(3)] == [
+        rate_limiter.ALLOW, rate_limiter.ALLOW, rate_limiter.DROP]
+
+def test_slip_answers_every_nth_suppressed_query(limits):
+    limits(client_rate=1, client_burst=1, slip=3)
+    assert verdicts("10.0.0.1", "r", 7) == [
+        rate_limiter.ALLOW,
+        rate_limiter.DROP, rate_limiter.DROP, rate_limiter.SLIPPED,
+        rate_limiter.DROP, rate_limiter.DROP, rate_limiter.SLIPPED,
+    ]
+
+def test_least_recent_clients_are_evicted(limits, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'TABLE_SIZE', 2)
+    limits(client_rate=1, client_burst=1)
+    for client in ("a", "b", "a", "c"):  # 'b' is the least recently seen when 'c' arrives
+        rate_limiter.check(client, "r")
+    assert list(rate_limiter.client_buckets.buckets) == ["a", "c"]
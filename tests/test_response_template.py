@@ -0,0 +1,68 @@
+import copy
+import pytest
+from scapy.all import Ether, IP, IPv6, UDP, DNS, DNSQR, DNSRROPT
+from scapy.layers.l2 import Dot1Q, Dot1AD
+import benchmark
+import dns_parser
+import packet_handler
+import reference
+
+IFACE = 'lo'
+
+def queries():
+    """
+    IPv4 and IPv6 queries, untagged and with one or two VLAN tags, with and without EDNS.
+    """
+    frames = []
+    for i, l2_tags in enumerate(((), (Dot1Q(vlan=100),), (Dot1AD(vlan=10), Dot1Q(vlan=20, prio=5)))):
+        for l3 in (IP(src="10.0.0.7", dst="10.0.0.53"), IPv6(src="fd00::7", dst="fd00::53")):
+            for edns in (None, DNSRROPT(rclass=512), DNSRROPT(rclass=4096)):
+                l2 = Ether(src="02:00:00:00:00:02", dst="02:00:00:00:00:03")
+                for tag in l2_tags:
+                    l2 = l2 / tag
+                dns = DNS(id=len(frames), rd=i & 1, cd=1, qd=DNSQR(qname="Host.Example.com"), ar=edns or [])
+                frames.append(bytes(l2 / l3 / UDP(sport=33000 + len(frames), dport=53) / dns))
+    return frames
+
+def dissected(frame):
+    packet = Ether(frame)
+    packet.sniffed_on = IFACE
+    return packet
+
+def parsed(frame):
+    query = dns_parser.parse_frame(frame)
+    query.sniffed_on = IFACE
+    return query
+
+@pytest.mark.parametrize('shape', sorted(benchmark.RESPONSE_SHAPES))
+def test_template_matches_scapy_reference(shape):
+    rule = benchmark.make_rule(shape)
+    assert packet_handler.get_response_template(rule) is not None
+    for frame in queries():
+        expected = bytes(packet_handler.build_response_packet(dissected(frame), rule))
+        assert packet_handler.generate_response(dissected(frame), rule) == expected
+        assert packet_handler.generate_response(parsed(frame), rule) == expected
+
+@pytest.mark.parametrize('shape', sorted(benchmark.RESPONSE_SHAPES))
+def test_records_match_an_independent_encoding(shape):
+    rule = benchmark.make_rule(shape)
+    for frame in queries():
+        response = packet_handler.generate_response(parsed(frame), rule)
+        assert reference.check_records(dissected(frame), rule, response)
+
+def test_inherited_fields_come_from_the_query():
+    rule = benchmark.make_rule('answers')
+    frame = queries()[1]
+    response = Ether(packet_handler.generate_response(parsed(frame), rule))
+    query = Ether(frame)
+    assert response[Ether].dst == query[Ether].src
+    assert response[IP].dst == query[IP].src and response[UDP].dport == query[UDP].sport
+    assert response[UDP].sport == 5353  # Custom
+    assert (response[DNS].id, response[DNS].qr, response[DNS].aa, response[DNS].rd) == (query[DNS].id, 1, 1, 0)
+    assert response[DNS].qd[0].qname == b"Host.Example.com."
+
+def test_unsupported_actions_fall_back_to_scapy():
+    rule = benchmark.make_rule('answers')
+    rule['response_action'] = copy.deepcopy(rule['response_action'])
+    rule['response_action']['l3']['src_ip'] = {'mode': 'custom', 'value': 'not an address'}
+    assert packet_handler.get_response_template(rule) is None
@@ -0,0 +1,229 @@
+import json
+import os
+import random
+import pytest
+from scapy.all import Ether, IP, IPv6, UDP, DNS, DNSQR
+import dns_parser
+import rules_manager
+
+def rule(rule_id, qname, qtype=1, priority=1, **conditions):
+    trigger = {"dns": {"qname": qname, "qtype": qtype}}
+    trigger.update(conditions)
+    return {"rule_id": rule_id, "is_enabled": True, "priority": priority, "trigger_condition": trigger,
+            "response_action": {}}
+
+def query(qname, src="10.0.0.7", qtype=1, sport=40000):
+    l3 = IPv6(src=src, dst="fd00::53") if ':' in src else IP(src=src, dst="10.0.0.53")
+    frame = bytes(Ether(dst="02:00:00:00:00:03") / l3 / UDP(sport=sport, dport=53) / DNS(qd=DNSQR(qname=qname, qtype=qtype)))
+    return dns_parser.parse_frame(frame)
+
+def matched_id(ruleset, packet):
+    matched = rules_manager.find_matching_rule(packet, ruleset)
+    return matched and matched['rule_id']
+
+def test_priority_and_disabled_rules():
+    low = rule("low", "example.com", priority=5)
+    high = rule("high", "example.com", priority=1)
+    disabled = dict(rule("disabled", "example.com", priority=0), is_enabled=False)
+    ruleset = rules_manager.compile_rules([low, high, disabled])
+    assert matched_id(ruleset, query("example.com")) == "high"
+
+def test_exact_index_is_keyed_by_qname_and_qtype():
+    ruleset = rules_manager.compile_rules([rule("a", "Example.com."), rule("aaaa", "example.com", qtype=28)])
+    assert matched_id(ruleset, query("EXAMPLE.com")) == "a"
+    assert matched_id(ruleset, query("example.com", qtype=28)) == "aaaa"
+    assert matched_id(ruleset, query("www.example.com")) is None
+
+def test_exact_rules_win_over_wildcards_and_longest_suffix_wins():
+    ruleset = rules_manager.compile_rules([
+        rule("wide", "*.example.com"),
+        rule("narrow", "*.www.example.com"),
+        rule("exact", "host.www.example.com"),
+    ])
+    assert matched_id(ruleset, query("HOST.www.example.com")) == "exact"
+    assert matched_id(ruleset, query("other.www.example.com")) == "narrow"
+    assert matched_id(ruleset, query("www.example.com")) == "wide"
+    assert matched_id(ruleset, query("example.com")) is None  # A wildcard does not match its apex
+    assert matched_id(ruleset, query("host.www.example.com", qtype=28)) is None
+
+def test_port_ranges():
+    ruleset = rules_manager.compile_rules([rule("high-ports", "example.com", l4={"src_port": "1024-65535"})])
+    assert matched_id(ruleset, query("example.com", sport=1024)) == "high-ports"
+    assert matched_id(ruleset, query("example.com", sport=1023)) is None
+
+def test_source_range_index_agrees_with_a_linear_scan():
+    rng = random.Random(7)
+    rules = []
+    for i in range(3 * rules_manager.RANGE_INDEX_MIN):
+        if i % 3 == 0:
+            subnet = f"10.{rng.randrange(4)}.{rng.randrange(4)}.0/{rng.choice((16, 24, 30))}"
+        elif i % 3 == 1:
+            subnet = f"fd00:{rng.randrange(4):x}::/{rng.choice((32, 48, 120))}"
+        else:
+            subnet = f"10.{rng.randrange(4)}.{rng.randrange(4)}.{rng.randrange(4)}"
+        rules.append(rule(f"r{i}", "example.com", priority=rng.randrange(3), l3={"src_ip": subnet}))
+    ruleset = rules_manager.compile_rules(rules)
+    assert isinstance(ruleset.index[("example.com", 1)], rules_manager.SourceRangeIndex)
+    ordered = sorted(enumerate(rules), key=lambda item: (item[1]['priority'], item[0]))
+    for _ in range(200):
+        if rng.random() < 0.5:
+            src = f"10.{rng.randrange(4)}.{rng.randrange(4)}.{rng.randrange(4)}"
+        else:
+            src = f"fd00:{rng.randrange(4):x}::{rng.randrange(4):x}"
+        packet = query("example.com", src=src)
+        linear = next((r['rule_id'] for _, r in ordered if rules_manager.match_query(packet, r)), None)
+        assert matched_id(ruleset, packet) == linear
+
+def test_source_range_index_stays_n_log_n():
+    # Rules without a source condition, disjoint host routes and nested subnets
+    rules = [rule(f"any{i}", "example.com") for i in range(1000)]
+    rules += [rule(f"host{i}", "example.com", l3={"src_ip": f"10.{i // 256}.{i % 256}.1"}) for i in range(1000)]
+    rules += [rule(f"net{i}", "example.com", l3={"src_ip": f"10.0.0.0/{8 + i % 24}"}) for i in range(1000)]
+    index = rules_manager.compile_rules(rules).index[("example.com", 1)]
+    assert index.size() <= 2 * len(rules) * len(index.starts).bit_length()
+    matched = [entry[0]['rule_id'] for entry in index.lookup(rules_manager.address_key(bytes((10, 0, 3, 1))))]
+    assert matched == [f"any{i}" for i in range(1000)] + ["host3"] + [f"net{i}" for i in range(1000) if 8 + i % 24 <= 22]
+
+@pytest.fixture
+def rules_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rules_manager, 'rules_loaded', False)
+    yield tmp_path
+    if rules_manager.cache_writer is not None:
+        rules_manager.cache_writer.join()
+    rules_manager.activate_rules([])
+
+def write_journal(*entries):
+    with open(rules_manager.JOURNAL_FILE, 'w') as f:
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+def test_journal_replay(rules_dir):
+    base = [rule("a", "a.example"), rule("b", "b.example"), rule("c", "c.example")]
+    write_journal(
+        {"op": "put", "rule_id": "b", "rule": rule("b", "b2.example")},
+        {"op": "delete", "rule_id": "a"},
+        {"op": "put", "rule_id": "d", "rule": rule("d", "d.example")},
+        {"op": "delete", "rule_id": "missing"},
+    )
+    with open(rules_manager.JOURNAL_FILE, 'a') as f:
+        f.write('{"op": "put", "rule_id": "e", "ru')  # Cut short by a crash
+    replayed, applied = rules_manager._replay_journal(base)
+    assert applied == 4
+    assert [(r['rule_id'], r['trigger_condition']['dns']['qname']) for r in replayed] == [
+        ("b", "b2.example"), ("c", "c.example"), ("d", "d.example")]
+
+def test_compiled_cache_is_used_only_for_an_unchanged_rules_file(rules_dir):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump([rule("a", "a.example")], f)
+    rules_manager.load_rules()
+    rules_manager.cache_writer.join()
+    assert os.path.exists(rules_manager.COMPILED_CACHE_FILE)
+
+    cached = rules_manager._read_compiled_cache(rules_manager._file_signature())
+    assert [r['rule_id'] for r in cached.rules] == ["a"]
+    assert matched_id(cached, query("a.example")) == "a"
+
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump([rule("a", "a.example"), rule("b", "b.example")], f)
+    assert rules_manager._read_compiled_cache(rules_manager._file_signature()) is None
+    assert [r['rule_id'] for r in rules_manager.load_rules()] == ["a", "b"]
+
+def test_journal_bypasses_the_compiled_cache(rules_dir):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump([rule("a", "a.example")], f)
+    rules_manager.load_rules()
+    rules_manager.cache_writer.join()
+    write_journal({"op": "delete", "rule_id": "a"})
+    assert rules_manager.load_rules() == ()
+
+def test_invalid_compiled_cache_is_ignored(rules_dir):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump([rule("a", "a.example")], f)
+    signature = rules_manager._file_signature()
+    ruleset = rules_manager.compile_rules([rule("a", "a.example", priority="high")])
+    with open(rules_manager.COMPILED_CACHE_FILE, 'wb') as f:
+        rules_manager.pickle.dump((rules_manager.COMPILED_CACHE_FORMAT, signature), f)
+        rules_manager.pickle.dump(ruleset, f)
+    assert rules_manager._read_compiled_cache(signature) is None
+    assert rules_manager.load_rules()[0]['priority'] == 1
+
+def test_edits_load_the_rules_file_first_and_never_save_before_a_load(rules_dir):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump([rule("a", "a.example")], f)
+    with pytest.raises(RuntimeError):
+        rules_manager.save_rules()
+    rules_manager.add_rule(rule("b", "b.example"))
+    rules_manager.flush_rules()
+    with open(rules_manager.RULES_FILE) as f:
+        assert [r['rule_id'] for r in json.load(f)] == ["a", "b"]
+
+def test_unloadable_rules_file_is_left_alone(rules_dir):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        f.write('[{"rule_id": ')
+    with pytest.raises(ValueError):
+        rules_manager.add_rule(rule("b", "b.example"))
+    assert not rules_manager.rules_loaded
+    with open(rules_manager.RULES_FILE) as f:
+        assert f.read() == '[{"rule_id": '
+
+def trie_patterns(trie):
+    """
+    Flattens a SuffixTrie into {(reversed labels, qtype): candidates}.
+    """
+    patterns, stack = {}, [((), trie.root)]
+    while stack:
+        path, (children, by_qtype) = stack.pop()
+        patterns.update(((path, qtype), candidates) for qtype, candidates in by_qtype.items())
+        stack.extend((path + (label,), child) for label, child in children.items())
+    return patterns
+
+def same_ruleset(edited, compiled):
+    def buckets(index):
+        return {key: getattr(candidates, 'entries', candidates) for key, candidates in index.items()}
+    assert edited.rules == compiled.rules and edited.active == compiled.active
+    assert buckets(edited.index) == buckets(compiled.index)
+    assert buckets(trie_patterns(edited.wildcards)) == buckets(trie_patterns(compiled.wildcards))
+
+def test_edits_match_a_full_compilation():
+    rng = random.Random(14)
+    names = ["a.example", "b.example", "*.example", "*.x.example"]
+
+    def random_rule(i):
+        conditions = {}
+        if rng.random() < 0.5:
+            conditions['l3'] = {"src_ip": f"10.{rng.randrange(4)}.0.0/16"}
+        new_rule = rule(f"r{rng.randrange(40)}", rng.choice(names), qtype=rng.choice((1, 28)),
+                        priority=rng.randrange(3), **conditions)
+        new_rule['is_enabled'] = rng.random() < 0.9
+        return new_rule
+
+    ruleset = rules_manager.compile_rules([])
+    for i in range(400):
+        op = rng.choice(('add', 'add', 'update', 'delete'))
+        if op == 'add':
+            change = ('add', random_rule(i))
+        elif op == 'update':
+            change = ('update', f"r{rng.randrange(40)}", random_rule(i))
+        else:
+            change = ('delete', f"r{rng.randrange(40)}")
+        edited = rules_manager.edit_ruleset(ruleset, change)
+        if edited is None:
+            assert all(r['rule_id'] != change[1] for r in ruleset.rules)
+            continue
+        same_ruleset(edited, rules_manager.compile_rules(list(edited.rules)))
+        ruleset = edited
+    assert len(ruleset.rules) > 20 and any(isinstance(c, rules_manager.SourceRangeIndex)
+                                           for c in ruleset.index.values())
+
+@pytest.mark.parametrize('malformed', [
+    [rule("a", "a.example", priority="high")],
+    [dict(rule("a", "a.example"), trigger_condition={"dns": {"qname": "a.example", "flags": []}})],
+    {"rules": []},
+])
+def test_malformed_rules_file_is_rejected(rules_dir, malformed):
+    with open(rules_manager.RULES_FILE, 'w') as f:
+        json.dump(malformed, f)
+    active = rules_manager.snapshot
+    with pytest.raises(ValueError):
+        rules_manager.load_rules()
+    assert rules_manager.snapshot is active